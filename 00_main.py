@@ -1,20 +1,26 @@
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-
-from scipy.spatial import KDTree
 
 # default modules
-import random
 import json
+import os
 import time
+from concurrent.futures import wait, FIRST_COMPLETED, ALL_COMPLETED
 from pathlib import Path
 
 # load external files
+import benign_cache
 import file_io
+import frame_cache
+import instrument
 import spoofer
 import slam
 import generate_rosbag
+import inprocess_slam
+import proxy_score
+import results_store
+import scheduler
+import seeding
+import spoofing_sim
 import error_estimate
 import post_process
 
@@ -23,21 +29,22 @@ def main():
     with open('config_temp.json', 'r') as f:
         config = json.load(f)
 
-    # --- [追加] 結果を蓄積するための辞書 ---
-    results_storage = {algo: [] for algo in ['kiss_icp', 'fast_lio', 'direct_lio', 'glim']}
+    # 結果は試行毎にSQLite (main.results_db) へ書き込み、途中で止まっても次回の実行で続きから再開する
+    store = results_store.ResultsStore(config['main'].get('results_db', 'results.sqlite'))
 
-    ref_x, ref_y, ref_z = file_io.load_reference(config['main']['reference_file'])
-    loaded_dataframe = file_io.load_reference_df(config['main']['reference_file'])
+    # 工程毎の時間/カウンタをJSON lines (main.trace_file) に書き、最後に集計表を表示する
+    trace_file = config['main'].get('trace_file')
+    run_id = f"{int(time.time())}-{os.getpid()}"
+    instrument.configure(trace_file, run=run_id)
+
+    # spoofingパラメータは実行毎に1回だけ読み込む
+    sim_params = spoofing_sim.load_params(config)
 
-    success_kiss = 0
-    success_flio = 0
-    success_dlio = 0
-    success_glim = 0
+    ref_x, ref_y, ref_z = file_io.load_reference(config['main']['reference_file'])
+    reference_index = file_io.load_reference_index(config['main']['reference_file'])
 
-    # record benign
-    slam_algorithm = ['glim']
-    #slam_algorithm = ['direct_lio']
-    bag_path = config['rosbag']['output_bag']
+    # record benign (slam.algorithm : アルゴリズム名かそのリスト)
+    slam_algorithm = slam.configured_algorithms(config)
 
     lidar_topic = config['rosbag']['lidar_topic']
     imu_topic = config['rosbag']['imu_topic']
@@ -45,80 +52,352 @@ def main():
     benign_save_dir = config['slam']['benign_save_dir']
     save_dir = config['slam']['save_dir']
 
-    # generate ground truth (修正：既に存在する場合はスキップする処理などを入れると効率的です)
-    for algorithm in slam_algorithm:
-        slam.run_slam(algorithm=algorithm, bag_path=config['rosbag']['input_bag'], topic=lidar_topic, imu_topic=imu_topic, save_dir=benign_save_dir, rosbag_rate=1.0)
-        old_file = Path(benign_save_dir) / "temp.txt"
-        new_file = old_file.with_name(f"{algorithm}_benign.txt")
+    # SLAMは別ポートのROS masterで最大slam.max_parallel個を同時に実行する
+    max_parallel_slam = int(config['slam'].get('max_parallel', 1))
+    # algorithm -> launchファイル (slam.launch_filesで上書きできる)
+    launch_files = slam.launch_files(config)
+    # slam.early_stop : 推定軌跡を監視し、RPEがsuccess_thresholdを超えた時点でSLAMを止める (攻撃成功が確定)
+    # slam.stall_timeout : 新しい姿勢がこの秒数書かれなければ止める (失敗として扱う)
+    early_stop = bool(config['slam'].get('early_stop', False))
+    runner = slam.SlamRunner(max_parallel=max_parallel_slam, timeout=config['slam'].get('timeout'),
+                             success_threshold=float(config['evaluation']['success_threshold']) if early_stop else None,
+                             stall_timeout=config['slam'].get('stall_timeout'),
+                             poll_interval=float(config['slam'].get('monitor_interval', 1.0)),
+                             launch_files=launch_files)
 
-        if old_file.exists():
-            old_file.rename(new_file)
-        else:
-            print(f"Error {old_file} not found.")
+    # slam.inprocess_kiss : kiss_icpはbagを書かずに生成パイプラインから直接in-processのKISS-ICPへ流す (inprocess_slam)
+    # benign軌跡もin-processで求める (roslaunch版とはdeskewの有無などが違うので混ぜない)
+    inprocess_kiss = bool(config['slam'].get('inprocess_kiss', False))
+    if inprocess_kiss and 'kiss_icp' not in slam_algorithm:
+        raise ValueError(f"slam.inprocess_kiss requires kiss_icp in slam.algorithm (got {slam_algorithm})")
+    kiss_config = config['slam'].get('kiss_config')
+    bag_algorithms = [algorithm for algorithm in slam_algorithm if not (inprocess_kiss and algorithm == 'kiss_icp')]
+
+    # generate ground truth (入力bag, アルゴリズム, launch (パラメータファイルの中身を含む), rosbag_rateが同じならキャッシュを使う)
+    benign_rate = 1.0
+    cache = benign_cache.BenignCache(config['slam'].get('benign_cache_dir', Path(benign_save_dir) / "cache"),
+                                     max_bytes=config['slam'].get('benign_cache_max_bytes'),
+                                     verify_content=bool(config['slam'].get('benign_cache_verify_content', False)))
+    benign_runs = {}
+    for algorithm in bag_algorithms:
+        new_file = Path(benign_save_dir) / f"{algorithm}_benign.txt"
+        cache_key = cache.key(config['rosbag']['input_bag'], algorithm, launch_files[algorithm], benign_rate,
+                              slam.launch_dependencies(algorithm, launch_files))
+        if cache.fetch(cache_key, new_file):
+            print(f"benign trajectory of {algorithm} loaded from cache")
+            continue
+        future = runner.submit(algorithm, config['rosbag']['input_bag'], lidar_topic, Path(benign_save_dir) / algorithm,
+                               rosbag_rate=benign_rate, imu_topic=imu_topic)
+        benign_runs[algorithm] = (future, cache_key)
+
+    for algorithm, (future, cache_key) in benign_runs.items():
+        result = future.result()
+        old_file = result.trajectory
+        new_file = Path(benign_save_dir) / f"{algorithm}_benign.txt"
+
+        # benign軌跡が無いと全ての試行の評価が失敗するので、bagを生成する前に止める
+        if not result.ok:
+            raise RuntimeError(f"benign SLAM ({algorithm}) failed: exit code {result.returncode}, timed out {result.timed_out}, "
+                               f"stopped {result.stopped}, log {result.log_path}")
+        old_file.rename(new_file)
+        cache.put(cache_key, new_file, algorithm=algorithm, bag=str(config['rosbag']['input_bag']),
+                  launch_file=launch_files[algorithm], rosbag_rate=benign_rate)
+
+    benign_trajectories = {} # algorithm -> TUM配列 (in-process)
+    if inprocess_kiss:
+        with instrument.span('replay.benign', emit_event=True):
+            benign_trajectories['kiss_icp'] = inprocess_slam.run_trials([None], reference_index, sim_params, config_file=kiss_config)[0]
 
     n_sims = int(config['main']['n_simulations'])
-    for iter in range(n_sims):
-        print(f"\n>>> Trial {iter + 1} / {n_sims}")
-        
-        index = random.randint(0, ref_x.shape[0]-1)
-        # Spoofer位置決定
-        spoofer_x, spoofer_y, spoofer_z = spoofer.decide_spoofer_placement(ref_x[index], ref_y[index], ref_z[index])
-
-        # generate rosbag
-        generate_rosbag.generate_main(spoofer_x, spoofer_y, loaded_dataframe)
-
-        for algorithm in slam_algorithm:
-            slam.run_slam(algorithm=algorithm, bag_path=bag_path, topic=lidar_topic, imu_topic=imu_topic, save_dir=save_dir)
-
-            # evaluate
-            gt_path = Path(benign_save_dir) / f"{algorithm}_benign.txt"
-            APE = error_estimate.evo_eval_result(gt_path, config['evaluation']['estimated'])
-            RPE = error_estimate.evo_rpe_eval_results(gt_path, config['evaluation']['estimated'])
-
-            old_file = Path(config['evaluation']['estimated'])
-            print(f"old file:{old_file}")
-            new_file = old_file.with_name(f"test{iter}.txt")
-
-            if old_file.exists():
-                old_file.rename(new_file)
-            else:
-                print(f"Error {old_file} not found.")
-
-            # --- [追加] データの記録 ---
-            results_storage[algorithm].append({
-                'iteration': iter,
-                'spoofer_x': spoofer_x,
-                'spoofer_y': spoofer_y,
-                'spoofer_z': spoofer_z,
-                'APE': APE,
-                'RPE': RPE
-            })
-
-            if RPE >= float(config['evaluation']['success_threshold']):
-                if algorithm == "kiss_icp": success_kiss += 1
-                elif algorithm == "fast_lio": success_flio += 1
-                elif algorithm == "direct_lio": success_dlio += 1
-                elif algorithm == "glim": success_glim += 1
+
+    # campaign seed (main.seed) から試行毎のseedを作る。main.trialsで一部の試行だけを再実行できる
+    # main.seedがnullでも、結果に影響する設定 (seeding.campaign_settings) が同じcampaignが記録されていればそのseedで再開する
+    # (main.resume=falseなら新規)。n_simulations/main.trials/worker数/timeoutなどを変えても同じcampaignになる
+    settings = seeding.campaign_settings(config, sim_params, slam_algorithm)
+    campaign_seed = config['main'].get('seed')
+    if campaign_seed is None and config['main'].get('resume', True):
+        # 前のversionはconfig全体で探していた
+        campaign_seed = store.find_campaign(settings, fallback=config)
+    campaign_seed = seeding.campaign_seed(None if campaign_seed is None else int(campaign_seed))
+    campaign_id = str(campaign_seed)
+    store.register_campaign(campaign_id, settings)
+    print(f"campaign seed: {campaign_seed}")
+    trial_ids = config['main'].get('trials')
+    if trial_ids is None:
+        trial_ids = range(n_sims)
+    trial_ids = sorted(int(iter) for iter in trial_ids)
+
+    # 試行毎の乱数seedを先に決める
+    seeds = {iter: seeding.trial_seed(campaign_seed, iter) for iter in trial_ids}
+
+    # spoofer配置 : spoofer.sampling = random (試行毎に独立) / stratified / lhs / adaptive (RPEがsuccess_thresholdに近い配置の周辺を重点的に)
+    sampling = config['spoofer'].get('sampling', 'random')
+    if sampling not in spoofer.SAMPLING_METHODS:
+        raise ValueError(f"unknown sampling method: {sampling}")
+    if sampling == 'adaptive' and config['main'].get('trials') is not None:
+        raise ValueError("main.trials cannot be combined with adaptive sampling")
+    success_threshold = float(config['evaluation']['success_threshold'])
+    dist_from_traj = float(config['spoofer']['dist_from_traj'])
+    distance_threshold = float(config['rosbag']['distance_threshold'])
+    # distance_threshold以内に入るLiDARフレームがmin_frames_in_range未満の配置は使わない
+    min_frames = int(config['spoofer'].get('min_frames_in_range', 0))
+    frame_xy = generate_rosbag.lidar_frame_xy(config['rosbag']['input_bag'], lidar_topic, reference_index)
+    if frame_xy is None:
+        frame_xy = np.column_stack((ref_x, ref_y))
+    placement_args = (ref_x, ref_y, ref_z, dist_from_traj, frame_xy, distance_threshold)
+
+    placements = {} # iter -> spoofer.Placements (1行)
+
+    def place_trials(ids, round_index):
+        if sampling == 'random':
+            # 試行毎のplacement_rngで決める (main.trialsで1試行だけ再実行しても同じ配置)
+            for iter in ids:
+                placements[iter] = spoofer.sample_placements(1, seeding.placement_rng(seeds[iter]), *placement_args, min_frames=min_frames)
+            return
+
+        rng = seeding.batch_placement_rng(campaign_seed, round_index)
+        if sampling == 'adaptive' and round_index > 0:
+            history = [iter for iter in placements if iter in trial_rpe]
+            unit, weight = spoofer.adaptive_unit_samples(
+                len(ids), rng, [placements[iter].unit[0] for iter in history], [trial_rpe[iter] for iter in history],
+                success_threshold, exploration=float(config['spoofer'].get('adaptive_exploration', 0.2)),
+                bandwidth=float(config['spoofer'].get('adaptive_bandwidth', 0.05)))
+            batch = spoofer.place(unit, *placement_args, weight=weight)
+            for row, iter in enumerate(ids):
+                placements[iter] = batch.take([row])
+            return
+
+        # stratified/lhsは全試行 (n_simulations) をまとめて配置し、その中から試行indexで選ぶ
+        if sampling == 'adaptive':
+            batch = spoofer.sample_placements(len(ids), rng, *placement_args, method='lhs', min_frames=min_frames)
+            rows = range(len(ids))
+        else:
+            batch = spoofer.sample_placements(n_sims, rng, *placement_args, method=sampling, min_frames=min_frames)
+            rows = ids
+        for row, iter in zip(rows, ids):
+            placements[iter] = batch.take([row])
+
+    # adaptiveは試行をspoofer.adaptive_roundsに分け、前のroundまでのRPEを見て次のroundを配置する
+    if sampling == 'adaptive':
+        rounds = [[int(iter) for iter in ids] for ids in np.array_split(trial_ids, int(config['spoofer'].get('adaptive_rounds', 4))) if len(ids)]
+    else:
+        rounds = [trial_ids]
+    trial_rpe = {} # iter -> 全アルゴリズムの最大RPE
+
+    # proxy.mode : off / calibrate (proxy scoreを記録するだけ) / prune (proxy.threshold未満の試行はSLAMを実行せず失敗と予測する)
+    proxy_config = config.get('proxy', {})
+    proxy_mode = proxy_config.get('mode', 'off')
+    if proxy_mode not in ('off', 'calibrate', 'prune'):
+        raise ValueError(f"unknown proxy mode: {proxy_mode}")
+    proxy_metric = proxy_config.get('metric', 'impact')
+    proxy_threshold = float(proxy_config.get('threshold', 0.0))
+    proxy_options = None
+    if proxy_mode != 'off':
+        proxy_options = {'max_frames': int(proxy_config.get('max_frames', 50)),
+                         'max_points': int(proxy_config.get('max_points', 2000))}
+    proxy_scores = {} # iter -> proxy score
+
+    success_trials = {algorithm: set() for algorithm in slam_algorithm}
+
+    # 前回までに記録済みの (trial, algorithm) は実行しない
+    completed = store.completed(campaign_id)
+    for algorithm in slam_algorithm:
+        for row in store.rows(campaign_id, algorithm).itertuples():
+            if row.predicted_failure:
+                continue
+            trial_rpe[row.trial] = max(row.RPE, trial_rpe.get(row.trial, -np.inf))
+            if row.RPE >= success_threshold:
+                success_trials[algorithm].add(row.trial)
+    if completed:
+        print(f"resume: {len(completed)} (trial, algorithm) results already recorded")
+
+    def pending_algorithms(iter, algorithms=slam_algorithm):
+        return [algorithm for algorithm in algorithms if (iter, algorithm) not in completed]
+
+    def record_evaluation(iter, algorithm, ground_truth, trajectory, slam_time, stopped=None):
+        # ground_truth/trajectory : TUMファイルのパスか (N, 8) のTUM配列
+        spoofer_x, spoofer_y, spoofer_z = placements[iter].xyz[0]
+        evaluation_start = time.perf_counter()
+        with instrument.span('evaluate', emit_event=True, trial=iter, algorithm=algorithm):
+            evaluation = error_estimate.evaluate(ground_truth, trajectory, backend=config['evaluation'].get('backend', 'evo'))
+        evaluation_time = time.perf_counter() - evaluation_start
+        # 途中で止めた軌跡のAPEは最後まで実行したAPEと比べられないので別の列に書く (成否はRPEだけで決まる)
+        APE, ape_partial = (evaluation.ape_rmse, None) if stopped is None else (None, evaluation.ape_rmse)
+        RPE = evaluation.rpe_max
+
+        # 試行が終わる毎に書き込む
+        store.record(campaign_id, seeds[iter], algorithm,
+                     trial=iter,
+                     spoofer_x=float(spoofer_x),
+                     spoofer_y=float(spoofer_y),
+                     spoofer_z=float(spoofer_z),
+                     frames_in_range=int(placements[iter].frames[0]),
+                     weight=float(placements[iter].weight[0]),
+                     proxy_score=proxy_scores.get(iter),
+                     predicted_failure=False,
+                     APE=APE,
+                     ape_partial=ape_partial,
+                     RPE=RPE,
+                     slam_time=slam_time,
+                     stopped=stopped,
+                     timings={'slam': slam_time, 'evaluation': evaluation_time})
+
+        trial_rpe[iter] = max(RPE, trial_rpe.get(iter, -np.inf))
+        if RPE >= success_threshold:
+            success_trials[algorithm].add(iter)
+        return RPE
+
+    def record_result(iter, bag_path, result):
+        algorithm = result.algorithm
+        if not result.ok:
+            print(f"Error SLAM ({algorithm}, trial {iter}) failed: exit code {result.returncode}, timed out {result.timed_out}, "
+                  f"stopped {result.stopped}, log {result.log_path}")
+            return
+        if result.stopped is not None:
+            print(f"SLAM ({algorithm}, trial {iter}) stopped early after {result.elapsed:.1f} sec: {result.stopped}")
+
+        # evaluate
+        gt_path = Path(benign_save_dir) / f"{algorithm}_benign.txt"
+        record_evaluation(iter, algorithm, gt_path, result.trajectory, result.elapsed, result.stopped)
+
+        old_file = result.trajectory
+        new_file = old_file.with_name(f"test{iter}.txt")
+        old_file.rename(new_file)
+
+    def record_predicted_failure(iter, algorithms):
+        # proxy scoreが閾値未満 : SLAMを実行せずに失敗として記録する
+        spoofer_x, spoofer_y, spoofer_z = placements[iter].xyz[0]
+        print(f"trial {iter}: predicted failure (proxy {proxy_metric} = {proxy_scores[iter]:.4f} < {proxy_threshold})")
+        for algorithm in pending_algorithms(iter, algorithms):
+            store.record(campaign_id, seeds[iter], algorithm,
+                         trial=iter,
+                         spoofer_x=float(spoofer_x),
+                         spoofer_y=float(spoofer_y),
+                         spoofer_z=float(spoofer_z),
+                         frames_in_range=int(placements[iter].frames[0]),
+                         weight=float(placements[iter].weight[0]),
+                         proxy_score=proxy_scores[iter],
+                         predicted_failure=True,
+                         slam_time=0.0)
+
+    running = {} # future -> (iter, bag_path)
+    bag_users = {} # bag_path -> 残りのSLAM数
+
+    def collect(return_when):
+        done, _ = wait(running, return_when=return_when)
+        for future in done:
+            iter, bag_path = running.pop(future)
+            record_result(iter, bag_path, future.result())
+            bag_users[bag_path] -= 1
+            if bag_users[bag_path] == 0:
+                del bag_users[bag_path]
+                bag_path.unlink(missing_ok=True)
+
+    # rosbag.frame_cache_dir : 入力bagのLiDAR/IMUを1回だけ読み出しておき、生成はmemmapから読む (worker processで共有)
+    if config['rosbag'].get('frame_cache_dir') is not None:
+        with instrument.span('frame_cache.ingest', emit_event=True):
+            frame_cache.open_cache(config['rosbag']['frame_cache_dir'], config['rosbag']['input_bag'], lidar_topic, imu_topic,
+                                   bool(config['rosbag'].get('frame_cache_verify_content', False)))
+
+    n_done = 0
+    with runner:
+        for round_index, ids in enumerate(rounds):
+            place_trials(ids, round_index)
+            trials = [(iter, placements[iter].xyz[0, 0], placements[iter].xyz[0, 1], seeds[iter]) for iter in ids if pending_algorithms(iter)]
+            n_done += len(ids) - len(trials)
+            if not trials:
+                continue
+
+            # in-processのkiss_icp (bagを書かない)。proxy scoreによるpruneは行わない
+            if inprocess_kiss:
+                replay = [trial for trial in trials if pending_algorithms(trial[0], ['kiss_icp'])]
+                for iter, trajectory, elapsed in scheduler.replay_trials(replay, reference_index, sim_params,
+                                                                         max_workers=config['main'].get('n_workers'),
+                                                                         batch_size=int(config['main'].get('trials_per_read', 1)),
+                                                                         kiss_config=kiss_config):
+                    RPE = record_evaluation(iter, 'kiss_icp', benign_trajectories['kiss_icp'], trajectory, elapsed)
+                    print(f"trial {iter}: kiss_icp (in-process) RPE {RPE:.3f}")
+                # bagが必要な試行 (他のアルゴリズムが残っている) だけ生成する
+                remaining = [trial for trial in trials if pending_algorithms(trial[0], bag_algorithms)]
+                n_done += len(trials) - len(remaining)
+                trials = remaining
+                if not trials:
+                    continue
+
+            # generate rosbag (process poolで並列生成し、できたbagから順にSLAMへ)
+            ready_bags = scheduler.generate_trials(trials, reference_index, sim_params,
+                                                   config['rosbag']['input_bag'], config['rosbag']['output_bag'],
+                                                   max_workers=config['main'].get('n_workers'),
+                                                   batch_size=int(config['main'].get('trials_per_read', 1)),
+                                                   keep_bags=True, proxy=proxy_options,
+                                                   profile_dir=config['main'].get('profile_dir'), held_bags=max_parallel_slam)
+
+            for iter, bag_path, score in ready_bags:
+                n_done += 1
+                print(f"\n>>> Trial {iter + 1} ({n_done} / {len(trial_ids)})")
+                if score is not None:
+                    proxy_scores[iter] = score.value(proxy_metric)
+                    if proxy_mode == 'prune' and proxy_scores[iter] < proxy_threshold:
+                        record_predicted_failure(iter, bag_algorithms)
+                        bag_path.unlink(missing_ok=True)
+                        continue
+                bag_users[bag_path] = len(pending_algorithms(iter, bag_algorithms))
+
+                for algorithm in pending_algorithms(iter, bag_algorithms):
+                    run_dir = Path(save_dir) / f"{algorithm}_{iter:03d}"
+                    gt_path = Path(benign_save_dir) / f"{algorithm}_benign.txt"
+                    future = runner.submit(algorithm, bag_path, lidar_topic, run_dir, imu_topic=imu_topic,
+                                           ground_truth=gt_path if early_stop and gt_path.exists() else None)
+                    running[future] = (iter, bag_path)
+
+                # SLAMの空きができるまで次のbagを要求しない (ディスク上のbag数を抑える)
+                while len(running) >= max_parallel_slam:
+                    collect(FIRST_COMPLETED)
+
+            # 次のroundの配置はこのroundの結果を使う
+            while running:
+                collect(ALL_COMPLETED)
 
     # --- [追加] CSV書き出し ---
     print("\n" + "="*30)
     for algorithm in slam_algorithm:
-        if results_storage[algorithm]:
-            df = pd.DataFrame(results_storage[algorithm])
+        df = store.rows(campaign_id, algorithm)
+        if len(df):
+            df = df.rename(columns={'trial': 'iteration', 'campaign_id': 'campaign_seed'})
             output_csv = f"result_{algorithm}.csv"
             df.to_csv(output_csv, index=False)
             print(f"Saved: {output_csv}")
 
+            # proxy scoreと実際のRPEの比較 (SLAMを実行した試行のみ)
+            if proxy_mode != 'off':
+                evaluated = df[~df['predicted_failure']]
+                correlation, report = proxy_score.calibration_report(evaluated['proxy_score'], evaluated['RPE'], success_threshold)
+                report_csv = f"proxy_calibration_{algorithm}.csv"
+                report.to_csv(report_csv, index=False)
+                print(f"proxy {proxy_metric} vs RPE ({algorithm}): Spearman {correlation:.3f}, saved {report_csv}")
+
     # --- [追加] クリーンアップ (外部呼び出しのダミー) ---
     post_process.cleanup_results([benign_save_dir, save_dir]) 
     print("Cleanup completed (dummy).")
     print("="*30 + "\n")
 
+    # 工程毎の時間の集計 (worker processの分も含む)
+    instrument.flush()
+    if trace_file is not None and Path(trace_file).exists():
+        table, counters = instrument.summary(trace_file, run=run_id)
+        print(table.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+        for name, value in counters.items():
+            print(f"{name}: {value}")
+
     # 成功率の表示
     for algorithm in slam_algorithm:
-        counts = {"kiss_icp": success_kiss, "fast_lio": success_flio, "direct_lio": success_dlio, "glim": success_glim}
-        success_rate = counts[algorithm] / n_sims
-        print(f"{algorithm}: {counts[algorithm]}/{n_sims} success. Rate: {success_rate * 100:.2f}%")
+        n_success = len(success_trials[algorithm])
+        success_rate = n_success / len(trial_ids)
+        print(f"{algorithm}: {n_success}/{len(trial_ids)} success. Rate: {success_rate * 100:.2f}%")
+        if sampling == 'adaptive':
+            weighted_rate = spoofer.weighted_success_rate([iter in success_trials[algorithm] for iter in trial_ids],
+                                                          [placements[iter].weight[0] for iter in trial_ids])
+            print(f"{algorithm}: weighted success rate (uniform placement): {weighted_rate * 100:.2f}%")
 
 if __name__ == "__main__":
     start = time.time()
@@ -0,0 +1,488 @@
+import numpy as np
+import pandas as pd
+
+# rosbags libraries
+from rosbags.rosbag1 import Writer
+from rosbags.typesys import Stores, get_typestore
+
+# default modules
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# load external files
+import spoofing_sim
+
+def synthetic_cloud(rings=64, columns=1024, seed=0):
+    # Ouster/Velodyne風の(rings x columns)点群を作る
+    rng = np.random.default_rng(seed)
+    azimuth = np.tile(np.linspace(-np.pi, np.pi, columns, endpoint=False), rings)
+    elevation = np.repeat(np.radians(np.linspace(-15.0, 15.0, rings)), columns)
+    r = rng.uniform(1.0, 50.0, rings * columns)
+    cloud = np.empty((rings * columns, 3), dtype=np.float32)
+    cloud[:, 0] = r * np.cos(elevation) * np.cos(azimuth)
+    cloud[:, 1] = r * np.cos(elevation) * np.sin(azimuth)
+    cloud[:, 2] = r * np.sin(elevation)
+    return cloud
+
+def time_per_frame(func, n_frames):
+    start = time.perf_counter()
+    for i in range(n_frames):
+        func(i)
+    return (time.perf_counter() - start) / n_frames * 1e3 # msec
+
+def bench_config_loading(config_path='config_temp.json', n_frames=200):
+    # 旧実装 (フレーム毎にjsonを読む) と SimulationParams を1回だけ作る場合の比較
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    params = spoofing_sim.load_params(config)
+    cloud = synthetic_cloud()
+
+    def reload_params():
+        with open(config_path, 'r') as f:
+            return spoofing_sim.load_params(json.load(f))
+
+    kernels = {
+        'removal': lambda p, i: spoofing_sim.spoof_main(cloud, 30.0, p),
+        'static_injection': lambda p, i: spoofing_sim.injection_main(cloud, 30.0, p),
+        'dynamic_injection': lambda p, i: spoofing_sim.dynamic_injection_main(cloud, i * 0.1, 30.0, p),
+    }
+
+    results = {}
+    print(f"{'mode':<20}{'per-frame load [ms]':>22}{'params once [ms]':>20}")
+    for mode, kernel in kernels.items():
+        before = time_per_frame(lambda i: kernel(reload_params(), i), n_frames)
+        after = time_per_frame(lambda i: kernel(params, i), n_frames)
+        print(f"{mode:<20}{before:>22.3f}{after:>20.3f}")
+        results[f"config_loading/{mode}"] = after
+
+    load_only = time_per_frame(lambda i: reload_params(), n_frames)
+    print(f"config parse only: {load_only:.3f} ms/frame")
+    return results
+
+def bench_sector_mask(n_points=131072, spoofing_ranges=(30.0, 90.0, 200.0, 360.0), centers=(0.0, 30.0, 179.0, -120.0), n_frames=50):
+    # 内積によるsector_maskとarctan2による判定の一致確認 (原点の点を含む) と速度比較
+    rng = np.random.default_rng(0)
+    cloud = rng.uniform(-50.0, 50.0, (n_points, 3)).astype(np.float32)
+    cloud[:n_points // 64, :2] = 0.0 # 原点 (無効点) : どの範囲にも入らない
+    azimuth = np.degrees(np.arctan2(cloud[:, 1], cloud[:, 0]).astype(np.float64))
+    at_origin = (cloud[:, 0] == 0) & (cloud[:, 1] == 0)
+
+    results = {}
+    print(f"{'range':>7}{'center':>8}{'dot [ms]':>10}{'arctan2 [ms]':>14}")
+    for spoofing_range in spoofing_ranges:
+        for center in centers:
+            mask = spoofing_sim.sector_mask(cloud, center, spoofing_range)
+            offset = np.abs((azimuth - center + 180.0) % 360.0 - 180.0)
+            expected = (offset <= spoofing_range / 2) & ~at_origin
+            # float32の丸めで範囲の境界 (1e-3 degree以内) だけは違ってよい
+            wrong = (mask != expected) & (np.abs(offset - spoofing_range / 2) > 1e-3)
+            if np.any(wrong) or np.any(mask[at_origin]):
+                raise AssertionError(f"sector_mask does not match arctan2 (range {spoofing_range}, center {center})")
+
+            dot_ms = time_per_frame(lambda i: spoofing_sim.sector_mask(cloud, center, spoofing_range), n_frames)
+            arctan_ms = time_per_frame(lambda i: np.abs((np.degrees(np.arctan2(cloud[:, 1], cloud[:, 0])) - center + 180.0) % 360.0 - 180.0)
+                                       <= spoofing_range / 2, n_frames)
+            print(f"{spoofing_range:>7g}{center:>8g}{dot_ms:>10.3f}{arctan_ms:>14.3f}")
+            results[f"sector_mask/{spoofing_range:g}/{center:g}"] = dot_ms
+    return results
+
+def synthetic_trajectories(n_poses=5000, drift=5.0, seed=0):
+    # (benign, spoofed) のTUM配列 : 10Hz, 約0.5m/frameで走る軌跡
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_poses) * 0.1
+    yaw = t / 50.0
+    xyz = np.column_stack((np.cumsum(np.full(n_poses, 0.5) * np.cos(yaw)), np.cumsum(np.full(n_poses, 0.5) * np.sin(yaw)), np.zeros(n_poses)))
+    quat = np.column_stack((np.zeros(n_poses), np.zeros(n_poses), np.sin(yaw / 2), np.cos(yaw / 2)))
+    benign = np.column_stack((t, xyz, quat))
+
+    noise = rng.normal(0.0, 0.2, (n_poses, 3)) + np.column_stack((np.linspace(0.0, drift, n_poses), np.zeros((n_poses, 2))))
+    spoofed = np.column_stack((t + rng.uniform(-0.003, 0.003, n_poses), xyz + noise, quat))
+    return benign, spoofed
+
+def bench_evaluation(n_poses=(1000, 5000, 20000), n_repeat=5, tolerance=1e-6):
+    # evoとnumpy backendの速度比較と結果の一致確認
+    import error_estimate
+
+    summary = {}
+    print(f"{'poses':>8}{'evo [ms]':>12}{'numpy [ms]':>12}{'|APE diff|':>14}{'|RPE diff|':>14}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in n_poses:
+            benign, spoofed = synthetic_trajectories(n)
+            gt_path, est_path = Path(tmp) / f"benign_{n}.txt", Path(tmp) / f"spoofed_{n}.txt"
+            np.savetxt(gt_path, benign)
+            np.savetxt(est_path, spoofed)
+
+            results = {}
+            times = {}
+            for backend in ('evo', 'numpy'):
+                start = time.perf_counter()
+                for _ in range(n_repeat):
+                    results[backend] = error_estimate.evaluate(gt_path, est_path, backend=backend)
+                times[backend] = (time.perf_counter() - start) / n_repeat * 1e3
+
+            ape_diff = abs(results['evo'].ape_rmse - results['numpy'].ape_rmse)
+            rpe_diff = abs(results['evo'].rpe_max - results['numpy'].rpe_max)
+            print(f"{n:>8}{times['evo']:>12.2f}{times['numpy']:>12.2f}{ape_diff:>14.2e}{rpe_diff:>14.2e}")
+            if max(ape_diff, rpe_diff) > tolerance or results['evo'].n_matched != results['numpy'].n_matched:
+                raise AssertionError(f"numpy backend does not match evo ({n} poses)")
+            for backend, elapsed in times.items():
+                summary[f"evaluation/{n}/{backend}"] = elapsed
+    return summary
+
+# sensor_msgs/PointField : (name, offset, datatype) / point_step
+POINT_LAYOUTS = {
+    # Ouster OS1 (os_cloud_node) : 48 byte
+    'ouster': ([('x', 0, 7), ('y', 4, 7), ('z', 8, 7), ('intensity', 16, 7), ('t', 20, 6),
+                ('reflectivity', 24, 4), ('ring', 26, 4), ('ambient', 28, 4), ('range', 32, 6)], 48),
+    # velodyne_pointcloud : 22 byte
+    'velodyne': ([('x', 0, 7), ('y', 4, 7), ('z', 8, 7), ('intensity', 12, 7), ('ring', 16, 4), ('time', 18, 7)], 22),
+}
+
+def layout_fields(layout, typestore):
+    # (PointFieldのリスト, point_step)
+    field_specs, point_step = POINT_LAYOUTS[layout]
+    PointField = typestore.types['sensor_msgs/msg/PointField']
+    return [PointField(name=name, offset=offset, datatype=datatype, count=1) for name, offset, datatype in field_specs], point_step
+
+def synthetic_bag(bag_path, reference_csv, rings=64, columns=1024, n_frames=20, layout='ouster',
+                  lidar_topic='/points', imu_topic='/imu', lidar_freq=10.0, imu_freq=100.0, speed=1.0, seed=0):
+    """
+    ROS1 bag (organized PointCloud2 + IMU) と基準軌跡CSVを作る
+    ロボットはx軸上をspeed [m/s] で直進し、CSVの時刻はbag先頭からの秒 (compare_referenceと同じ)
+    """
+    import generate_rosbag
+    typestore = get_typestore(Stores.ROS1_NOETIC)
+    types = typestore.types
+    fields, point_step = layout_fields(layout, typestore)
+    dtype = generate_rosbag.point_dtype(fields, point_step)
+
+    rng = np.random.default_rng(seed)
+    cloud = synthetic_cloud(rings, columns, seed)
+    start_ns = 1_600_000_000 * 1_000_000_000
+    lidar_period, imu_period = int(1e9 / lidar_freq), int(1e9 / imu_freq)
+
+    def header(seq, stamp_ns, frame_id):
+        stamp = types['builtin_interfaces/msg/Time'](sec=stamp_ns // 1_000_000_000, nanosec=stamp_ns % 1_000_000_000)
+        return types['std_msgs/msg/Header'](seq=seq, stamp=stamp, frame_id=frame_id)
+
+    Path(bag_path).unlink(missing_ok=True)
+    with Writer(Path(bag_path)) as writer:
+        lidar_conn = writer.add_connection(lidar_topic, 'sensor_msgs/msg/PointCloud2', typestore=typestore)
+        imu_conn = writer.add_connection(imu_topic, 'sensor_msgs/msg/Imu', typestore=typestore)
+        vector3, quaternion = types['geometry_msgs/msg/Vector3'], types['geometry_msgs/msg/Quaternion']
+
+        n_imu = int(n_frames * lidar_period // imu_period)
+        for seq in range(n_imu):
+            stamp_ns = start_ns + seq * imu_period
+            imu = types['sensor_msgs/msg/Imu'](
+                header=header(seq, stamp_ns, 'imu'), orientation=quaternion(x=0.0, y=0.0, z=0.0, w=1.0),
+                orientation_covariance=np.zeros(9), angular_velocity=vector3(x=0.0, y=0.0, z=0.0),
+                angular_velocity_covariance=np.zeros(9), linear_acceleration=vector3(x=0.0, y=0.0, z=9.81),
+                linear_acceleration_covariance=np.zeros(9))
+            writer.write(imu_conn, stamp_ns, typestore.serialize_ros1(imu, imu_conn.msgtype))
+
+        for seq in range(n_frames):
+            stamp_ns = start_ns + seq * lidar_period
+            points = np.zeros(rings * columns, dtype=dtype)
+            jitter = rng.normal(0.0, 0.01, cloud.shape).astype(np.float32)
+            for i, name in enumerate(('x', 'y', 'z')):
+                points[name] = cloud[:, i] + jitter[:, i]
+            points['intensity'] = rng.uniform(0.0, 100.0, points.shape[0])
+            points['ring'] = np.repeat(np.arange(rings), columns)
+            msg = types['sensor_msgs/msg/PointCloud2'](
+                header=header(seq, stamp_ns, 'lidar'), height=rings, width=columns, fields=fields,
+                is_bigendian=False, point_step=point_step, row_step=point_step * columns,
+                data=points.view(np.uint8), is_dense=True)
+            writer.write(lidar_conn, stamp_ns, typestore.serialize_ros1(msg, lidar_conn.msgtype))
+
+    t = np.arange(n_frames) / lidar_freq
+    pd.DataFrame({'timestamp': t, 'x': speed * t, 'y': np.zeros(n_frames), 'z': np.zeros(n_frames),
+                  'qx': 0.0, 'qy': 0.0, 'qz': 0.0, 'qw': 1.0}).to_csv(reference_csv, index=False)
+
+@contextmanager
+def working_directory(path):
+    # generate_rosbagはカレントディレクトリのconfig_temp.jsonを読む
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+# (spoofing_mode, injection_mode)
+SPOOFING_CASES = [('removal', 'wall'), ('static_injection', 'wall'), ('static_injection', 'corner'),
+                  ('dynamic_injection', 'wall'), ('dynamic_injection', 'corner')]
+
+def bench_stages(rings=(16, 32, 64, 128), layouts=('ouster', 'velodyne'), columns=1024, n_frames=20, config_path='config_temp.json'):
+    """
+    合成bagでgenerate_rosbagの工程毎の時間 [ms/frame] を測る
+    decode/spoof/serialize/write はgenerate_manyのinstrument span、mask/inject/encodeはカーネル単体
+    全フレームがspoofing範囲に入るように配置する
+    """
+    import file_io
+    import generate_rosbag
+    import instrument
+
+    with open(config_path, 'r') as f:
+        base_config = json.load(f)
+    typestore = get_typestore(Stores.ROS1_NOETIC)
+
+    results = {}
+    print(f"{'layout':<10}{'rings':>6}{'case':>26}{'decode':>9}{'mask':>9}{'inject':>9}{'encode':>9}{'spoof':>9}{'serial':>9}{'write':>9}{'total':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for layout in layouts:
+            for n_rings in rings:
+                bag, csv = tmp / f"{layout}_{n_rings}.bag", tmp / f"{layout}_{n_rings}.csv"
+                synthetic_bag(bag, csv, n_rings, columns, n_frames, layout)
+                reference_index = file_io.load_reference_index(csv)
+
+                for spoofing_mode, injection_mode in SPOOFING_CASES:
+                    config = json.loads(json.dumps(base_config))
+                    config['rosbag'].update(input_bag=str(bag), output_bag=str(tmp / "out.bag"), lidar_topic='/points',
+                                            imu_topic='/imu', spoofing_mode=spoofing_mode, distance_threshold=1e9)
+                    config['spoofing_simulation']['injection_mode'] = injection_mode
+                    params = spoofing_sim.load_params(config)
+                    with open(tmp / "config_temp.json", 'w') as f:
+                        json.dump(config, f)
+
+                    instrument.flush()
+                    with working_directory(tmp):
+                        start = time.perf_counter()
+                        generate_rosbag.generate_main(0.0, 3.0, reference_index, params, output_bag_path=tmp / "out.bag", seed=0)
+                        total = (time.perf_counter() - start) / n_frames * 1e3
+                    spans, _ = instrument.flush()
+                    stage = {name.split('.', 1)[1]: s['total'] / n_frames * 1e3 for name, s in spans.items()}
+
+                    # カーネル単体 (1フレーム分)
+                    cloud = synthetic_cloud(n_rings, columns)
+                    rng = np.random.default_rng(0)
+                    points = np.zeros(cloud.shape[0], dtype=generate_rosbag.point_dtype(*layout_fields(layout, typestore)))
+                    mask_ms = time_per_frame(lambda i: spoofing_sim.sector_mask(cloud, 30.0, params.spoofing_range), n_frames)
+                    if spoofing_mode == 'removal':
+                        kernel = lambda i: spoofing_sim.noise_simulation(cloud, 30.0, params, rng)
+                    else:
+                        kernel = lambda i: spoofing_sim.injection_simulation(cloud, 30.0, params.static_wall_dist, params, rng)
+                    inject_ms = time_per_frame(kernel, n_frames)
+                    keep_mask, spoofed = kernel(0)
+                    encode_ms = time_per_frame(lambda i: generate_rosbag.encode_points(points, keep_mask, spoofed), n_frames)
+
+                    case = f"{spoofing_mode}/{injection_mode}"
+                    row = {'decode': stage.get('decode', 0.0), 'mask': mask_ms, 'inject': inject_ms, 'encode': encode_ms,
+                           'spoof': stage.get('spoof', 0.0), 'serialize': stage.get('serialize', 0.0),
+                           'write': stage.get('write', 0.0), 'total': total}
+                    print(f"{layout:<10}{n_rings:>6}{case:>26}" + ''.join(f"{value:>9.2f}" for value in row.values()))
+                    for name, value in row.items():
+                        results[f"stages/{layout}/{n_rings}/{case}/{name}"] = value
+    return results
+
+def bench_defense(rings=(16, 64, 128), columns=1024, n_frames=60, frame_rates=(10.0, 20.0), config_path='config_temp.json'):
+    """
+    defense.DefenseStageの1フレームの処理時間 (deserialize/検知/除去/serialize) [ms] を合成bagで測る
+    spoofingはロボットがspooferの近くを通る中間のフレームだけにかかる (前半でbaselineを作る)
+    fired (benign) は誤検知、fired (spoofed) はspoofingしたフレームのうち検知した数
+    """
+    import defense
+    import file_io
+    import generate_rosbag
+
+    with open(config_path, 'r') as f:
+        base_config = json.load(f)
+    speed, lidar_freq = 1.0, 10.0
+    # ロボット (x軸上) がspoofer_x ± distance_thresholdにいるフレームだけspoofingする
+    spoofer_x, distance_threshold = speed * n_frames / lidar_freq * 0.6, speed * n_frames / lidar_freq * 0.2
+
+    results = {}
+    print(f"{'rings':>6}{'case':>10}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'frame/s':>10}{'fired':>7}" + ''.join(f"{f'{rate:g}Hz':>7}" for rate in frame_rates))
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for n_rings in rings:
+            bag, csv = tmp / f"defense_{n_rings}.bag", tmp / f"defense_{n_rings}.csv"
+            synthetic_bag(bag, csv, n_rings, columns, n_frames, speed=speed, lidar_freq=lidar_freq)
+            config = json.loads(json.dumps(base_config))
+            config['rosbag'].update(input_bag=str(bag), output_bag=str(tmp / "spoofed.bag"), lidar_topic='/points',
+                                    imu_topic='/imu', spoofing_mode='removal', distance_threshold=distance_threshold)
+            with open(tmp / "config_temp.json", 'w') as f:
+                json.dump(config, f)
+            with working_directory(tmp):
+                generate_rosbag.generate_main(spoofer_x, 0.0, file_io.load_reference_index(csv), output_bag_path=tmp / "spoofed.bag", seed=0)
+
+            for case, path in (('benign', bag), ('spoofed', tmp / "spoofed.bag")):
+                stage = defense.run_bag(path, '/points', defense.DefenseStage.from_config(config))
+                report = stage.report()
+                budgets = ''.join(f"{'ok' if report['p99_ms'] <= 1e3 / rate else 'over':>7}" for rate in frame_rates)
+                print(f"{n_rings:>6}{case:>10}" + ''.join(f"{report[key]:>9.2f}" for key in ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms'))
+                      + f"{report['throughput']:>10.1f}{report['fired']:>7}" + budgets)
+                for key in ('p50_ms', 'p99_ms'):
+                    results[f"defense/{n_rings}/{case}/{key[:-3]}"] = report[key]
+    return results
+
+def bench_slam_runner(n_runs=6, max_parallel=3, timeout=1.0, stall_timeout=1.0):
+    """
+    slam.SlamRunnerの動作確認 (ROSは使わない)
+      fake : fake_slam_commandでmax_parallel個を同時に実行し、全て成功してポートが重ならないこと
+      timeout : 終わらないコマンドをtimeout秒で止めること
+      stall : 姿勢を1つ書いて止まったコマンドを監視 (stall_timeout) で止めること
+    """
+    import slam
+    import trajectory_monitor
+
+    benign, _ = synthetic_trajectories(200)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        source = tmp / "source.txt"
+        np.savetxt(source, benign)
+
+        # fake : 各実行が (port, 開始, 終了) を書き、同じポートを同時に使った組が無いか調べる
+        fake = slam.fake_slam_command(source)
+        script = ("import shutil, sys, time; start = time.time(); time.sleep(0.2); shutil.copy(sys.argv[1], sys.argv[2]); "
+                  "open(sys.argv[2] + '.port', 'w').write(f'{sys.argv[3]} {start} {time.time()}')")
+
+        def builder(algorithm, bag_path, topic, save_dir, rosbag_rate, visualize, imu_topic=None, port=None):
+            return [sys.executable, "-c", script, *fake(algorithm, bag_path, topic, save_dir, rosbag_rate, visualize, imu_topic, port)[-2:],
+                    str(port)]
+
+        start = time.perf_counter()
+        with slam.SlamRunner(max_parallel=max_parallel, command_builder=builder) as runner:
+            futures = [runner.submit('kiss_icp', tmp / "in.bag", '/points', tmp / f"run_{i}") for i in range(n_runs)]
+            runs = [future.result() for future in futures]
+        elapsed = (time.perf_counter() - start) * 1e3
+        ok = all(run.ok and run.stopped is None and np.allclose(np.loadtxt(run.trajectory), benign) for run in runs)
+        spans = [tuple(float(v) for v in Path(f"{run.trajectory}.port").read_text().split()) for run in runs]
+        overlaps = sum(1 for i, a in enumerate(spans) for b in spans[i + 1:] if a[0] == b[0] and a[1] < b[2] and b[1] < a[2])
+        print(f"fake: {n_runs} runs, max_parallel {max_parallel}: {elapsed:.0f} ms, all ok {ok}, "
+              f"ports {len(set(span[0] for span in spans))}, port overlaps {overlaps}")
+        if not ok or overlaps:
+            raise AssertionError("SlamRunner fake runs failed or shared a ROS master port")
+        results['slam_runner/fake'] = elapsed / n_runs
+
+        # timeout : SIGINTで止まらなければSIGKILL
+        hang = lambda *args: [sys.executable, "-c", "import time; time.sleep(60)"]
+        with slam.SlamRunner(max_parallel=1, timeout=timeout, command_builder=hang) as runner:
+            run = runner.submit('kiss_icp', tmp / "in.bag", '/points', tmp / "run_timeout").result()
+        print(f"timeout: timed out {run.timed_out}, exit code {run.returncode}, {run.elapsed:.2f} sec")
+        if not run.timed_out or run.ok or run.elapsed > timeout + 5.0:
+            raise AssertionError("SlamRunner did not stop a run at its timeout")
+
+        # stall : 最初の姿勢を書いた後に止まる
+        first_pose = ' '.join(map(str, benign[0]))
+        stall = lambda algorithm, bag_path, topic, save_dir, *args: [
+            sys.executable, "-c", "import sys, time; open(sys.argv[1], 'w').write(sys.argv[2] + '\\n'); time.sleep(60)",
+            str(Path(save_dir) / slam.TRAJECTORY_FILE), first_pose]
+        with slam.SlamRunner(max_parallel=1, command_builder=stall, stall_timeout=stall_timeout, poll_interval=0.2) as runner:
+            run = runner.submit('kiss_icp', tmp / "in.bag", '/points', tmp / "run_stall").result()
+        print(f"stall: stopped {run.stopped}, ok {run.ok}, {run.elapsed:.2f} sec")
+        if run.stopped != trajectory_monitor.STALLED or run.ok:
+            raise AssertionError("SlamRunner did not stop a stalled run")
+    return results
+
+# worker processのentry point (scheduler) と、spawnのworkerが読み直す00_mainが使うモジュール
+STARTUP_MODULES = ('scheduler', 'generate_rosbag', 'inprocess_slam', 'error_estimate', 'results_store', '00_main')
+
+def import_time(module, top=5):
+    """
+    python -X importtime で1つのモジュールをimportし、(全体 [ms], 時間のかかったトップレベルのパッケージ [(name, ms)]) を返す
+    別プロセスで実行するので、既にimport済みのモジュールに影響されない
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"__import__({module!r})"],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, value, name = line.split('|')
+        cumulative[name.strip()] = int(value) / 1e3
+    packages = sorted(((name, ms) for name, ms in cumulative.items() if '.' not in name and name != module),
+                      key=lambda item: item[1], reverse=True)
+    return cumulative[module], packages[:top]
+
+def bench_startup(modules=STARTUP_MODULES, n_repeat=5):
+    """
+    モジュール毎のimport時間 [ms] (-X importtime) と、インタプリタの起動込みの時間 (python -c "import ..." の最小値)
+    typestoreは最初の1回 (作成 + PointCloud2のserialize/deserializeのコード生成) と2回目以降 (file_io.ros1_typestore) を比べる
+    """
+    import file_io
+    from rosbags.typesys import Stores, get_typestore
+
+    results = {}
+    print(f"{'module':<18}{'import':>9}{'process':>9}  heaviest packages")
+    for module in modules:
+        try:
+            import_ms, packages = import_time(module)
+        except ImportError as e:
+            print(f"{module:<18}  skipped ({e})")
+            continue
+        process_ms = min(time_per_frame(lambda i: subprocess.run([sys.executable, '-c', f"__import__({module!r})"],
+                                                                 check=True), 1) for _ in range(n_repeat))
+        print(f"{module:<18}{import_ms:>9.1f}{process_ms:>9.1f}  " + ', '.join(f"{name} {ms:.0f}" for name, ms in packages))
+        results[f"startup/{module}/import"] = import_ms
+        results[f"startup/{module}/process"] = process_ms
+
+    def first_use(typestore):
+        types = typestore.types
+        header = types['std_msgs/msg/Header'](seq=0, stamp=types['builtin_interfaces/msg/Time'](sec=0, nanosec=0), frame_id='lidar')
+        msg = types['sensor_msgs/msg/PointCloud2'](header=header, height=1, width=0, fields=[], is_bigendian=False, point_step=0,
+                                                   row_step=0, data=np.zeros(0, dtype=np.uint8), is_dense=True)
+        typestore.deserialize_ros1(typestore.serialize_ros1(msg, 'sensor_msgs/msg/PointCloud2'), 'sensor_msgs/msg/PointCloud2')
+
+    results['startup/typestore/new'] = time_per_frame(lambda i: first_use(get_typestore(Stores.ROS1_NOETIC)), n_repeat)
+    first_use(file_io.ros1_typestore())
+    results['startup/typestore/cached'] = time_per_frame(lambda i: first_use(file_io.ros1_typestore()), n_repeat)
+    print(f"typestore : new {results['startup/typestore/new']:.2f} ms, cached {results['startup/typestore/cached']:.2f} ms")
+    return results
+
+BENCHMARKS = {
+    'config_loading': bench_config_loading,
+    'sector_mask': bench_sector_mask,
+    'evaluation': bench_evaluation,
+    'stages': bench_stages,
+    'defense': bench_defense,
+    'slam_runner': bench_slam_runner,
+    'startup': bench_startup,
+}
+
+def compare_baseline(results, baseline, tolerance):
+    # baselineよりtolerance倍以上遅くなった項目
+    regressions = []
+    for name, value in sorted(results.items()):
+        reference = baseline.get(name)
+        if reference is not None and reference > 0 and value > reference * tolerance:
+            regressions.append((name, reference, value))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', default=list(BENCHMARKS))
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help="比較に使う前回の結果 (ms)")
+    parser.add_argument('--save-baseline', action='store_true', help="今回の結果をbaselineとして保存する")
+    parser.add_argument('--tolerance', type=float, default=1.3, help="baselineの何倍を超えたら遅くなったとみなすか")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.names:
+        print(f"\n--- {name} ---")
+        results.update(BENCHMARKS[name]() or {})
+
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+        baseline.update(results)
+        baseline_path.write_text(json.dumps(baseline, indent=2, sort_keys=True))
+        print(f"\nsaved {len(results)} results to {baseline_path}")
+    elif baseline_path.exists():
+        regressions = compare_baseline(results, json.loads(baseline_path.read_text()), args.tolerance)
+        print(f"\n--- regressions (> {args.tolerance:.2f}x {baseline_path}) ---")
+        for name, reference, value in regressions:
+            print(f"{name}: {reference:.3f} -> {value:.3f} ms ({value / reference:.2f}x)")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,144 @@
+# default modules
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+CHUNK_SIZE = 1 << 20 # 1 MiB
+
+def _atomic_write_bytes(path, data):
+    # 同じディレクトリに一時ファイルを書いてからos.replace (途中で落ちても壊れない)
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+def file_stamp(path):
+    # 高速判定用 : (絶対パス, サイズ, mtime)
+    stat = Path(path).stat()
+    return f"{Path(path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def content_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class BenignCache:
+    """
+    benign SLAM軌跡のキャッシュ
+    key = hash(入力bag, algorithm, launchファイル, rosbag_rate, launchファイルと参照するパラメータファイルの中身)
+    cache_dir/manifest.json に各エントリの情報を持ち、容量/件数を超えたら最後に使ったのが古い順に消す
+    verify_content=True ならbagの中身のsha256で判定する (サイズ/mtimeが同じなら前回のhashを使う)
+    sweep.ArtifactCacheも同じ仕組みでspoofed bag/推定軌跡を置く (put(suffix=..., move=...))
+    """
+    MANIFEST = "manifest.json"
+
+    def __init__(self, cache_dir, max_bytes=None, max_entries=None, verify_content=False):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.verify_content = verify_content
+
+    @contextmanager
+    def _locked_manifest(self):
+        # 複数プロセスから同時に使っても壊れないようにflockで排他する
+        with open(self.cache_dir / ".lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest_path = self.cache_dir / self.MANIFEST
+            if manifest_path.exists():
+                with open(manifest_path, 'r') as f:
+                    manifest = json.load(f)
+            else:
+                manifest = {'entries': {}, 'fingerprints': {}}
+            yield manifest
+            _atomic_write_bytes(manifest_path, json.dumps(manifest, indent=2).encode())
+
+    def bag_fingerprint(self, bag_path):
+        stamp = file_stamp(bag_path)
+        if not self.verify_content:
+            return hashlib.sha256(stamp.encode()).hexdigest()
+
+        with self._locked_manifest() as manifest:
+            fingerprint = manifest['fingerprints'].get(stamp)
+        if fingerprint is None:
+            fingerprint = content_hash(bag_path)
+            with self._locked_manifest() as manifest:
+                manifest['fingerprints'][stamp] = fingerprint
+        return fingerprint
+
+    def key(self, bag_path, algorithm, launch_file, rosbag_rate, launch_dependencies=()):
+        # launch_dependencies : slam.launch_dependencies (パラメータを書き換えたら別のkeyになる)
+        dependencies = [[Path(path).name, content_hash(path)] for path in sorted(launch_dependencies)]
+        source = json.dumps([self.bag_fingerprint(bag_path), algorithm, launch_file, float(rosbag_rate), dependencies])
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    def get(self, key):
+        # hitならキャッシュ内の軌跡ファイルのPath, missならNone
+        with self._locked_manifest() as manifest:
+            entry = manifest['entries'].get(key)
+            if entry is None:
+                return None
+            path = self.cache_dir / entry['file']
+            if not path.exists():
+                del manifest['entries'][key]
+                return None
+            entry['last_used'] = time.time()
+        return path
+
+    def put(self, key, trajectory_path, suffix='.txt', move=False, keep=(), **meta):
+        # move=True ならコピーせずにrenameする (同じファイルシステム上の大きなbag用)
+        # keep : 使用中で消してはいけないkey (今回のkeyも消さない)
+        file_name = f"{key}{suffix}"
+        path = self.cache_dir / file_name
+        if move:
+            os.replace(trajectory_path, path)
+        else:
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=f".{file_name}.")
+            os.close(fd)
+            try:
+                shutil.copyfile(trajectory_path, tmp)
+                os.replace(tmp, path)
+            except BaseException:
+                Path(tmp).unlink(missing_ok=True)
+                raise
+
+        with self._locked_manifest() as manifest:
+            now = time.time()
+            manifest['entries'][key] = dict(meta, file=file_name, size=path.stat().st_size,
+                                            created=now, last_used=now)
+            self._evict(manifest, set(keep) | {key})
+        return path
+
+    def fetch(self, key, destination):
+        # hitならdestinationへコピーしてTrue
+        path = self.get(key)
+        if path is None:
+            return False
+        shutil.copyfile(path, destination)
+        return True
+
+    def _evict(self, manifest, keep=()):
+        entries = manifest['entries']
+        by_age = sorted((k for k in entries if k not in keep), key=lambda k: entries[k]['last_used'])
+        total = sum(entry['size'] for entry in entries.values())
+
+        while by_age and ((self.max_bytes is not None and total > self.max_bytes)
+                          or (self.max_entries is not None and len(entries) > self.max_entries)):
+            key = by_age.pop(0)
+            total -= entries[key]['size']
+            (self.cache_dir / entries.pop(key)['file']).unlink(missing_ok=True)
@@ -0,0 +1,260 @@
+"""
+spoofingの検知と除去 (spoofing_sim.defencedと同じ扇形の除去) をフレーム毎に逐次行う
+
+SectorDetector : 方位角ヒストグラム (bins分割) の点数の割合と平均距離を、ビン毎のrolling baseline (EMAの平均/分散) と比べる
+                 1フレームの処理は点数に比例するヒストグラム作成 + O(bins) の比較/更新だけ
+DefenseStage   : 検知した扇形の点を除去し、フレーム毎の処理時間 (deserializeから出力まで) を記録する
+                 generate_rosbag.generate_many(lidar_filters=...) で生成中のbagに、run_bag() で既存のbagに使う
+
+  python defense.py spoofed.bag [--output defended.bag]
+"""
+import numpy as np
+
+# rosbags libraries
+from rosbags.highlevel import AnyReader
+from rosbags.rosbag1 import Writer
+
+# default modules
+import argparse
+import json
+import time
+from pathlib import Path
+
+# load external files
+import file_io
+import generate_rosbag
+import spoofing_sim
+
+class SectorDetector:
+    """
+    bins : 方位角の分割数
+    alpha : baselineのEMA係数 (最初のwarmupフレームは単純平均で立ち上げる)
+    threshold : z-scoreがこれを超えたビンを異常とする
+    min_share_std / min_range_std : 分散が小さすぎるビンで誤検知しないための標準偏差の下限
+    margin_bins : 除去する扇形を異常なビンの両側に広げる数
+    flagged_alpha : 異常なビンの平均のEMA係数 (攻撃で基準を汚さないよう、攻撃が終わった後に誤検知しない程度に小さくする)
+    readmit_frames : これだけ連続して異常なビンは景色が変わったとみなし、今の値でbaselineを作り直す
+                     (これより長く続く攻撃はそれ以降検知しない)
+    """
+    def __init__(self, bins=72, alpha=0.05, threshold=6.0, warmup=10, min_share_std=0.002, min_range_std=0.5, margin_bins=1,
+                 flagged_alpha=0.001, readmit_frames=100):
+        self.bins = bins
+        self.alpha = alpha
+        self.flagged_alpha = flagged_alpha
+        self.readmit_frames = readmit_frames
+        self.threshold = threshold
+        self.warmup = warmup
+        self.min_share_std = min_share_std
+        self.min_range_std = min_range_std
+        self.margin_bins = margin_bins
+        self.share_mean = np.zeros(bins)
+        self.share_var = np.zeros(bins)
+        self.range_mean = np.zeros(bins)
+        self.range_var = np.zeros(bins)
+        self.flagged_run = np.zeros(bins, dtype=np.int64)
+        self.n_frames = 0
+
+    def statistics(self, xyz):
+        # ビン毎の (点数の割合, 平均水平距離)。無効点 (0, 0, 0) / NaNは数えない
+        # 点が無いビンの平均距離はNaN (距離のbaselineと比べず、更新もしない)
+        x, y = xyz[:, 0], xyz[:, 1]
+        valid = np.isfinite(x) & np.isfinite(y) & ((x != 0) | (y != 0))
+        x, y = x[valid], y[valid]
+        index = ((np.arctan2(y, x) + np.pi) * (self.bins / (2 * np.pi))).astype(np.int64) % self.bins
+        count = np.bincount(index, minlength=self.bins)
+        range_sum = np.bincount(index, weights=np.hypot(x, y), minlength=self.bins)
+        share = count / max(x.shape[0], 1)
+        mean_range = np.where(count > 0, range_sum / np.maximum(count, 1), np.nan)
+        return share, mean_range
+
+    def scores(self, share, mean_range):
+        z_share = (share - self.share_mean) / np.sqrt(self.share_var + self.min_share_std ** 2)
+        z_range = (mean_range - self.range_mean) / np.sqrt(self.range_var + self.min_range_std ** 2)
+        return np.maximum(np.abs(z_share), np.nan_to_num(np.abs(z_range), nan=0.0))
+
+    def sector(self, anomalous, score):
+        # 異常なビンの連続区間 (360度で一周) のうちscoreの合計が最大のもの -> (中心角, 幅) [degree]
+        # 全てのビンが異常ならspoofing (扇形) ではなく景色全体の変化なのでNone
+        if anomalous.all():
+            return None
+        start = int(np.argmin(anomalous)) # 正常なビンから数え始めれば区間が端で切れない
+        order = np.roll(np.arange(self.bins), -start)
+        best, best_score, run, run_score = None, 0.0, [], 0.0
+        for i in np.append(order, order[0]):
+            if anomalous[i]:
+                run.append(i)
+                run_score += score[i]
+            elif run:
+                if run_score > best_score:
+                    best, best_score = run, run_score
+                run, run_score = [], 0.0
+        bin_width = 360.0 / self.bins
+        # 除去する扇形は一周より狭くする (スキャン全体は消さない)
+        width = min((len(best) + 2 * self.margin_bins) * bin_width, 360.0 - bin_width)
+        # run[0]からlen(best)ビン分の中心 (ビンiは -180 + i * bin_width から始まる)
+        center = -180.0 + (best[0] + len(best) / 2) * bin_width
+        return (center + 180.0) % 360.0 - 180.0, width
+
+    def update(self, xyz):
+        # 1フレーム分 : 異常なら (中心角, 幅) [degree]、それ以外はNone
+        share, mean_range = self.statistics(xyz)
+        result = None
+        anomalous = np.zeros(self.bins, dtype=bool)
+        if self.n_frames >= self.warmup:
+            score = self.scores(share, mean_range)
+            anomalous = score > self.threshold
+            if anomalous.any():
+                result = self.sector(anomalous, score)
+            if result is None:
+                # 扇形にならない (全てのビンが異常) 変化は景色の変化として通常の速さで取り込む
+                anomalous[:] = False
+        self.flagged_run = np.where(anomalous, self.flagged_run + 1, 0)
+
+        # 異常なビンは平均だけをゆっくり更新する (攻撃中の扇形で基準を汚さないが、景色の変化にはいずれ追従する)
+        # 分散まで更新すると大きな差で分散が膨らみ、数フレームで検知できなくなる
+        normal = ~anomalous
+        alpha = max(self.alpha, 1.0 / (self.n_frames + 1))
+        for mean, var, value in ((self.share_mean, self.share_var, share), (self.range_mean, self.range_var, mean_range)):
+            diff = np.nan_to_num(value - mean, nan=0.0)
+            var[normal] = (1.0 - alpha) * (var[normal] + alpha * diff[normal] ** 2)
+            mean += np.where(normal, alpha, self.flagged_alpha) * diff
+
+        # 長く異常が続いたビンは今の値を新しいbaselineにする
+        readmit = self.flagged_run >= self.readmit_frames
+        if readmit.any():
+            self.share_mean[readmit] = share[readmit]
+            self.range_mean[readmit] = np.where(np.isnan(mean_range), self.range_mean, mean_range)[readmit]
+            self.share_var[readmit] = self.range_var[readmit] = 0.0
+            self.flagged_run[readmit] = 0
+        self.n_frames += 1
+        return result
+
+class DefenseStage:
+    """
+    1つのLiDARストリーム (1試行) 分の検知と除去
+    process_raw(rawdata, msgtype) : PointCloud2の生バイト -> 生バイト (検知しなければ入力をそのまま返す)
+    wrap(consumer) : replay_many用のconsumer(msg_ns, points) の前に挟む
+    report() : 検知したフレーム数と処理時間の統計
+    frame_rate : センサのフレームレート [Hz] (処理時間がフレーム周期に収まるかの判定用)
+    """
+    def __init__(self, detector=None, typestore=None, frame_rate=None):
+        self.detector = SectorDetector() if detector is None else detector
+        self.typestore = file_io.ros1_typestore() if typestore is None else typestore
+        self.frame_rate = frame_rate
+        self.latencies = []
+        self.fired = 0
+        self.points_removed = 0
+
+    @classmethod
+    def from_config(cls, config):
+        # config['defense'] (enabled以外はSectorDetectorの引数)
+        options = {key: value for key, value in config.get('defense', {}).items() if key != 'enabled'}
+        return cls(SectorDetector(**options), frame_rate=float(config['rosbag']['topic_freq']))
+
+    def defend(self, points):
+        # points : decode_pointsの出力 (organizedなら (H, W)) -> 除去後の点群 (除去しなければNone)
+        flat = points.reshape(-1)
+        xyz = generate_rosbag.xyz_view(flat)
+        sector = self.detector.update(xyz)
+        if sector is None:
+            return None
+        self.fired += 1
+        center, width = sector
+        mask = spoofing_sim.sector_mask(xyz, center, width)
+        self.points_removed += int(np.count_nonzero(mask))
+        if points.ndim == 2:
+            # organizedの形は保ち、除去した点を0にする
+            out = points.view((np.void, points.dtype.itemsize)).copy().view(points.dtype)
+            for name in ('x', 'y', 'z'):
+                out[name].reshape(-1)[mask] = 0
+            return out
+        return generate_rosbag.encode_points(flat, ~mask, np.empty((0, 3), dtype=np.float32))
+
+    def process_raw(self, rawdata, msgtype):
+        start = time.perf_counter()
+        msg = self.typestore.deserialize_ros1(rawdata, msgtype)
+        points = generate_rosbag.decode_points(msg)
+        if msg.height > 1:
+            points = points.reshape(msg.height, msg.width)
+        defended = self.defend(points)
+        if defended is not None:
+            out_msg = generate_rosbag.create_pointcloud2(defended, msg.header.seq, generate_rosbag.header_stamp_ns(rawdata),
+                                                         msg.header.frame_id, msg.fields, self.typestore)
+            rawdata = self.typestore.serialize_ros1(out_msg, msgtype)
+        self.latencies.append(time.perf_counter() - start)
+        return rawdata
+
+    def wrap(self, consumer):
+        def defended(msg_ns, points):
+            start = time.perf_counter()
+            out = self.defend(points)
+            self.latencies.append(time.perf_counter() - start)
+            consumer(msg_ns, points if out is None else out)
+        return defended
+
+    def report(self, frame_rate=None):
+        # 処理時間 [ms] の分位点とthroughput [frame/s]。frame_rateがあればp99がフレーム周期に収まるかも返す
+        frame_rate = self.frame_rate if frame_rate is None else frame_rate
+        latencies = np.asarray(self.latencies) * 1e3
+        report = {'frames': int(latencies.shape[0]), 'fired': self.fired, 'points_removed': self.points_removed}
+        if latencies.shape[0] == 0:
+            return report
+        for q in (50, 90, 99):
+            report[f'p{q}_ms'] = float(np.percentile(latencies, q))
+        report['max_ms'] = float(latencies.max())
+        report['throughput'] = float(latencies.shape[0] / (latencies.sum() / 1e3))
+        if frame_rate is not None:
+            report['frame_period_ms'] = 1e3 / frame_rate
+            report['within_budget'] = report['p99_ms'] <= report['frame_period_ms']
+        return report
+
+def stages_from_config(config, n_trials):
+    # defense.enabledなら試行毎のDefenseStage (無効ならNone)。configがNoneならconfig_temp.jsonを読む
+    if config is None:
+        with open('config_temp.json', 'r') as f:
+            config = json.load(f)
+    if not config.get('defense', {}).get('enabled', False):
+        return None
+    return [DefenseStage.from_config(config) for _ in range(n_trials)]
+
+def run_bag(bag_path, lidar_topic, stage=None, output_bag=None, imu_topic=None):
+    """
+    既存のbag (生成したspoofed bagなど) をフレーム順に処理する (1スレッド)
+    output_bagを渡すと除去後のLiDARとIMUを書き出す (SLAMでdefenseの効果を見る用)
+    """
+    stage = DefenseStage() if stage is None else stage
+    typestore = stage.typestore
+    with AnyReader([Path(bag_path)], default_typestore=typestore) as reader:
+        connections = [x for x in reader.connections if x.topic == lidar_topic or (imu_topic is not None and x.topic == imu_topic)]
+        writer = None
+        if output_bag is not None:
+            Path(output_bag).unlink(missing_ok=True)
+            writer = Writer(Path(output_bag))
+            writer.open()
+            conns_out = {x.topic: writer.add_connection(x.topic, x.msgtype, typestore=typestore) for x in connections}
+        try:
+            for connection, timestamp, rawdata in reader.messages(connections=connections):
+                if connection.topic == lidar_topic:
+                    rawdata = stage.process_raw(rawdata, connection.msgtype)
+                if writer is not None:
+                    writer.write(conns_out[connection.topic], timestamp, rawdata)
+        finally:
+            if writer is not None:
+                writer.close()
+    return stage
+
+def main():
+    with open('config_temp.json', 'r') as f:
+        config = json.load(f)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bag')
+    parser.add_argument('--output', default=None, help="除去後のbagの出力先")
+    parser.add_argument('--topic', default=config['rosbag']['lidar_topic'])
+    args = parser.parse_args()
+
+    stage = run_bag(args.bag, args.topic, DefenseStage.from_config(config), args.output, config['rosbag']['imu_topic'])
+    for name, value in stage.report().items():
+        print(f"{name}: {value}")
+
+if __name__ == "__main__":
+    main()
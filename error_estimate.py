@@ -1,43 +1,170 @@
-
 import numpy as np
-from scipy.spatial import cKDTree
-
-from evo.core import metrics
-from evo.core.units import Unit
-from evo.tools import log
-log.configure_logging(verbose=False, debug=False, silent=False)
-
-import pprint
-from evo.tools import plot
-from evo.tools.settings import SETTINGS
-SETTINGS.plot_usetex = False
 
-plot.apply_settings(SETTINGS)
-
-from evo.tools import file_interface
-from evo.core import sync
+# default modules
+import copy
+import functools
+import types
+from dataclasses import dataclass, field
+from pathlib import Path
+
+# load external files
+import traj_metrics
+
+@functools.lru_cache(maxsize=None)
+def load_evo():
+    # evoは評価を実行する時に初めてimportする (metrics/sync/file_interfaceだけで約0.4秒)
+    # bag生成/SLAMのworker processはerror_estimateをimportしても待たされない
+    from evo.core import metrics, sync
+    from evo.core.trajectory import PoseTrajectory3D
+    from evo.core.units import Unit
+    from evo.tools import file_interface, log
+    log.configure_logging(verbose=False, debug=False, silent=False)
+    return types.SimpleNamespace(metrics=metrics, sync=sync, PoseTrajectory3D=PoseTrajectory3D, Unit=Unit,
+                                 file_interface=file_interface)
+
+@functools.lru_cache(maxsize=None)
+def load_plot():
+    # 軌跡を描画する場合だけ (evo.tools.plotはmatplotlibを含めて約1.6秒)
+    load_evo()
+    from evo.tools import plot
+    from evo.tools.settings import SETTINGS
+    SETTINGS.plot_usetex = False
+    plot.apply_settings(SETTINGS)
+    return plot
 
 def calc_trans_error(ground_truth, estimated_traj):
-    tree = cKDTree(estimated_traj)
-    distance, index = tree.query(ground_truth)
-
-    return distance
+    return traj_metrics.nearest_distances(ground_truth, estimated_traj)
+
+@functools.lru_cache(maxsize=16)
+def _read_tum_cached(path, size, mtime_ns):
+    return load_evo().file_interface.read_tum_trajectory_file(path)
+
+@functools.lru_cache(maxsize=16)
+def _load_tum_array_cached(path, size, mtime_ns):
+    array = traj_metrics.load_tum(path)
+    array.flags.writeable = False
+    return array
+
+def read_tum_array(path):
+    # read_tumのnumpy版 (N, 8)、キャッシュは読み取り専用
+    # (N, 8) の配列 (in-processのオドメトリの出力) はそのまま返す
+    if isinstance(path, np.ndarray):
+        return np.atleast_2d(path)
+    stat = Path(path).stat()
+    return _load_tum_array_cached(str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns)
+
+def read_tum(path):
+    # 同じファイル (パス, サイズ, mtimeが同じ) は1回だけ読む (benign軌跡は全試行で共通)
+    # 呼び出し側で変更しても良いようにコピーを返す
+    # (N, 8) のTUM配列 [timestamp, x, y, z, qx, qy, qz, qw] も受け付ける (ファイルを介さない)
+    if isinstance(path, np.ndarray):
+        array = np.atleast_2d(path)
+        return load_evo().PoseTrajectory3D(positions_xyz=array[:, 1:4], orientations_quat_wxyz=array[:, [7, 4, 5, 6]],
+                                           timestamps=array[:, 0])
+    stat = Path(path).stat()
+    return copy.deepcopy(_read_tum_cached(str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns))
 
 def load_traj(est_file, ref_file, convert_timestamp_to_relative=False):
     max_diff = 0.01
-    traj_ref = file_interface.read_tum_trajectory_file(ref_file)
-    traj_est = file_interface.read_tum_trajectory_file(est_file)
+    traj_ref = read_tum(ref_file)
+    traj_est = read_tum(est_file)
 
     # Convert absolute timestamps to relative time (from first timestamp)
     if convert_timestamp_to_relative:
         traj_ref.timestamps = traj_ref.timestamps - traj_ref.timestamps[0]
         traj_est.timestamps = traj_est.timestamps - traj_est.timestamps[0]
 
-    traj_ref, traj_est = sync.associate_trajectories(traj_ref, traj_est, max_diff)
+    traj_ref, traj_est = load_evo().sync.associate_trajectories(traj_ref, traj_est, max_diff=max_diff)
     traj_est.align(traj_ref, correct_scale=False, correct_only_scale=False)
     return traj_est, traj_ref
 
+# RPEは5mごとの相対誤差
+RPE_DELTA = 5
+
+# 評価指標の指定 : (pose_relation, statistics_type) (evoのenumを使うのでimportを遅らせるため関数にする)
+def default_ape():
+    metrics = load_evo().metrics
+    return ((metrics.PoseRelation.translation_part, metrics.StatisticsType.rmse),)
+
+def default_rpe():
+    metrics = load_evo().metrics
+    return ((metrics.PoseRelation.translation_part, metrics.StatisticsType.max),)
+
+@dataclass
+class EvaluationResult:
+    # stats[('ape' or 'rpe', PoseRelation, StatisticsType)] = value
+    stats: dict = field(default_factory=dict)
+    n_matched: int = 0
+
+    def get(self, kind, pose_relation, statistics_type):
+        return self.stats[(kind, pose_relation, statistics_type)]
+
+    @property
+    def ape_rmse(self):
+        return self.get('ape', *default_ape()[0])
+
+    @property
+    def rpe_max(self):
+        return self.get('rpe', *default_rpe()[0])
+
+def evaluate(estimated_traj, ground_truth, ape=None, rpe=None, convert_timestamp_to_relative=False, backend='evo'):
+    """
+    軌跡の読み込み・対応付け・位置合わせを1回だけ行い、指定された全てのAPE/RPE統計量を計算する
+    軌跡はTUMファイルのパスか (N, 8) のTUM配列
+    ape/rpe : ((pose_relation, statistics_type), ...)、Noneならdefault_ape()/default_rpe()
+    backend='numpy' はtraj_metricsで計算する (translation_partのみ、evoと同じ結果)
+    """
+    ape = default_ape() if ape is None else ape
+    rpe = default_rpe() if rpe is None else rpe
+    if backend == 'numpy':
+        return _evaluate_numpy(estimated_traj, ground_truth, ape, rpe, convert_timestamp_to_relative)
+    elif backend != 'evo':
+        raise ValueError(f"unknown backend: {backend}")
+
+    metrics = load_evo().metrics
+    traj_est, traj_ref = load_traj(estimated_traj, ground_truth, convert_timestamp_to_relative)
+    data = (traj_est, traj_ref)
+    result = EvaluationResult(n_matched=traj_est.num_poses)
+
+    for pose_relation in dict.fromkeys(relation for relation, _ in ape):
+        ape_metric = metrics.APE(pose_relation)
+        ape_metric.process_data(data)
+        for relation, statistics_type in ape:
+            if relation == pose_relation:
+                result.stats[('ape', relation, statistics_type)] = ape_metric.get_statistic(statistics_type)
+
+    for pose_relation in dict.fromkeys(relation for relation, _ in rpe):
+        rpe_metric = metrics.RPE(pose_relation=pose_relation, delta=RPE_DELTA, delta_unit=load_evo().Unit.meters, all_pairs=False)
+        rpe_metric.process_data(data)
+        for relation, statistics_type in rpe:
+            if relation == pose_relation:
+                result.stats[('rpe', relation, statistics_type)] = rpe_metric.get_statistic(statistics_type)
+
+    return result
+
+def _evaluate_numpy(estimated_traj, ground_truth, ape, rpe, convert_timestamp_to_relative):
+    metrics = load_evo().metrics
+    for _, pose_relation, _ in [('ape',) + spec for spec in ape] + [('rpe',) + spec for spec in rpe]:
+        if pose_relation != metrics.PoseRelation.translation_part:
+            raise ValueError(f"numpy backend supports only translation_part, not {pose_relation}")
+
+    traj_est, traj_ref = read_tum_array(estimated_traj), read_tum_array(ground_truth)
+    if convert_timestamp_to_relative:
+        traj_est = np.column_stack((traj_est[:, 0] - traj_est[0, 0], traj_est[:, 1:]))
+        traj_ref = np.column_stack((traj_ref[:, 0] - traj_ref[0, 0], traj_ref[:, 1:]))
+
+    stats, n_matched = traj_metrics.evaluate_arrays(traj_est, traj_ref,
+                                                    ape=[statistics_type.value for _, statistics_type in ape],
+                                                    rpe=[statistics_type.value for _, statistics_type in rpe],
+                                                    rpe_delta=RPE_DELTA)
+    result = EvaluationResult(n_matched=n_matched)
+    for kind, specs in (('ape', ape), ('rpe', rpe)):
+        for pose_relation, statistics_type in specs:
+            result.stats[(kind, pose_relation, statistics_type)] = stats[kind][statistics_type.value]
+    return result
+
 def get_ape(traj_est, traj_ref):
+    metrics = load_evo().metrics
     pose_relation = metrics.PoseRelation.translation_part
     #pose_relation = metrics.PoseRelation.rotation_part
     #pose_relation = metrics.PoseRelation.full_transformation
@@ -50,12 +177,13 @@ def get_ape(traj_est, traj_ref):
     return ape_stat
 
 def get_rpe(traj_est, traj_ref):
+    metrics = load_evo().metrics
     pose_relation = metrics.PoseRelation.translation_part
     data = (traj_est, traj_ref)
 
     # normal mode
-    delta = 5
-    delta_unit = Unit.meters
+    delta = RPE_DELTA
+    delta_unit = load_evo().Unit.meters
     all_pairs = False
 
     rpe_metric = metrics.RPE(pose_relation=pose_relation, delta=delta, delta_unit=delta_unit, all_pairs=all_pairs)
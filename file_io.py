@@ -1,10 +1,116 @@
-import pandas as pd
+import numpy as np
+
+# rosbags libraries
+from rosbags.typesys import Stores, get_typestore
+
+# default modules
+import functools
+
+@functools.lru_cache(maxsize=None)
+def ros1_typestore():
+    # ROS1 (noetic) のtypestoreはプロセス毎に1回だけ作り、使い回す
+    # (メッセージ型毎のserialize/deserializeのコード生成もtypestore毎にキャッシュされる)
+    return get_typestore(Stores.ROS1_NOETIC)
 
 def load_reference(csv_file_name):
+    # pandasはCSVを読む時だけimportする (ReferenceIndexはnumpyだけなのでworker processでは不要)
+    import pandas as pd
     df = pd.read_csv(csv_file_name)
     x, y, z = df['x'].to_numpy(), df['y'].to_numpy(), df['z'].to_numpy()
     return x, y, z
 
 def load_reference_df(csv_file_name):
+    import pandas as pd
     df = pd.read_csv(csv_file_name)
-    return df
\ No newline at end of file
+    return df
+
+def load_reference_index(csv_file_name, interpolation='nearest'):
+    return ReferenceIndex(load_reference_df(csv_file_name), interpolation)
+
+def slerp(q0, q1, u):
+    # q0, q1 : (N, 4) quaternion (qx, qy, qz, qw), u : (N,) 0~1
+    dot = np.sum(q0 * q1, axis=1)
+    q1 = np.where((dot < 0)[:, None], -q1, q1)
+    dot = np.abs(dot)
+
+    theta = np.arccos(np.clip(dot, -1.0, 1.0))
+    sin_theta = np.sin(theta)
+    near = sin_theta < 1e-6 # ほぼ同じ姿勢は線形補間
+    safe_sin = np.where(near, 1.0, sin_theta)
+    w0 = np.where(near, 1.0 - u, np.sin((1.0 - u) * theta) / safe_sin)
+    w1 = np.where(near, u, np.sin(u * theta) / safe_sin)
+
+    q = w0[:, None] * q0 + w1[:, None] * q1
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+class ReferenceIndex:
+    """
+    基準軌跡の時刻索引 (load_reference_dfの結果から1回だけ作る)
+    interpolation : 'nearest' (最も近い時刻の姿勢) or 'linear' (位置は線形補間、姿勢はSLERP)
+    """
+    QUATERNION_COLUMNS = ['qx', 'qy', 'qz', 'qw']
+
+    def __init__(self, dataframe, interpolation='nearest'):
+        if interpolation not in ('nearest', 'linear'):
+            raise ValueError(f"unknown interpolation: {interpolation}")
+        self.interpolation = interpolation
+
+        timestamp = dataframe['timestamp'].to_numpy(dtype=np.float64)
+        order = np.argsort(timestamp, kind='stable')
+        self.timestamp = np.ascontiguousarray(timestamp[order])
+        self.x = np.ascontiguousarray(dataframe['x'].to_numpy(dtype=np.float64)[order])
+        self.y = np.ascontiguousarray(dataframe['y'].to_numpy(dtype=np.float64)[order])
+        self.z = np.ascontiguousarray(dataframe['z'].to_numpy(dtype=np.float64)[order])
+
+        if all(c in dataframe.columns for c in self.QUATERNION_COLUMNS):
+            self.quaternion = np.ascontiguousarray(dataframe[self.QUATERNION_COLUMNS].to_numpy(dtype=np.float64)[order])
+        else:
+            self.quaternion = None
+
+    def __len__(self):
+        return self.timestamp.shape[0]
+
+    def nearest_index(self, times):
+        # np.argmin(np.abs(timestamp - t)) と同じ結果 (同距離なら前側)
+        times = np.asarray(times, dtype=np.float64)
+        right = np.clip(np.searchsorted(self.timestamp, times, side='left'), 1, len(self) - 1)
+        left = right - 1
+        use_left = (times - self.timestamp[left]) <= (self.timestamp[right] - times)
+        index = np.where(use_left, left, right)
+        if len(self) == 1:
+            index = np.zeros_like(index)
+        # 同じ時刻が複数ある場合は先頭の行
+        return np.searchsorted(self.timestamp, self.timestamp[index], side='left')
+
+    def _bracket(self, times):
+        # linear用 : 区間の左index と 区間内の割合 (範囲外は端の値)
+        times = np.clip(np.asarray(times, dtype=np.float64), self.timestamp[0], self.timestamp[-1])
+        left = np.clip(np.searchsorted(self.timestamp, times, side='right') - 1, 0, max(len(self) - 2, 0))
+        right = np.minimum(left + 1, len(self) - 1)
+        span = self.timestamp[right] - self.timestamp[left]
+        u = np.divide(times - self.timestamp[left], span, out=np.zeros_like(times), where=span > 0)
+        return left, right, u
+
+    def lookup(self, times):
+        # times : スカラー or 配列 (全フレームを1回で引ける) -> x, y, z
+        if self.interpolation == 'nearest':
+            index = self.nearest_index(times)
+            return self.x[index], self.y[index], self.z[index]
+
+        left, right, u = self._bracket(times)
+        x = self.x[left] + u * (self.x[right] - self.x[left])
+        y = self.y[left] + u * (self.y[right] - self.y[left])
+        z = self.z[left] + u * (self.z[right] - self.z[left])
+        return x, y, z
+
+    def lookup_orientation(self, times):
+        # -> (N, 4) quaternion (qx, qy, qz, qw)
+        if self.quaternion is None:
+            raise ValueError(f"reference has no {self.QUATERNION_COLUMNS} columns")
+
+        times = np.atleast_1d(np.asarray(times, dtype=np.float64))
+        if self.interpolation == 'nearest':
+            return self.quaternion[self.nearest_index(times)]
+
+        left, right, u = self._bracket(times)
+        return slerp(self.quaternion[left], self.quaternion[right], u)
@@ -0,0 +1,197 @@
+"""
+入力bagのLiDAR/IMUメッセージを1回だけ読み出して並べたキャッシュ (generate_rosbag.run_pipelineの読み込み元)
+
+cache_dir/<bag名>-<key>/
+  points.bin   全LiDARフレームのPointCloud2.dataを連結したもの (np.memmapで開き、フレーム毎にコピーせずに切り出す)
+  shells.bin   LiDAR : dataを空にしたPointCloud2 (header/fields等、数百バイト)、IMU : メッセージの生バイト
+  index.npy    メッセージ毎 (bagの時刻順) の (topic, timestamp, stamp_ns, shell_offset, shell_size, data_offset, data_size)
+  meta.json    入力bagのサイズ/mtime (/sha256)、topic、msgtype
+
+bagのサイズかmtimeが変わると作り直す (verify_content=Trueなら中身のsha256が同じ場合は作り直さない)
+worker processはそれぞれmemmapで開くので、点群はページキャッシュを共有してコピーされない
+"""
+import numpy as np
+
+# default modules
+import dataclasses
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+# rosbags libraries
+from rosbags.highlevel import AnyReader
+
+# load external files
+import benign_cache
+import file_io
+
+VERSION = 1
+LIDAR, IMU = 0, 1
+INDEX_DTYPE = np.dtype([('topic', 'u1'), ('timestamp', '<i8'), ('stamp_ns', '<i8'),
+                        ('shell_offset', '<u8'), ('shell_size', '<u8'), ('data_offset', '<u8'), ('data_size', '<u8')])
+
+def cache_path(cache_dir, bag_path, lidar_topic, imu_topic):
+    # 同じbag (パス) とtopicの組なら同じディレクトリ (中身が変わった場合は上書きする)
+    source = json.dumps([str(Path(bag_path).resolve()), lidar_topic, imu_topic, VERSION])
+    return Path(cache_dir) / f"{Path(bag_path).stem}-{hashlib.sha256(source.encode()).hexdigest()[:16]}"
+
+@contextmanager
+def _locked(path):
+    # 複数のworker processが同時に作らないようにflockで排他する
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.parent / f".{path.name}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def _read_meta(path):
+    try:
+        with open(path / "meta.json", 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def is_valid(path, bag_path, verify_content=False):
+    meta = _read_meta(path)
+    if meta is None or meta.get('version') != VERSION:
+        return False
+    stat = Path(bag_path).stat()
+    if meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns:
+        return True
+    if not verify_content or meta.get('sha256') is None or meta['size'] != stat.st_size:
+        return False
+    if benign_cache.content_hash(bag_path) != meta['sha256']:
+        return False
+    # 中身は同じ (touchされただけ) : 次回からサイズ/mtimeで判定できるようにする
+    meta['mtime_ns'] = stat.st_mtime_ns
+    benign_cache._atomic_write_bytes(path / "meta.json", json.dumps(meta, indent=2).encode())
+    return True
+
+def split_pointcloud2(rawdata, n_data):
+    # ROS1のPointCloud2は ... uint32 len, uint8[len] data, bool is_dense の順
+    # -> (dataを長さ0にしたメッセージ, data)
+    data_start = len(rawdata) - 1 - n_data
+    if struct.unpack_from('<I', rawdata, data_start - 4)[0] != n_data:
+        raise ValueError("unexpected PointCloud2 layout")
+    shell = rawdata[:data_start - 4] + b'\0\0\0\0' + rawdata[-1:]
+    return shell, rawdata[data_start:-1]
+
+def ingest(bag_path, lidar_topic, imu_topic, path, verify_content=False):
+    # 一時ディレクトリに書いてからrenameする (途中で落ちても壊れたキャッシュを残さない)
+    typestore = file_io.ros1_typestore()
+    stat = Path(bag_path).stat()
+    tmp = Path(tempfile.mkdtemp(dir=path.parent, prefix=f".{path.name}."))
+    try:
+        index = []
+        msgtypes = {}
+        with AnyReader([Path(bag_path)], default_typestore=typestore) as reader, \
+             open(tmp / "points.bin", 'wb') as points, open(tmp / "shells.bin", 'wb') as shells:
+            connections = [x for x in reader.connections if x.topic in (lidar_topic, imu_topic)]
+            for connection, timestamp, rawdata in reader.messages(connections=connections):
+                msgtypes[connection.topic] = connection.msgtype
+                # header.stamp (uint32 seq, uint32 sec, uint32 nsec)
+                sec, nanosec = struct.unpack_from('<II', rawdata, 4)
+                stamp_ns = sec * 1_000_000_000 + nanosec
+                if connection.topic == lidar_topic:
+                    n_data = typestore.deserialize_ros1(rawdata, connection.msgtype).data.shape[0]
+                    shell, data = split_pointcloud2(rawdata, n_data)
+                    index.append((LIDAR, timestamp, stamp_ns, shells.tell(), len(shell), points.tell(), len(data)))
+                    points.write(data)
+                else:
+                    index.append((IMU, timestamp, stamp_ns, shells.tell(), len(rawdata), 0, 0))
+                    shell = rawdata
+                shells.write(shell)
+
+        np.save(tmp / "index.npy", np.array(index, dtype=INDEX_DTYPE))
+        meta = {'version': VERSION, 'bag': str(Path(bag_path).resolve()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                'sha256': benign_cache.content_hash(bag_path) if verify_content else None,
+                'topics': {'lidar': lidar_topic, 'imu': imu_topic}, 'msgtypes': msgtypes}
+        with open(tmp / "meta.json", 'w') as f:
+            json.dump(meta, f, indent=2)
+
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+def open_cache(cache_dir, bag_path, lidar_topic, imu_topic, verify_content=False):
+    # 無いか古ければ作ってから開く
+    path = cache_path(cache_dir, bag_path, lidar_topic, imu_topic)
+    with _locked(path):
+        if not is_valid(path, bag_path, verify_content):
+            ingest(bag_path, lidar_topic, imu_topic, path, verify_content)
+    return FrameCache(path)
+
+def _memmap(path):
+    # 長さ0のファイルはmemmapできない
+    if path.stat().st_size == 0:
+        return np.empty(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r')
+
+class CachedFrame:
+    # 1メッセージ (generate_rosbag.BagFrameと同じ使い方 : raw() / msg())
+    __slots__ = ('cache', 'row')
+
+    def __init__(self, cache, row):
+        self.cache = cache
+        self.row = row
+
+    @property
+    def msgtype(self):
+        return self.cache.msgtypes[self.cache.topic_names[int(self.row['topic'])]]
+
+    def _shell(self):
+        start = int(self.row['shell_offset'])
+        return self.cache.shells[start:start + int(self.row['shell_size'])]
+
+    def _data(self):
+        start = int(self.row['data_offset'])
+        return self.cache.points[start:start + int(self.row['data_size'])]
+
+    def raw(self):
+        # 入力bagと同じバイト列
+        shell = self._shell().tobytes()
+        if self.row['topic'] != LIDAR:
+            return shell
+        return b''.join((shell[:-5], struct.pack('<I', int(self.row['data_size'])), self._data().tobytes(), shell[-1:]))
+
+    def msg(self):
+        # LiDAR : dataはpoints.binへのビュー (コピーしない、読み取り専用)
+        msg = self.cache.typestore.deserialize_ros1(self._shell().tobytes(), self.msgtype)
+        if self.row['topic'] != LIDAR:
+            return msg
+        return dataclasses.replace(msg, data=self._data())
+
+class FrameCache:
+    def __init__(self, path):
+        self.path = Path(path)
+        meta = _read_meta(self.path)
+        self.msgtypes = meta['msgtypes']
+        self.topic_names = {LIDAR: meta['topics']['lidar'], IMU: meta['topics']['imu']}
+        self.index = np.load(self.path / "index.npy")
+        self.points = _memmap(self.path / "points.bin")
+        self.shells = _memmap(self.path / "shells.bin")
+        self.typestore = file_io.ros1_typestore()
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def lidar_times(self):
+        # LiDARの記録時刻 (generate_rosbag.lidar_frame_timesと同じ)
+        return np.sort(self.index['timestamp'][self.index['topic'] == LIDAR])
+
+    def first_lidar_msg(self):
+        rows = np.flatnonzero(self.index['topic'] == LIDAR)
+        return CachedFrame(self, self.index[rows[0]]).msg() if rows.shape[0] else None
+
+    def messages(self):
+        # (topic, timestamp, stamp_ns, frame) を時刻順に
+        for row in self.index:
+            yield self.topic_names[int(row['topic'])], int(row['timestamp']), int(row['stamp_ns']), CachedFrame(self, row)
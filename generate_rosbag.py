@@ -1,29 +1,126 @@
 # rosbags libraries
 from rosbags.highlevel import AnyReader
 from rosbags.rosbag1 import Writer
-from rosbags.typesys import Stores, get_typestore
 
 import numpy as np
 from pathlib import Path
 import json
+import struct
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
 
 # load external files
+import file_io
+import frame_cache
+import instrument
+import seeding
 import spoofing_sim
 
-def binary_to_xyz(binary):
-    x = binary[:, 0:4].view(dtype=np.float32)
-    y = binary[:, 4:8].view(dtype=np.float32)
-    z = binary[:, 8:12].view(dtype=np.float32)
-    return x.flatten(), y.flatten(), z.flatten()
+SPOOFING_MODES = ('removal', 'static_injection', 'dynamic_injection')
 
-def compare_reference(rosbag_time, dataframe_reference):
-    reference_time = dataframe_reference['timestamp']
-    x, y = np.array(dataframe_reference['x']), np.array(dataframe_reference['y'])
+# sensor_msgs/PointField datatype -> numpy type
+POINTFIELD_DTYPES = {
+    1: np.int8,
+    2: np.uint8,
+    3: np.int16,
+    4: np.uint16,
+    5: np.int32,
+    6: np.uint32,
+    7: np.float32,
+    8: np.float64,
+}
 
-    # find corresponding timestamp
-    time_diff = np.abs(reference_time - rosbag_time)
-    corresponding_index = np.argmin(time_diff)
-    return x[corresponding_index], y[corresponding_index]
+def point_dtype(fields, point_step, is_bigendian=False):
+    # PointFieldの並びからstructured dtypeを作る (padding込みでitemsize=point_step)
+    byteorder = '>' if is_bigendian else '<'
+    names, formats, offsets = [], [], []
+    for field in fields:
+        base = np.dtype(POINTFIELD_DTYPES[field.datatype]).newbyteorder(byteorder)
+        names.append(field.name)
+        formats.append(base if field.count == 1 else (base, (field.count,)))
+        offsets.append(field.offset)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': point_step})
+
+def decode_points(msg):
+    # msg.dataをコピーせずにstructured arrayとして見る
+    dtype = point_dtype(msg.fields, msg.point_step, msg.is_bigendian)
+    n_points = msg.data.shape[0] // msg.point_step
+    return np.frombuffer(msg.data, dtype=dtype, count=n_points)
+
+def xyz_view(points):
+    # x, y, zが連続したfloat32なら元バッファへの(N,3)ビュー、それ以外はコピー
+    fields = points.dtype.fields
+    x_type, x_offset = fields['x'][:2]
+    if (x_type == np.dtype('<f4') and fields['y'][:2] == (x_type, x_offset + 4)
+            and fields['z'][:2] == (x_type, x_offset + 8)):
+        return np.ndarray((points.shape[0], 3), dtype=np.float32, buffer=points,
+                          offset=x_offset, strides=(points.dtype.itemsize, 4))
+    return np.stack((points['x'], points['y'], points['z']), axis=1).astype(np.float32)
+
+def encode_points(points, keep_mask, points_spoofed):
+    # 残す点と注入点を一つの出力バッファに直接書き込む
+    # 注入点のintensity/ring/time等は0で埋める
+    n_remaining = int(np.count_nonzero(keep_mask))
+    n_spoofed = points_spoofed.shape[0]
+    out = np.zeros(n_remaining + n_spoofed, dtype=points.dtype)
+    out[:n_remaining] = points[keep_mask]
+    for i, name in enumerate(('x', 'y', 'z')):
+        out[name][n_remaining:] = points_spoofed[:, i]
+    return out
+
+def compare_reference(rosbag_time, reference_index):
+    # reference_index : file_io.ReferenceIndex (rosbag_timeは配列でも可)
+    x, y, _ = reference_index.lookup(rosbag_time)
+    return x, y
+
+# lidar_frame_timesが読むrosbagsの内部 (rosbag1.Reader.indexes : {connection.id: [IndexData(time, ...)]}) を確認したversion
+ROSBAGS_INDEX_VERSION = "0.11.7"
+_index_fallback_warned = False
+
+def lidar_frame_times(connections):
+    # rosbag1のindexからLiDARの記録時刻を読む (メッセージ本体は読まない)
+    # rosbagsの公開APIではないので、読めなければNone (呼び出し側はフレーム毎のcompare_referenceになり遅い) を返して1回だけ警告する
+    global _index_fallback_warned
+    times = []
+    for connection in connections:
+        try:
+            times.extend(index.time for index in connection.owner.indexes[connection.id])
+        except (AttributeError, KeyError, TypeError) as e:
+            if not _index_fallback_warned:
+                _index_fallback_warned = True
+                print(f"Warning: cannot read the rosbag1 index ({type(e).__name__}: {e}); falling back to per-frame reference lookup. "
+                      f"lidar_frame_times was checked with rosbags {ROSBAGS_INDEX_VERSION}")
+            return None
+    return np.sort(np.array(times, dtype=np.int64))
+
+def frame_positions(connections, reference_index):
+    # 全LiDARフレームの基準位置を1回のベクトル演算で求める {timestamp_ns: (x, y)}
+    return times_to_positions(lidar_frame_times(connections), reference_index)
+
+def times_to_positions(times, reference_index):
+    if times is None or times.shape[0] == 0:
+        return None
+    rosbag_time = times / 1e9 - times[0] / 1e9
+    x, y = compare_reference(rosbag_time, reference_index)
+    return dict(zip(times.tolist(), zip(x.tolist(), y.tolist())))
+
+def lidar_frame_xy(bag_path, lidar_topic, reference_index):
+    # 全LiDARフレームの基準位置 (N, 2) (spoofer配置の評価用、bagのindexだけを読む)
+    if not isinstance(reference_index, file_io.ReferenceIndex):
+        reference_index = file_io.ReferenceIndex(reference_index)
+    with AnyReader([Path(bag_path)], default_typestore=file_io.ros1_typestore()) as reader:
+        times = lidar_frame_times([x for x in reader.connections if x.topic == lidar_topic])
+    if times is None or times.shape[0] == 0:
+        return None
+    x, y = compare_reference(times / 1e9 - times[0] / 1e9, reference_index)
+    return np.column_stack((x, y))
+
+def header_stamp_ns(rawdata):
+    # ROS1のstd_msgs/Header : uint32 seq, uint32 sec, uint32 nsec, string frame_id
+    sec, nanosec = struct.unpack_from('<II', rawdata, 4)
+    return sec * 1_000_000_000 + nanosec
 
 def check_spoofing_condition(odom_x, odom_y, spoofer_x, spoofer_y, distance_threshold):
     dist_spoofer_to_robot = ((odom_x - spoofer_x) ** 2 + (odom_y - spoofer_y) ** 2) ** 0.5
@@ -37,105 +134,375 @@ def decide_spoofing_param(odom_x, odom_y, spoofer_x, spoofer_y):
     spoofing_angle = np.degrees(np.arctan2(spoofer_y - odom_y, spoofer_x - odom_x)) 
     return spoofing_angle
 
-def create_pointcloud2(points, seq, stamp_ns, frame_id, typestore):
-    blob = points.astype(np.float32).tobytes()
-    data_array = np.frombuffer(blob, dtype=np.uint8)
-    PointField = typestore.types['sensor_msgs/msg/PointField']
-    fields = [
-        PointField(name='x', offset=0, datatype=7, count=1),
-        PointField(name='y', offset=4, datatype=7, count=1),
-        PointField(name='z', offset=8, datatype=7, count=1),
-    ]
+def encode_organized(points, columns, cells):
+    # organized (H, W) の点群をコピーし、spoofing範囲の列だけを書き換える
+    # intensity/ring/time等は元の値のまま残す
+    # structured dtypeのcopy()はpaddingのバイトを初期化しないので、点毎の生バイトとしてコピーする
+    out = points.view((np.void, points.dtype.itemsize)).copy().view(points.dtype)
+    for i, name in enumerate(('x', 'y', 'z')):
+        out[name][:, columns] = cells[..., i]
+    return out
+
+def create_pointcloud2(points, seq, stamp_ns, frame_id, fields, typestore):
+    # pointsはencode_points (N,) または encode_organized (H, W) の出力 (入力と同じフィールド構成)
+    data_array = points.view(np.uint8).reshape(-1)
+    point_step = points.dtype.itemsize
+    height, width = points.shape if points.ndim == 2 else (1, points.shape[0])
     Header = typestore.types['std_msgs/msg/Header']
     Timestamp = typestore.types['builtin_interfaces/msg/Time']
     ros_time = Timestamp(sec=int(stamp_ns // 1e9), nanosec=int(stamp_ns % 1e9))
     header = Header(seq=seq, stamp=ros_time, frame_id=frame_id)
     PointCloud2 = typestore.types['sensor_msgs/msg/PointCloud2']
-    return PointCloud2(header=header, height=1, width=points.shape[0], fields=fields,
-                       is_bigendian=False, point_step=12, row_step=12 * points.shape[0],
-                       data=data_array, is_dense=True)
+    return PointCloud2(header=header, height=height, width=width, fields=fields,
+                       is_bigendian=False, point_step=point_step, row_step=point_step * width,
+                       data=data_array, is_dense=(height == 1))
 
-def generate_main(spoofer_x, spoofer_y, reference_dataframe):
-        
-    with open('config_temp.json', 'r') as f:
-        config = json.load(f)
+def spoof_points(points, spoofing_mode, spoofing_angle, now_time, params, rng, geometry=None):
+    # 1フレーム分のspoofing (points : decode_pointsの出力) -> encode済みの点群
+    # geometryがあればorganized (H, W) の点群として範囲内の列だけを書き換える
+    if geometry is not None:
+        columns, cells = spoofing_sim.organized_spoof(spoofing_mode, geometry, spoofing_angle, now_time, params, rng)
+        # 書き換えたセルを除去、0でないセルを注入として数える
+        instrument.count('points_in', points.size)
+        instrument.count('points_removed', cells.shape[0] * cells.shape[1])
+        instrument.count('points_injected', int(np.count_nonzero(np.any(cells != 0.0, axis=2))))
+        return encode_organized(points, columns, cells)
+
+    raw_cloud = xyz_view(points)
+
+    if spoofing_mode == "removal":
+        keep_mask, points_spoofed = spoofing_sim.spoof_main(raw_cloud, spoofing_angle, params, rng)
+
+    elif spoofing_mode == "static_injection":
+        keep_mask, points_spoofed = spoofing_sim.injection_main(raw_cloud, spoofing_angle, params, rng)
+
+    elif spoofing_mode == "dynamic_injection":
+        keep_mask, points_spoofed = spoofing_sim.dynamic_injection_main(raw_cloud, now_time, spoofing_angle, params, rng)
+
+    instrument.count('points_in', points.shape[0])
+    instrument.count('points_removed', points.shape[0] - int(np.count_nonzero(keep_mask)))
+    instrument.count('points_injected', points_spoofed.shape[0])
+    return encode_points(points, keep_mask, points_spoofed)
+
+def trial_bag_path(output_bag, trial):
+    # sim.bag -> sim_003.bag
+    output_bag = Path(output_bag)
+    return output_bag.with_name(f"{output_bag.stem}_{trial:03d}{output_bag.suffix}")
+
+def generate_main(spoofer_x, spoofer_y, reference_index, params=None, output_bag_path=None, seed=None):
+    # 1試行分のbagを生成する
+    if output_bag_path is None:
+        with open('config_temp.json', 'r') as f:
+            output_bag_path = json.load(f)['rosbag']['output_bag']
+    return generate_many([(spoofer_x, spoofer_y)], reference_index, params, [output_bag_path], [seed])[0]
+
+def first_scan_geometry(msg):
+    # 最初のLiDARフレームから。organizedでない (height == 1) 場合はNone
+    if msg is None or msg.height <= 1:
+        return None
+    xyz = xyz_view(decode_points(msg))
+    return spoofing_sim.ScanGeometry.from_points(xyz.reshape(msg.height, msg.width, 3))
+
+class BagFrame:
+    # bagから読んだ1メッセージ : raw() は生バイト、msg() はdeserializeしたメッセージ (frame_cache.CachedFrameと同じ)
+    __slots__ = ('rawdata', 'msgtype', 'typestore')
+
+    def __init__(self, rawdata, msgtype, typestore):
+        self.rawdata = rawdata
+        self.msgtype = msgtype
+        self.typestore = typestore
+
+    def raw(self):
+        return self.rawdata
+
+    def msg(self):
+        return self.typestore.deserialize_ros1(self.rawdata, self.msgtype)
+
+class BagSource:
+    # 入力bagを直接読む (frame_cache.FrameCacheと同じ使い方)
+    def __init__(self, reader, lidar_topic, imu_topic, typestore):
+        self.reader = reader
+        self.typestore = typestore
+        self.connections = [x for x in reader.connections if x.topic == lidar_topic or x.topic == imu_topic]
+        self.lidar_connections = [x for x in self.connections if x.topic == lidar_topic]
 
+    def lidar_times(self):
+        return lidar_frame_times(self.lidar_connections)
+
+    def first_lidar_msg(self):
+        for connection, _, rawdata in self.reader.messages(connections=self.lidar_connections):
+            return self.typestore.deserialize_ros1(rawdata, connection.msgtype)
+        return None
+
+    def messages(self):
+        # (topic, timestamp, header.stamp, frame) を時刻順に。header.stampは生バイトから読む (deserializeしない)
+        for connection, timestamp, rawdata in self.reader.messages(connections=self.connections):
+            yield connection.topic, timestamp, header_stamp_ns(rawdata), BagFrame(rawdata, connection.msgtype, self.typestore)
+
+def read_stage(source, lidar_topic, positions, reference_index, spoofer_positions, seed_sequences,
+               distance_threshold, spoofing_mode, submit, out_queue, stop, decode_all=False):
+    """
+    reader stage : source (BagSource / frame_cache.FrameCache) を時刻順に読み、LiDARフレームをspoofing workerへ投入する
+    out_queueには読んだ順に (topic, msg_ns, payload) を入れる
+    payloadは生バイト (そのまま書く) か、試行毎の出力のリストを返すFuture
+    spoofer位置がNoneの試行はspoofingしない (benign)。decode_all=Trueならspoofingしないフレームもworkerでdecodeする
+    out_queueが一杯の間は読み込みを止める (backpressure)
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    start_time = None
+    frame_index = 0
+    try:
+        messages = source.messages()
+        while not stop.is_set():
+            with instrument.span('generate.read'):
+                message = next(messages, None)
+            if message is None:
+                break
+            topic, timestamp, msg_ns, frame = message
+
+            if topic != lidar_topic:
+                put((topic, msg_ns, frame.raw()))
+                continue
+
+            now_time = timestamp/1e9
+
+            if start_time == None:
+                start_time = now_time
+
+            rosbag_time = now_time - start_time
+
+            if positions is not None:
+                odom_x, odom_y = positions[timestamp]
+            else:
+                odom_x, odom_y = compare_reference(rosbag_time, reference_index)
+
+            # 試行毎に (spoofing_angle, 乱数列)、spoofingしない試行はNone
+            jobs = []
+            for spoofer_position, seed_sequence in zip(spoofer_positions, seed_sequences):
+                if spoofer_position is None or spoofing_mode not in SPOOFING_MODES:
+                    jobs.append(None)
+                    continue
+                spoofer_x, spoofer_y = spoofer_position
+                is_spoofing = check_spoofing_condition(odom_x, odom_y, spoofer_x, spoofer_y, distance_threshold)
+                if not is_spoofing:
+                    jobs.append(None)
+                else:
+                    jobs.append((decide_spoofing_param(odom_x, odom_y, spoofer_x, spoofer_y), seeding.frame_rng(seed_sequence, frame_index)))
+
+            # どの試行もspoofingしないフレームはworkerを通さない
+            if all(job is None for job in jobs) and not decode_all:
+                put((topic, msg_ns, frame.raw()))
+            else:
+                put((topic, msg_ns, submit(frame, msg_ns, now_time, jobs, frame_index)))
+            frame_index += 1
+
+    except BaseException as e:
+        put(e)
+    finally:
+        put(None)
+
+def run_pipeline(config, spoofer_positions, reference_index, params, seeds, emit, serialize=True, proxy_accumulators=None):
+    """
+    reader (thread) -> spoofing worker (thread pool, rosbag.frame_workers) -> emit (この関数を呼んだスレッド) の3段で処理する
+    段の間はrosbag.queue_sizeフレームまでのqueueでつなぎ、メモリ使用量を抑える
+    rosbag.frame_cache_dirがあれば入力bagの代わりにframe_cache (memmap) から読む (無いか古ければ最初に作る)
+    emit(topic, msg_ns, payloads) は読んだ順 (= 時刻順) に呼ばれるので、IMUとLiDARの順序は入力bagと同じ
+      serialize=True  : payloadsは試行毎のバイト列 (bagへそのまま書ける)
+      serialize=False : LiDARは全フレームをdecodeし、payloadsは試行毎の点群 (decode_points/spoof_pointsの出力)
+    proxy_accumulators : 試行毎のproxy_score.ProxyAccumulator (かNone)。spoofingしたフレームの前後の点群をworkerで渡す
+    """
+    if not isinstance(reference_index, file_io.ReferenceIndex):
+        reference_index = file_io.ReferenceIndex(reference_index)
+
+    n_trials = len(spoofer_positions)
     bag_path = Path(config['rosbag']['input_bag'])
-    output_bag_path = Path(config['rosbag']['output_bag'])
+    seed_sequences = [seeding.spoofing_sequence(seed) for seed in seeds]
     spoofing_mode = config['rosbag']['spoofing_mode']
 
     lidar_topic = config['rosbag']['lidar_topic']
     imu_topic = config['rosbag']['imu_topic']
-    topic_length = int(config['rosbag']['topic_length'])
-    lidar_freq = float(config['rosbag']['topic_freq'])
     distance_threshold = float(config['rosbag']['distance_threshold'])
+    # organized (rings x columns) のまま範囲内の列だけspoofingする
+    organized_scan = bool(config['rosbag'].get('organized_scan', False))
+    frame_workers = max(int(config['rosbag'].get('frame_workers', 1)), 1)
+    queue_size = max(int(config['rosbag'].get('queue_size', 4 * frame_workers)), 1)
+    cache_dir = config['rosbag'].get('frame_cache_dir')
+    geometry = None
 
-    if output_bag_path.exists():
-        output_bag_path.unlink()
+    typestore = file_io.ros1_typestore()
 
-    typestore = get_typestore(Stores.ROS1_NOETIC)
+    def spoof_frame(frame, msg_ns, now_time, jobs, frame_index):
+        # spoofing worker : 1フレームを1回decodeし、試行毎の出力を返す (spoofingしない試行は入力のまま)
+        with instrument.span('generate.decode'):
+            msg = frame.msg()
+            points = decode_points(msg)
+        frame_geometry = None
+        if geometry is not None and msg.height > 1:
+            points = points.reshape(msg.height, msg.width)
+            frame_geometry = geometry
 
-    start_time = None
-    cnt = 0
+        outputs = []
+        for trial, job in enumerate(jobs):
+            if job is None:
+                outputs.append(frame.raw() if serialize else points)
+                continue
+            spoofing_angle, rng = job
+            # pointsは読み取り専用のビューなので全試行で共有できる
+            with instrument.span('generate.spoof'):
+                simulated_points = spoof_points(points, spoofing_mode, spoofing_angle, now_time, params, rng, frame_geometry)
+            if proxy_accumulators is not None and proxy_accumulators[trial] is not None:
+                with instrument.span('proxy.score'):
+                    proxy_accumulators[trial].add(frame_index, points, simulated_points)
+            if not serialize:
+                outputs.append(simulated_points)
+                continue
+            with instrument.span('generate.serialize'):
+                out_msg = create_pointcloud2(simulated_points, msg.header.seq, msg_ns, msg.header.frame_id, msg.fields, typestore)
+                outputs.append(typestore.serialize_ros1(out_msg, frame.msgtype))
+        return outputs
 
-    with AnyReader([bag_path], default_typestore=typestore) as reader:
-        with Writer(output_bag_path) as writer:
-            lidar_conn_out = writer.add_connection(lidar_topic, 'sensor_msgs/msg/PointCloud2', typestore=typestore)
-            imu_conn_out = writer.add_connection(imu_topic, 'sensor_msgs/msg/Imu', typestore=typestore)
+    with ExitStack() as stack:
+        if cache_dir is not None:
+            with instrument.span('generate.cache_open'):
+                source = frame_cache.open_cache(cache_dir, bag_path, lidar_topic, imu_topic,
+                                                bool(config['rosbag'].get('frame_cache_verify_content', False)))
+        else:
+            source = BagSource(stack.enter_context(AnyReader([bag_path], default_typestore=typestore)), lidar_topic, imu_topic, typestore)
+        with instrument.span('generate.reference_lookup'):
+            positions = times_to_positions(source.lidar_times(), reference_index)
 
-            connections = [x for x in reader.connections if x.topic == lidar_topic or x.topic == imu_topic]
+        # proxy scoreのresidualを求めるフレームの間隔は、書き換える予定のフレーム数から決める
+        if proxy_accumulators is not None and positions is not None and spoofing_mode in SPOOFING_MODES:
+            odom_xy = np.array(list(positions.values()))
+            for spoofer_position, accumulator in zip(spoofer_positions, proxy_accumulators):
+                if accumulator is not None and spoofer_position is not None:
+                    distance = np.hypot(odom_xy[:, 0] - spoofer_position[0], odom_xy[:, 1] - spoofer_position[1])
+                    accumulator.expect(int(np.count_nonzero(distance <= distance_threshold)))
 
-            for connection, timestamp, rawdata in reader.messages(connections=connections):
+        # 列の方位角/ringの仰角は最初のLiDARフレームから1回だけ求める (どのフレームをspoofingするかに依存しない)
+        if organized_scan:
+            geometry = first_scan_geometry(source.first_lidar_msg())
 
-                msg = reader.deserialize(rawdata, connection.msgtype)
-                msg_ns = msg.header.stamp.sec * 1_000_000_000 + msg.header.stamp.nanosec
+        pool = stack.enter_context(ThreadPoolExecutor(max_workers=frame_workers))
+        frames = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+        reader_thread = threading.Thread(
+            target=read_stage, daemon=True,
+            args=(source, lidar_topic, positions, reference_index, spoofer_positions, seed_sequences,
+                  distance_threshold, spoofing_mode, lambda *args: pool.submit(spoof_frame, *args), frames, stop,
+                  not serialize))
+        reader_thread.start()
 
-                if connection.topic == imu_topic:
-                    writer.write(imu_conn_out, msg_ns, rawdata)
-                    continue
+        # 読んだ順にFutureの完了を待ってemitする
+        n_lidar_frames = 0
+        try:
+            while True:
+                item = frames.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
 
-                elif connection.topic == lidar_topic:
+                topic, msg_ns, payload = item
+                if isinstance(payload, Future):
+                    # workerの処理待ち (長ければspoofingが律速)
+                    with instrument.span('generate.wait'):
+                        payloads = payload.result()
+                else:
+                    payloads = [payload] * n_trials
+                if topic == lidar_topic:
+                    n_lidar_frames += 1
+                emit(topic, msg_ns, payloads)
+        finally:
+            stop.set()
+            reader_thread.join()
 
-                    msg = reader.deserialize(rawdata, connection.msgtype)
-                    msg_ns = msg.header.stamp.sec * 1_000_000_000 + msg.header.stamp.nanosec
+    if proxy_accumulators is not None:
+        for accumulator in proxy_accumulators:
+            if accumulator is not None:
+                accumulator.frames = n_lidar_frames
 
-                    now_time = timestamp/1e9
+def generate_many(spoofer_positions, reference_index, params=None, output_bag_paths=None, seeds=None, config=None, lidar_filters=None,
+                  proxy_accumulators=None):
+    """
+    入力bagを1回だけ読み、spoofer位置毎に別のbagへ書き出す
+    spoofer_positions : [(spoofer_x, spoofer_y), ...]
+    各LiDARフレームのdecodeは1回で、試行毎に独立した乱数列 (seeds : seeding.trial_seed) でspoofingする
+    config : config_temp.jsonの内容 (Noneならファイルから読む、parameter sweepではセル毎の値を渡す)
+    lidar_filters : 試行毎のf(rawdata, msgtype) -> rawdata (defense.DefenseStage.process_rawなど)
+                    書き出す直前に時刻順に呼ぶ (Noneの試行はそのまま書く)
+    proxy_accumulators : 試行毎のproxy_score.ProxyAccumulator。生成しながらproxy scoreを求める
+    処理の流れはrun_pipelineを参照
+    """
+    if config is None:
+        with open('config_temp.json', 'r') as f:
+            config = json.load(f)
 
-                    if start_time == None:
-                        start_time = now_time
+    # spoofingのパラメータはフレーム毎ではなく1回だけ読む
+    if params is None:
+        params = spoofing_sim.load_params(config)
 
-                    rosbag_time = now_time - start_time
+    n_trials = len(spoofer_positions)
+    # 並列実行時は試行毎に別の出力先を渡す
+    if output_bag_paths is None:
+        output_bag_paths = [trial_bag_path(config['rosbag']['output_bag'], trial) for trial in range(n_trials)]
+    output_bag_paths = [Path(path) for path in output_bag_paths]
+    if seeds is None:
+        seeds = [None] * n_trials
 
-                    odom_x, odom_y = compare_reference(rosbag_time, reference_dataframe)
-                    is_spoofing = check_spoofing_condition(odom_x, odom_y, spoofer_x, spoofer_y, distance_threshold)
+    lidar_topic = config['rosbag']['lidar_topic']
+    imu_topic = config['rosbag']['imu_topic']
 
-                    iteration = int(msg.data.shape[0]/topic_length)
-                    bin_points = np.frombuffer(msg.data, dtype=np.uint8).reshape(iteration, topic_length)
-                    x, y, z = binary_to_xyz(bin_points)
+    for output_bag_path in output_bag_paths:
+        if output_bag_path.exists():
+            output_bag_path.unlink()
 
-                    raw_cloud = np.vstack((x, y, z)).T
+    typestore = file_io.ros1_typestore()
 
-                    if is_spoofing and spoofing_mode == "removal":
-                        spoofing_angle = decide_spoofing_param(odom_x, odom_y, spoofer_x, spoofer_y)
-                        x_remaining, y_remaining, z_remaining, x_spoofed, y_spoofed, z_spoofed = spoofing_sim.spoof_main(raw_cloud, spoofing_angle, config['spoofing_simulation']['spoofing_range'])
+    with ExitStack() as stack:
+        writers = [stack.enter_context(Writer(path)) for path in output_bag_paths]
+        conns_out = {
+            lidar_topic: [writer.add_connection(lidar_topic, 'sensor_msgs/msg/PointCloud2', typestore=typestore) for writer in writers],
+            imu_topic: [writer.add_connection(imu_topic, 'sensor_msgs/msg/Imu', typestore=typestore) for writer in writers],
+        }
 
-                    elif is_spoofing and spoofing_mode == "static_injection":
-                        spoofing_angle = decide_spoofing_param(odom_x, odom_y, spoofer_x, spoofer_y)
-                        x_remaining, y_remaining, z_remaining, x_spoofed, y_spoofed, z_spoofed = spoofing_sim.injection_main(raw_cloud, spoofing_angle, config['spoofing_simulation']['spoofing_range'], config['spoofing_simulation']['static_wall_dist'])
+        def write(topic, msg_ns, payloads):
+            if lidar_filters is not None and topic == lidar_topic:
+                with instrument.span('generate.defense'):
+                    payloads = [data if f is None else f(data, 'sensor_msgs/msg/PointCloud2') for f, data in zip(lidar_filters, payloads)]
+            with instrument.span('generate.write'):
+                for writer, conn_out, data in zip(writers, conns_out[topic], payloads):
+                    writer.write(conn_out, msg_ns, data)
+
+        run_pipeline(config, spoofer_positions, reference_index, params, seeds, write, proxy_accumulators=proxy_accumulators)
+
+    return output_bag_paths
+
+def replay_many(spoofer_positions, reference_index, consumers, params=None, seeds=None):
+    """
+    bagを書かずに、spoofing済みのLiDARフレームを試行毎のconsumer(msg_ns, points) へ時刻順に渡す
+    (in-processのオドメトリ用、serializeしない)
+    spoofer_positionsの要素がNoneの試行はspoofingしない点群 (benign) を受け取る
+    """
+    with open('config_temp.json', 'r') as f:
+        config = json.load(f)
+    if params is None:
+        params = spoofing_sim.load_params(config)
+    if seeds is None:
+        seeds = [None] * len(spoofer_positions)
+    lidar_topic = config['rosbag']['lidar_topic']
 
-                    elif is_spoofing and spoofing_mode == "dynamic_injection":
-                        spoofing_angle = decide_spoofing_param(odom_x, odom_y, spoofer_x, spoofer_y)
-                        x_remaining, y_remaining, z_remaining, x_spoofed, y_spoofed, z_spoofed = spoofing_sim.dynamic_injection_main(raw_cloud, now_time, spoofing_angle, config['spoofing_simulation']['spoofing_range'])
-                        
-                    else:
-                        x_remaining, y_remaining, z_remaining, x_spoofed, y_spoofed, z_spoofed = x, y, z, np.array([]), np.array([]), np.array([])
+    def feed(topic, msg_ns, payloads):
+        if topic != lidar_topic:
+            return
+        for consumer, points in zip(consumers, payloads):
+            consumer(msg_ns, points)
 
-                    x_simulated = np.concatenate((x_remaining, x_spoofed))
-                    y_simulated = np.concatenate((y_remaining, y_spoofed))
-                    z_simulated = np.concatenate((z_remaining, z_spoofed))
-                    simulated_cloud =  np.vstack((x_simulated.astype(np.float32), y_simulated.astype(np.float32), z_simulated.astype(np.float32))).T
-                    
-                    out_msg = create_pointcloud2(simulated_cloud, cnt, msg_ns, msg.header.frame_id, typestore)
-                    serialized_msg = typestore.serialize_ros1(out_msg, lidar_conn_out.msgtype)
-                    writer.write(lidar_conn_out, msg_ns, serialized_msg)
-                    cnt += 1
\ No newline at end of file
+    run_pipeline(config, spoofer_positions, reference_index, params, seeds, feed, serialize=False)
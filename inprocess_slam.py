@@ -0,0 +1,62 @@
+"""
+KISS-ICPをプロセス内で実行する (roslaunch/bagの書き出しを使わない)
+generate_rosbag.replay_manyから時刻順に点群を受け取り、推定軌跡をTUM配列 (N, 8) [timestamp, x, y, z, qx, qy, qz, qw] で返す
+返した配列はerror_estimate.evaluateにそのまま渡せる
+
+kiss_icp (pip install kiss-icp) は任意の依存 : KissOdometryを作る時だけimportする
+点毎の時刻を渡さないのでdeskewは行わない (roslaunch版のKISS-ICPとは結果が一致しない)
+"""
+import numpy as np
+
+# load external files
+import generate_rosbag
+import traj_metrics
+
+def load_kiss_icp():
+    try:
+        from kiss_icp.config import load_config
+        from kiss_icp.kiss_icp import KissICP
+    except ImportError as e:
+        raise ImportError("in-process KISS-ICP requires the kiss-icp package (pip install kiss-icp)") from e
+    return KissICP, load_config
+
+class KissOdometry:
+    """
+    consumer(msg_ns, points) として1試行分のLiDARフレームを受け取る
+    config_file : KISS-ICPのyaml (Noneならkiss_icpの既定値)
+    threads : ICPのスレッド数 (Noneならyamlの値、複数プロセスで試行を並列に回す場合は1)
+    """
+    def __init__(self, config_file=None, threads=None):
+        KissICP, load_config = load_kiss_icp()
+        config = load_config(config_file)
+        config.data.deskew = False
+        if threads is not None:
+            config.registration.max_num_threads = int(threads)
+        self.odometry = KissICP(config)
+        self.stamps = []
+        self.poses = []
+
+    def __call__(self, msg_ns, points):
+        # 無効点 (0, 0, 0) / NaNを除く。点が残らないフレームは位置を更新しない
+        xyz = generate_rosbag.xyz_view(np.ascontiguousarray(points).reshape(-1))
+        valid = np.isfinite(xyz).all(axis=1) & np.any(xyz != 0.0, axis=1)
+        self.odometry.register_frame(xyz[valid].astype(np.float64), np.empty(0))
+        self.stamps.append(msg_ns / 1e9)
+        self.poses.append(self.odometry.last_pose.copy())
+
+    def trajectory(self):
+        if not self.poses:
+            return np.empty((0, 8))
+        poses = np.asarray(self.poses)
+        return np.column_stack((np.asarray(self.stamps), poses[:, :3, 3], traj_metrics.rotation_to_quaternion(poses[:, :3, :3])))
+
+def run_trials(spoofer_positions, reference_index, params=None, seeds=None, config_file=None, threads=None, stages=None):
+    """
+    入力bagを1回だけ読み、spoofer位置毎のKISS-ICPの推定軌跡を返す
+    spoofer_positionsにNoneを入れるとspoofingしない (benign) 軌跡になる
+    stages : 試行毎のdefense.DefenseStage (KISS-ICPの前で検知/除去する)
+    """
+    odometries = [KissOdometry(config_file, threads) for _ in spoofer_positions]
+    consumers = odometries if stages is None else [stage.wrap(odometry) for stage, odometry in zip(stages, odometries)]
+    generate_rosbag.replay_many(spoofer_positions, reference_index, consumers, params, seeds)
+    return [odometry.trajectory() for odometry in odometries]
@@ -0,0 +1,150 @@
+"""
+工程毎の時間計測とカウンタ (JSON lines)
+
+  with instrument.span('generate.decode'):   # 集計だけ (フレーム毎などの細かい区間)
+  with instrument.span('slam.run', emit_event=True, algorithm=...):   # 1区間毎に1行書く
+  @instrument.timed('evaluate')
+  instrument.count('points_in', n)
+  instrument.flush()   # 集計 (span/カウンタ) を1行書いてリセットする (プロセス終了前や試行毎に呼ぶ)
+
+configure(path, **context) で出力先を決める (Noneなら集計だけ)。contextは全ての行に付く
+worker processでも同じpathをconfigureすれば1つのファイルに追記される
+summary(path) で全プロセス分を集計した表を作る
+"""
+# default modules
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+_lock = threading.Lock()
+_state = {'path': None, 'context': {}}
+_spans = {}     # name -> [count, total, max] (sec)
+_counters = {}  # name -> total
+
+def configure(path, **context):
+    _state['path'] = None if path is None else Path(path)
+    _state['context'] = context
+    if _state['path'] is not None:
+        _state['path'].parent.mkdir(parents=True, exist_ok=True)
+
+def settings():
+    # configureの引数 (worker processへ渡す用) : (path, context)
+    return _state['path'], dict(_state['context'])
+
+def emit(kind, **fields):
+    # 1行を1回のwriteでO_APPEND追記する (複数プロセスから書いても行が混ざらない)
+    if _state['path'] is None:
+        return
+    line = json.dumps(dict(type=kind, time=time.time(), pid=os.getpid(), **_state['context'], **fields), default=float) + "\n"
+    with _lock:
+        fd = os.open(_state['path'], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+def add_span(name, duration):
+    with _lock:
+        stats = _spans.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] = max(stats[2], duration)
+
+@contextmanager
+def span(name, emit_event=False, **fields):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        # emit_eventの区間は行として書くので集計には入れない (summaryで二重に数えない)
+        if emit_event:
+            emit('span', name=name, duration=duration, **fields)
+        else:
+            add_span(name, duration)
+
+def timed(name=None, emit_event=False):
+    # デコレータ版のspan
+    def decorator(func):
+        span_name = name or func.__qualname__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, emit_event):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def flush(**fields):
+    # ここまでの集計を1行書いてリセットする
+    with _lock:
+        spans = {name: {'count': c, 'total': t, 'max': m} for name, (c, t, m) in _spans.items()}
+        counters = dict(_counters)
+        _spans.clear()
+        _counters.clear()
+    if spans or counters:
+        emit('aggregate', spans=spans, counters=counters, **fields)
+    return spans, counters
+
+@contextmanager
+def profile(path):
+    # pathがNoneなら何もしない。それ以外はcProfileの結果をpathに書く (pstats/snakevizで見る)
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(str(path))
+
+def read_events(path, **match):
+    # matchの全てのkey/valueが一致する行
+    events = []
+    with open(path, 'r') as f:
+        for line in f:
+            event = json.loads(line)
+            if all(event.get(key) == value for key, value in match.items()):
+                events.append(event)
+    return events
+
+def summary(path, **match):
+    """
+    span/aggregateの行をspan名毎に集計する
+    戻り値 : (span表 [name, count, total, mean, max, share], カウンタ {name: 合計})
+    shareは全spanの合計時間に対する割合 (spanは入れ子になり得るので目安)
+    """
+    totals = {}
+    counters = {}
+    for event in read_events(path, **match):
+        if event['type'] == 'span':
+            stats = totals.setdefault(event['name'], [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += event['duration']
+            stats[2] = max(stats[2], event['duration'])
+        elif event['type'] == 'aggregate':
+            for name, s in event['spans'].items():
+                stats = totals.setdefault(name, [0, 0.0, 0.0])
+                stats[0] += s['count']
+                stats[1] += s['total']
+                stats[2] = max(stats[2], s['max'])
+            for name, value in event['counters'].items():
+                counters[name] = counters.get(name, 0) + value
+
+    # pandasは集計表を作る時だけimportする (worker processの起動を遅くしない)
+    import pandas as pd
+    table = pd.DataFrame([(name, c, t, t / c if c else 0.0, m) for name, (c, t, m) in totals.items()],
+                         columns=['name', 'count', 'total', 'mean', 'max'])
+    table['share'] = table['total'] / table['total'].sum() if len(table) else []
+    return table.sort_values('total', ascending=False).reset_index(drop=True), counters
@@ -0,0 +1,170 @@
+"""
+SLAMを実行する前の簡易的な攻撃効果の推定 (proxy score)
+spoofing前後のLiDARフレームを比べる
+  生成中 : ProxyAccumulatorをgenerate_rosbag.generate_many(proxy_accumulators=...) に渡す (bagを読み直さない)
+  生成済みのbag : score_bag (入力bagと生成したbagを読み直す)
+  affected_fraction : 書き換えられたフレームの割合
+  point_reduction   : 書き換えられたフレームでの有効点の減少率 (平均、注入やノイズで点が増えた場合は負)
+  residual          : 書き換えられたフレームの元の点群とのKD-tree最近傍距離 (両方向の平均) [m]
+  impact            : affected_fraction * residual (書き換えの無いフレームを0とした平均)
+"""
+import numpy as np
+
+# rosbags libraries
+from rosbags.highlevel import AnyReader
+
+# default modules
+import math
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+# load external files
+import file_io
+import generate_rosbag
+import traj_metrics
+
+METRICS = ('impact', 'affected_fraction', 'point_reduction', 'residual')
+
+@dataclass
+class ProxyScore:
+    frames: int
+    affected_frames: int
+    point_reduction: float
+    residual: float
+
+    @property
+    def affected_fraction(self):
+        return self.affected_frames / self.frames if self.frames else 0.0
+
+    @property
+    def impact(self):
+        return self.affected_fraction * self.residual
+
+    def value(self, metric='impact'):
+        if metric not in METRICS:
+            raise ValueError(f"unknown proxy metric: {metric}")
+        return float(getattr(self, metric))
+
+def valid_points(points):
+    # 無効点 (0, 0, 0) / NaNを除いたxyz (pointsはdecode_points/spoof_pointsの出力)
+    xyz = generate_rosbag.xyz_view(points.reshape(-1))
+    valid = np.isfinite(xyz).all(axis=1) & np.any(xyz != 0.0, axis=1)
+    return xyz[valid]
+
+def valid_xyz(msg):
+    return valid_points(generate_rosbag.decode_points(msg))
+
+def subsample(xyz, max_points):
+    # 等間隔に間引く (乱数を使わないので同じbagなら同じ値)
+    if xyz.shape[0] <= max_points:
+        return xyz
+    return xyz[np.linspace(0, xyz.shape[0] - 1, max_points).astype(np.int64)]
+
+def frame_residual(original, spoofed, max_points=2000):
+    # 両方向の最近傍距離の平均 (注入点も除去された点も大きくなる)
+    if original.shape[0] == 0 or spoofed.shape[0] == 0:
+        return 0.0
+    original, spoofed = subsample(original, max_points), subsample(spoofed, max_points)
+    return 0.5 * float(np.mean(traj_metrics.nearest_distances(spoofed, original))
+                       + np.mean(traj_metrics.nearest_distances(original, spoofed)))
+
+def score_bag(input_bag, spoofed_bag, lidar_topic, max_frames=50, max_points=2000):
+    """
+    spoofed_bagはgenerate_rosbagの出力 (LiDARフレームの順序は入力bagと同じ)
+    生バイトが同じフレームは書き換え無しとしてdecodeしない
+    point_reduction/residualは書き換えられたフレームを最大max_frames個 (等間隔) 使う
+    """
+    typestore = file_io.ros1_typestore()
+    with AnyReader([Path(input_bag)], default_typestore=typestore) as original_reader, \
+         AnyReader([Path(spoofed_bag)], default_typestore=typestore) as spoofed_reader:
+        original_conns = [x for x in original_reader.connections if x.topic == lidar_topic]
+        spoofed_conns = [x for x in spoofed_reader.connections if x.topic == lidar_topic]
+
+        n_frames = 0
+        affected = []
+        for (connection, _, original), (_, _, spoofed) in zip(original_reader.messages(connections=original_conns),
+                                                              spoofed_reader.messages(connections=spoofed_conns)):
+            if original != spoofed:
+                affected.append(n_frames)
+            n_frames += 1
+
+        if not affected:
+            return ProxyScore(n_frames, 0, 0.0, 0.0)
+
+        # 2回目の読み込みでは選んだフレームだけdecodeする
+        selected = set(np.asarray(affected)[np.linspace(0, len(affected) - 1, min(max_frames, len(affected))).astype(np.int64)].tolist())
+        reductions, residuals = [], []
+        for frame, ((connection, _, original), (_, _, spoofed)) in enumerate(zip(original_reader.messages(connections=original_conns),
+                                                                                 spoofed_reader.messages(connections=spoofed_conns))):
+            if frame not in selected:
+                continue
+            original_xyz = valid_xyz(typestore.deserialize_ros1(original, connection.msgtype))
+            spoofed_xyz = valid_xyz(typestore.deserialize_ros1(spoofed, connection.msgtype))
+            reductions.append(1.0 - spoofed_xyz.shape[0] / max(original_xyz.shape[0], 1))
+            residuals.append(frame_residual(original_xyz, spoofed_xyz, max_points))
+
+    return ProxyScore(n_frames, len(affected), float(np.mean(reductions)), float(np.mean(residuals)))
+
+class ProxyAccumulator:
+    """
+    1試行分のProxyScoreをspoofingしながら求める (generate_rosbag.run_pipelineのworkerスレッドから呼ばれる)
+    point_reductionは書き換えた全フレーム、residualは書き換えたフレームを約max_frames個 (フレーム番号で等間隔) 使う
+    平均はフレーム番号順に取るので、workerの実行順に依らず同じ値になる
+    defenseのフィルタを掛ける前の点群で比べる
+    """
+    def __init__(self, max_frames=50, max_points=2000):
+        self.max_frames = max_frames
+        self.max_points = max_points
+        self.frames = 0
+        self.stride = 1
+        self.reductions = {} # frame_index -> point_reduction
+        self.residuals = {}  # frame_index -> residual
+        self._lock = threading.Lock()
+
+    def expect(self, n_affected):
+        # 書き換える予定のフレーム数 (分からなければNone、全フレームでresidualを求める)
+        if n_affected:
+            self.stride = max(math.ceil(n_affected / self.max_frames), 1)
+
+    def add(self, frame_index, original, spoofed):
+        original_xyz, spoofed_xyz = valid_points(original), valid_points(spoofed)
+        reduction = 1.0 - spoofed_xyz.shape[0] / max(original_xyz.shape[0], 1)
+        residual = frame_residual(original_xyz, spoofed_xyz, self.max_points) if frame_index % self.stride == 0 else None
+        with self._lock:
+            self.reductions[frame_index] = reduction
+            if residual is not None:
+                self.residuals[frame_index] = residual
+
+    def score(self):
+        if not self.reductions:
+            return ProxyScore(self.frames, 0, 0.0, 0.0)
+        reductions = [self.reductions[frame] for frame in sorted(self.reductions)]
+        residuals = [self.residuals[frame] for frame in sorted(self.residuals)]
+        return ProxyScore(self.frames, len(reductions), float(np.mean(reductions)),
+                          float(np.mean(residuals)) if residuals else 0.0)
+
+def calibration_report(scores, rpe, success_threshold, n_thresholds=10):
+    """
+    proxy scoreと実際のRPEの関係
+    戻り値 : (Spearmanの順位相関, 閾値毎の表)
+    表 : threshold / skipped (SLAMを省ける試行の割合) / missed_success (閾値未満に入ってしまう成功試行の割合)
+    """
+    # pandasは評価の時だけimportする (score_bagはworker processで呼ばれる)
+    import pandas as pd
+    scores = np.asarray(scores, dtype=np.float64)
+    rpe = np.asarray(rpe, dtype=np.float64)
+    valid = np.isfinite(scores) & np.isfinite(rpe)
+    scores, rpe = scores[valid], rpe[valid]
+    success = rpe >= success_threshold
+
+    correlation = pd.Series(scores).corr(pd.Series(rpe), method='spearman') if scores.shape[0] > 1 else np.nan
+    rows = []
+    for threshold in np.unique(np.quantile(scores, np.linspace(0.0, 1.0, n_thresholds + 1))) if scores.shape[0] else []:
+        skipped = scores < threshold
+        rows.append({
+            'threshold': threshold,
+            'skipped': float(np.mean(skipped)),
+            'missed_success': float(np.sum(skipped & success) / max(np.sum(success), 1)),
+        })
+    return correlation, pd.DataFrame(rows, columns=['threshold', 'skipped', 'missed_success'])
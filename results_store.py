@@ -0,0 +1,106 @@
+# default modules
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+class ResultsStore:
+    """
+    試行毎の結果を1行ずつ書き込むSQLite (WALモード)
+    key = (campaign_id, seed, algorithm) : 同じ組を書き直した場合は上書き
+    書き込みは1回毎に別の接続/トランザクションなので、複数のスレッド/プロセスから同時に使える
+    campaign_id/seedは64bitを超えるintなので文字列で持つ
+    """
+    COLUMNS = {
+        'trial': 'INTEGER',
+        'spoofer_x': 'REAL',
+        'spoofer_y': 'REAL',
+        'spoofer_z': 'REAL',
+        'frames_in_range': 'INTEGER',
+        'weight': 'REAL',
+        'proxy_score': 'REAL',
+        'predicted_failure': 'INTEGER',
+        'APE': 'REAL',         # 最後まで実行した軌跡のAPE (監視で途中で止めた試行はNULL)
+        'ape_partial': 'REAL', # 途中で止めた試行の、止めるまでの軌跡のAPE (APEとは比べられない)
+        'RPE': 'REAL',
+        'slam_time': 'REAL',
+        'stopped': 'TEXT', # SLAMを監視で途中で止めた理由 (trajectory_monitor.SUCCESS / STALLED)、最後まで実行したらNULL
+        'timings': 'TEXT', # 工程毎の時間 {name: sec} (JSON)
+    }
+
+    def __init__(self, path, timeout=60.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.timeout = timeout
+        columns = ''.join(f", {name} {kind}" for name, kind in self.COLUMNS.items())
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS results (campaign_id TEXT, seed TEXT, algorithm TEXT{columns}, "
+                         "recorded_at REAL, PRIMARY KEY (campaign_id, seed, algorithm))")
+            conn.execute("CREATE TABLE IF NOT EXISTS campaigns (campaign_id TEXT PRIMARY KEY, config TEXT, created REAL)")
+            # 前のversionで作ったDBには後から足した列が無い
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(results)")}
+            for name, kind in self.COLUMNS.items():
+                if name not in existing:
+                    conn.execute(f"ALTER TABLE results ADD COLUMN {name} {kind}")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        try:
+            with conn: # 正常終了でcommit、例外でrollback
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def config_key(config):
+        return json.dumps(config, sort_keys=True)
+
+    def register_campaign(self, campaign_id, config):
+        with self._connect() as conn:
+            # 記録済みのcampaignはconfigだけ書き換える (前のversionのconfig全体 -> 今の形式)
+            conn.execute("INSERT INTO campaigns VALUES (?, ?, ?) ON CONFLICT (campaign_id) DO UPDATE SET config = excluded.config",
+                         (str(campaign_id), self.config_key(config), time.time()))
+
+    def find_campaign(self, config, fallback=None):
+        # 同じconfigで最後に始めたcampaignのid (無ければNone)
+        # fallback : 見つからなければこのconfigでも探す (前のversionが記録したconfig全体)
+        with self._connect() as conn:
+            for key in [config] + ([] if fallback is None else [fallback]):
+                row = conn.execute("SELECT campaign_id FROM campaigns WHERE config = ? ORDER BY created DESC LIMIT 1",
+                                   (self.config_key(key),)).fetchone()
+                if row is not None:
+                    return row[0]
+        return None
+
+    def record(self, campaign_id, seed, algorithm, **values):
+        unknown = set(values) - set(self.COLUMNS)
+        if unknown:
+            raise ValueError(f"unknown result columns: {sorted(unknown)}")
+        if isinstance(values.get('timings'), dict):
+            values['timings'] = json.dumps(values['timings'])
+        names = ['campaign_id', 'seed', 'algorithm', *values, 'recorded_at']
+        params = [str(campaign_id), str(seed), algorithm, *values.values(), time.time()]
+        with self._connect() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO results ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})", params)
+
+    def completed(self, campaign_id):
+        # 記録済みの (trial, algorithm)
+        with self._connect() as conn:
+            rows = conn.execute("SELECT trial, algorithm FROM results WHERE campaign_id = ?", (str(campaign_id),)).fetchall()
+        return set(rows)
+
+    def rows(self, campaign_id, algorithm=None):
+        query = "SELECT * FROM results WHERE campaign_id = ?"
+        params = [str(campaign_id)]
+        if algorithm is not None:
+            query += " AND algorithm = ?"
+            params.append(algorithm)
+        # pandasは結果を読む時だけimportする (spawnのworkerは00_mainを読み直すので起動を遅くしない)
+        import pandas as pd
+        with self._connect() as conn:
+            df = pd.read_sql_query(query + " ORDER BY trial", conn, params=params)
+        df['predicted_failure'] = df['predicted_failure'].fillna(0).astype(bool)
+        return df
@@ -0,0 +1,145 @@
+# default modules
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+
+# load external files
+import defense
+import generate_rosbag
+import inprocess_slam
+import instrument
+import proxy_score
+
+# worker process内で共有する (試行毎にpickleしない)
+_worker_state = {}
+
+def _init_worker(reference_index, params, proxy, trace, profile_dir, config=None):
+    _worker_state['reference_index'] = reference_index
+    _worker_state['config'] = config
+    _worker_state['params'] = params
+    _worker_state['proxy'] = proxy
+    _worker_state['profile_dir'] = profile_dir
+    trace_path, trace_context = trace
+    instrument.configure(trace_path, **trace_context)
+
+def _generate_batch(batch, output_bag):
+    # batch : [(trial, spoofer_x, spoofer_y, seed), ...] を入力bag 1回の読み込みで生成する
+    trials = [trial for trial, _, _, _ in batch]
+    profile_dir = _worker_state['profile_dir']
+    profile_path = None if profile_dir is None else Path(profile_dir) / f"generate_{trials[0]:03d}.prof"
+    stages = defense.stages_from_config(_worker_state['config'], len(batch))
+    # proxy scoreは生成中に求める (SLAMの前にbagを読み直さない)
+    proxy = _worker_state['proxy']
+    accumulators = None
+    if proxy is not None:
+        accumulators = [proxy_score.ProxyAccumulator(proxy.get('max_frames', 50), proxy.get('max_points', 2000)) for _ in batch]
+    with instrument.profile(profile_path), instrument.span('generate.batch', emit_event=True, trials=trials):
+        paths = generate_rosbag.generate_many([(spoofer_x, spoofer_y) for _, spoofer_x, spoofer_y, _ in batch],
+                                              _worker_state['reference_index'], _worker_state['params'],
+                                              output_bag_paths=[generate_rosbag.trial_bag_path(output_bag, trial) for trial in trials],
+                                              seeds=[seed for _, _, _, seed in batch], config=_worker_state['config'],
+                                              lidar_filters=None if stages is None else [stage.process_raw for stage in stages],
+                                              proxy_accumulators=accumulators)
+    if stages is not None:
+        for trial, stage in zip(trials, stages):
+            instrument.emit('defense', trial=trial, **stage.report())
+    scores = [None] * len(paths) if accumulators is None else [accumulator.score() for accumulator in accumulators]
+    # フレーム毎のspan/カウンタはbatch毎に1行にまとめて書く
+    instrument.flush(trials=trials)
+    return [(trial, path, score) for (trial, _, _, _), path, score in zip(batch, paths, scores)]
+
+def max_parallel_trials(input_bag, output_dir, requested=None, margin=1.2, bags_per_task=1, held_bags=0):
+    # CPUコア数と空きディスク容量 (出力bag 1つ ≒ 入力bagサイズ) で上限を決める
+    # held_bags : 生成後に呼び出し側がSLAMの実行待ち/実行中として持っておくbagの最大数 (この分の容量は生成に使わない)
+    cores = os.cpu_count() or 1
+    bag_size = max(Path(input_bag).stat().st_size, 1)
+    free = shutil.disk_usage(output_dir).free
+    disk_slots = int((free // (bag_size * margin) - held_bags) // bags_per_task)
+    if disk_slots < 1:
+        raise RuntimeError(f"not enough disk space in {output_dir} for {bags_per_task} output bag(s) "
+                           f"and {held_bags} bag(s) waiting for SLAM ({bag_size} bytes each)")
+
+    n_workers = min(cores, disk_slots)
+    if requested is not None:
+        n_workers = min(n_workers, int(requested))
+    return max(n_workers, 1)
+
+def generate_trials(trials, reference_index, params, input_bag, output_bag, max_workers=None, keep_bags=False, batch_size=1,
+                    proxy=None, profile_dir=None, config=None, held_bags=0):
+    """
+    trials : [(trial, spoofer_x, spoofer_y, seed), ...]
+    生成が終わったbagから順に (trial, bag_path, proxy_score) をyieldする
+    proxy : {'max_frames': ..., 'max_points': ...} を渡すと生成中にproxy_score.ProxyScoreも計算する (Noneならscore=None)
+    worker processも呼び出し側と同じinstrumentの出力先に書く。profile_dirを渡すとbatch毎のcProfileを保存する
+    config : generate_rosbag.generate_manyへ渡す (Noneならworkerがconfig_temp.jsonを読む)
+    呼び出し側 (SLAM) が処理を終えて次を要求した時点でbagを削除し、次の試行を投入する
+    batch_size > 1 の場合はbatch_size個の試行を入力bag 1回の読み込みでまとめて生成する (generate_many)
+    held_bags : keep_bags=Trueで呼び出し側が同時に持つbagの最大数 (SLAMの並列数)。ディスクの上限から差し引く
+    """
+    n_workers = max_parallel_trials(input_bag, Path(output_bag).parent, max_workers, bags_per_task=batch_size, held_bags=held_bags)
+    # 生成中 + SLAM処理中のタスク数をn_workers (<= ディスク上限) に抑える
+    # SLAMが1コアを使うので、その間の生成はn_workers - 1並列になる
+    max_in_flight = n_workers
+    trials = list(trials)
+    pending_batches = [trials[i:i + batch_size] for i in range(0, len(trials), batch_size)][::-1]
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                             initargs=(reference_index, params, proxy, instrument.settings(), profile_dir, config)) as pool:
+        running = set()
+
+        def submit_next():
+            while pending_batches and len(running) < max_in_flight:
+                running.add(pool.submit(_generate_batch, pending_batches.pop(), output_bag))
+
+        submit_next()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.remove(future)
+                for trial, bag_path, score in future.result():
+                    yield trial, bag_path, score
+
+                    if not keep_bags:
+                        bag_path.unlink(missing_ok=True)
+                submit_next()
+
+def _replay_batch(batch, kiss_config):
+    # batch : [(trial, spoofer_x, spoofer_y, seed), ...] をbagを書かずにKISS-ICPへ流す
+    trials = [trial for trial, _, _, _ in batch]
+    stages = defense.stages_from_config(_worker_state['config'], len(batch))
+    start = time.perf_counter()
+    with instrument.span('replay.batch', emit_event=True, trials=trials):
+        trajectories = inprocess_slam.run_trials([(spoofer_x, spoofer_y) for _, spoofer_x, spoofer_y, _ in batch],
+                                                 _worker_state['reference_index'], _worker_state['params'],
+                                                 seeds=[seed for _, _, _, seed in batch], config_file=kiss_config, threads=1,
+                                                 stages=stages)
+    elapsed = (time.perf_counter() - start) / len(batch)
+    if stages is not None:
+        for trial, stage in zip(trials, stages):
+            instrument.emit('defense', trial=trial, **stage.report())
+    instrument.flush(trials=trials)
+    return [(trial, trajectory, elapsed) for trial, trajectory in zip(trials, trajectories)]
+
+def replay_trials(trials, reference_index, params, max_workers=None, batch_size=1, kiss_config=None):
+    """
+    generate_trialsのin-process KISS-ICP版 (bagを書かない)
+    終わったbatchから順に (trial, TUM配列 (N, 8), 1試行あたりの処理時間 [sec]) をyieldする
+    ディスクを使わないのでworker数はCPUコア数だけで決め、各workerのICPは1スレッドにする
+    KISS-ICP (TBB) のスレッドを作った後のforkは固まることがあるので、workerはspawnで起動する
+    """
+    n_workers = os.cpu_count() or 1
+    if max_workers is not None:
+        n_workers = min(n_workers, int(max_workers))
+    trials = list(trials)
+    batches = [trials[i:i + batch_size] for i in range(0, len(trials), batch_size)]
+
+    with ProcessPoolExecutor(max_workers=max(n_workers, 1), mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker,
+                             initargs=(reference_index, params, None, instrument.settings(), None)) as pool:
+        running = {pool.submit(_replay_batch, batch, kiss_config) for batch in batches}
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
@@ -0,0 +1,76 @@
+"""
+campaign seedから試行/spoofer配置/フレーム毎の乱数列を作る (np.random.SeedSequenceのspawn木)
+
+  campaign seed
+  ├ [campaign, BATCH, k]     batch_placement_rng(campaign, k) : 試行をまとめて配置する場合 (stratified/lhs/adaptive)
+  └ trial i                  trial_seed(campaign, i)  : 結果のCSVに記録するint
+     ├ PLACEMENT             placement_rng(trial_seed) : 基準軌跡上の位置とspooferの向き
+     └ SPOOFING              spoofing_sequence(trial_seed)
+        └ frame j            frame_rng(spoofing_sequence, j)
+
+各ノードは親と番号だけで決まるので、1試行だけ/1フレームだけを順不同に再現できる
+"""
+import numpy as np
+
+# default modules
+import dataclasses
+
+PLACEMENT = 0
+SPOOFING = 1
+BATCH = 2
+
+def child_sequence(seed_sequence, *key):
+    # seed_sequence.spawn(n)[key] と同じ (他の子を作らずに直接求める)
+    return np.random.SeedSequence(seed_sequence.entropy, spawn_key=seed_sequence.spawn_key + key,
+                                  pool_size=seed_sequence.pool_size)
+
+# 生成されるbagに影響するrosbagの設定 (frame_workers/queue_size/frame_cache_dirは結果を変えない)
+GENERATION_KEYS = ('spoofing_mode', 'distance_threshold', 'organized_scan', 'lidar_topic', 'imu_topic')
+
+def campaign_settings(config, params, algorithms):
+    """
+    seedを指定しない場合に前回のcampaignを探すための設定 (試行の結果に影響するものだけ)
+    params : spoofing_sim.SimulationParams
+    main.trials/n_simulations、worker数/trace/profile/timeout/並列数、proxyなどは含めない (変えても同じcampaignで再開する)
+    """
+    settings = {
+        'input_bag': str(config['rosbag']['input_bag']),
+        'reference_file': str(config['main']['reference_file']),
+        'params': dataclasses.asdict(params),
+        'rosbag': {key: config['rosbag'].get(key) for key in GENERATION_KEYS},
+        'spoofer': config['spoofer'],
+        'algorithms': sorted(algorithms),
+        'inprocess_kiss': bool(config['slam'].get('inprocess_kiss', False)),
+    }
+    # adaptiveサンプリングの配置はsuccess_thresholdに依る
+    if config['spoofer'].get('sampling', 'random') == 'adaptive':
+        settings['success_threshold'] = float(config['evaluation']['success_threshold'])
+    # defenseは有効にした場合だけ含める (sweep.generation_inputsと同じ)
+    if config.get('defense', {}).get('enabled', False):
+        settings['defense'] = config['defense']
+    return settings
+
+def campaign_seed(seed=None):
+    # Noneなら新しいentropyを作る (表示/記録しておけば後から同じcampaignを再現できる)
+    return int(np.random.SeedSequence(seed).entropy)
+
+def trial_seed(campaign, trial):
+    return int(child_sequence(np.random.SeedSequence(campaign), trial).generate_state(1, np.uint64)[0])
+
+def trial_seeds(campaign, n_trials):
+    return [trial_seed(campaign, trial) for trial in range(n_trials)]
+
+def placement_rng(seed):
+    return np.random.default_rng(child_sequence(np.random.SeedSequence(seed), PLACEMENT))
+
+def batch_placement_rng(campaign, batch=0):
+    # 試行の木とは別のentropyから作る (trial_seedと重ならない)
+    return np.random.default_rng(np.random.SeedSequence([campaign, BATCH, batch]))
+
+def spoofing_sequence(seed):
+    # seed=Noneなら毎回違う乱数列 (再現不要な単発実行用)
+    return child_sequence(np.random.SeedSequence(seed), SPOOFING)
+
+def frame_rng(seed_sequence, frame_index):
+    # フレームを別スレッドで順不同に処理しても結果が変わらない
+    return np.random.default_rng(child_sequence(seed_sequence, frame_index))
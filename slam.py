@@ -1,58 +1,284 @@
 import subprocess
 
-def run_slam(algorithm='kiss_icp', bag_path='', topic='/velodyne_points', save_dir='', rosbag_rate='2.0', visualize=True):
+# default modules
+import functools
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+# load external files
+import instrument
+import trajectory_monitor
+
+# algorithm -> slamspoofパッケージのlaunchファイル (既定値)
+# それ以外 (direct_lio/glimなど) や名前の違うlaunchはconfigのslam.launch_filesで指定する (launch_files(config))
+LAUNCH_FILES = {
+    'kiss_icp': "slam_test_kiss.launch",
+    'fast_lio': "slam_test_flio.launch",
+}
+
+# launchファイルを持つROSパッケージ
+ROS_PACKAGE = "slamspoof"
+
+# launchファイルから参照されるパラメータファイル (ディレクトリが指定されていれば直下のこれらのファイル)
+PARAMETER_SUFFIXES = ('.json', '.yaml', '.yml', '.lua', '.launch', '.xml')
+
+# IMUを使うアルゴリズム (launchにimu_topicを渡す)
+IMU_ALGORITHMS = ('fast_lio', 'direct_lio', 'glim')
+
+# SLAMノードが書き出す推定軌跡 (name_traj_dir以下)
+TRAJECTORY_FILE = "temp.txt"
+
+DEFAULT_MASTER_PORT = 11311
+
+def launch_files(config):
+    # LAUNCH_FILESをslam.launch_files ({algorithm: launchファイル名}) で上書きしたもの
+    return dict(LAUNCH_FILES, **(config['slam'].get('launch_files') or {}))
+
+def configured_algorithms(config, algorithms=None):
+    # slam.algorithm : アルゴリズム名かそのリスト (00_mainとsweepで同じ既定値を使う)
+    # algorithmsを渡せばslam.algorithmの代わりに使う (sweep.algorithms)。launchファイルが決まらなければValueError
+    if not algorithms:
+        algorithms = config['slam']['algorithm']
+    algorithms = [algorithms] if isinstance(algorithms, str) else list(algorithms)
+    files = launch_files(config)
+    unknown = [algorithm for algorithm in algorithms if not files.get(algorithm)]
+    if unknown:
+        raise ValueError(f"no launch file for SLAM algorithm {unknown}: set slam.launch_files")
+    return algorithms
+
+@functools.lru_cache(maxsize=None)
+def find_ros_package(name):
+    # rospack findと同じ場所 (見つからなければNone)。rospackが無ければROS_PACKAGE_PATH以下のpackage.xmlを探す
+    try:
+        result = subprocess.run(["rospack", "find", name], capture_output=True, text=True, timeout=30)
+        if result.returncode == 0 and result.stdout.strip():
+            return Path(result.stdout.strip())
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+    for root in filter(None, os.environ.get('ROS_PACKAGE_PATH', '').split(os.pathsep)):
+        for package_xml in sorted(Path(root).glob("**/package.xml")):
+            if re.search(rf"<name>\s*{re.escape(name)}\s*</name>", package_xml.read_text(errors='ignore')):
+                return package_xml.parent
+    return None
+
+def launch_file_path(algorithm, launch_files=None):
+    # roslaunchと同じくパッケージ以下からlaunchファイルを探す (見つからなければNone)
+    launch_files = LAUNCH_FILES if launch_files is None else launch_files
+    package = find_ros_package(ROS_PACKAGE)
+    if package is None or not launch_files.get(algorithm):
+        return None
+    return next(iter(sorted(package.glob(f"**/{launch_files[algorithm]}"))), None)
+
+def launch_dependencies(algorithm, launch_files=None):
+    """
+    launchファイルと、そこから$(find パッケージ)/... で参照されるinclude/パラメータファイル (benign軌跡のcache key用)
+    $(arg ...) など実行時まで決まらないパスは含めない。launchファイルが見つからなければ空
+    """
+    launch_path = launch_file_path(algorithm, launch_files)
+    if launch_path is None:
+        return []
+
+    files = []
+    pending = [launch_path]
+    while pending:
+        path = pending.pop()
+        if path in files:
+            continue
+        files.append(path)
+        if path.suffix not in ('.launch', '.xml'):
+            continue
+        for value in re.findall(r'"([^"]*)"', path.read_text(errors='ignore')):
+            for package_name in set(re.findall(r"\$\(find ([^)\s]+)\)", value)):
+                package = find_ros_package(package_name)
+                if package is not None:
+                    value = value.replace(f"$(find {package_name})", str(package))
+            if "$(" in value or not os.path.isabs(value):
+                continue
+            target = Path(value)
+            if target.is_file() and target.suffix in PARAMETER_SUFFIXES:
+                pending.append(target)
+            elif target.is_dir():
+                pending.extend(sorted(p for p in target.iterdir() if p.is_file() and p.suffix in PARAMETER_SUFFIXES))
+    return sorted(files)
+
+def build_command(algorithm, bag_path, topic, save_dir, rosbag_rate, visualize, imu_topic=None, port=None, launch_files=None):
+    launch_files = LAUNCH_FILES if launch_files is None else launch_files
+    if not launch_files.get(algorithm):
+        raise ValueError(f"no launch file for SLAM algorithm: {algorithm}")
+
+    cmd = [
+        "roslaunch",
+        ROS_PACKAGE,
+        launch_files[algorithm],
+        f"bagfile:={bag_path}",
+        f"topic:={topic}",
+        # launch側でname_traj_dir + "temp.txt"としているので末尾の/を付ける
+        f"name_traj_dir:={os.path.join(str(save_dir), '')}",
+        f"rosbag_rate:={rosbag_rate}",
+        f"visualize:={'true' if visualize else 'false'}"
+    ]
+    if imu_topic is not None and algorithm in IMU_ALGORITHMS:
+        cmd.append(f"imu_topic:={imu_topic}")
+    if port is not None:
+        # 起動するroscoreのポート
+        cmd[1:1] = ["-p", str(port)]
+    return cmd
+
+def fake_slam_command(source_trajectory):
+    """
+    roslaunchの代わりに既存の軌跡をコピーするだけのコマンド (ROSの無い環境での動作確認用)
+    SlamRunner(command_builder=fake_slam_command(path)) のように使う (benchmark.py slam_runner)
+    """
+    def builder(algorithm, bag_path, topic, save_dir, rosbag_rate, visualize, imu_topic=None, port=None):
+        return [sys.executable, "-c", "import shutil, sys; shutil.copy(sys.argv[1], sys.argv[2])",
+                str(source_trajectory), str(Path(save_dir) / TRAJECTORY_FILE)]
+    return builder
+
+def run_slam(algorithm='kiss_icp', bag_path='', topic='/velodyne_points', save_dir='', rosbag_rate='2.0', visualize=True, imu_topic=None):
     """
     Pythonの変数をroslaunchの引数として渡して実行する
     """
-    if algorithm == 'kiss_icp':
-        
-        # 1. 使用するベースのlaunchファイルを選択
-        launch_file = "slam_test_kiss.launch"
-    
-        # 2. 基本コマンドの構成
-        cmd = [
-            "roslaunch", 
-            "slamspoof", 
-            launch_file,
-            f"bagfile:={bag_path}",
-            f"topic:={topic}",
-            f"name_traj_dir:={save_dir}",
-            f"rosbag_rate:={rosbag_rate}",
-            f"visualize:={'true' if visualize else 'false'}"
-        ]
-
-        print(f"\n--- SLAM開始 ({algorithm}) ---")
-        print(f"実行コマンド: {' '.join(cmd)}")
-        
+    cmd = build_command(algorithm, bag_path, topic, save_dir, rosbag_rate, visualize, imu_topic)
+
+    print(f"\n--- SLAM開始 ({algorithm}) ---")
+    print(f"実行コマンド: {' '.join(cmd)}")
+
+    try:
+        # check=Trueでエラー時に例外を投げる
+        subprocess.run(cmd, check=True)
+        print("--- SLAM正常終了 ---")
+    except subprocess.CalledProcessError as e:
+        print(f"SLAM実行中にエラーが発生しました (Exit code: {e.returncode})")
+    except Exception as e:
+        print(f"予期せぬエラー: {e}")
+
+@dataclass
+class SlamResult:
+    algorithm: str
+    bag_path: Path
+    trajectory: Path     # save_dir/temp.txt
+    log_path: Path
+    returncode: int
+    elapsed: float       # sec
+    timed_out: bool
+    stopped: str = None  # 監視で途中で止めた理由 (trajectory_monitor.SUCCESS / STALLED)、最後まで実行した場合はNone
+
+    @property
+    def ok(self):
+        # 成功が決まって止めた場合は途中までの軌跡で評価する
+        if self.stopped == trajectory_monitor.SUCCESS:
+            return self.trajectory.exists()
+        return self.returncode == 0 and not self.timed_out and self.stopped is None and self.trajectory.exists()
+
+class SlamRunner:
+    """
+    複数のroslaunchを同時に実行する
+    各インスタンスは別ポートのROS master (ROS_MASTER_URI) と別の出力ディレクトリを使う
+    submit() はconcurrent.futures.Futureを返す (結果はSlamResult)
+    実行中はtemp.txtをpoll_interval毎に読み (trajectory_monitor)、次の場合はroslaunchを途中で止める
+      submit(ground_truth=benign軌跡) かつsuccess_thresholdがある : RPEがsuccess_thresholdを超えた (攻撃成功が確定)
+      stall_timeout : 新しい姿勢がstall_timeout秒書かれない (SLAMノードの異常終了/停止)
+    """
+    def __init__(self, max_parallel=1, base_port=DEFAULT_MASTER_PORT + 100, timeout=None, command_builder=None,
+                 success_threshold=None, stall_timeout=None, poll_interval=1.0, launch_files=None):
+        self.max_parallel = max_parallel
+        self.timeout = timeout
+        # command_builderを渡さなければroslaunch (launch_files : launch_files(config)、NoneならLAUNCH_FILES)
+        if command_builder is None:
+            command_builder = functools.partial(build_command, launch_files=launch_files)
+        self.command_builder = command_builder
+        self.success_threshold = success_threshold
+        self.stall_timeout = stall_timeout
+        self.poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_parallel)
+        self._ports = list(range(base_port, base_port + max_parallel))
+        self._ports_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def submit(self, algorithm, bag_path, topic, save_dir, rosbag_rate='2.0', visualize=False, imu_topic=None, timeout=None,
+               ground_truth=None):
+        timeout = self.timeout if timeout is None else timeout
+        return self._executor.submit(self._run, algorithm, Path(bag_path), topic, Path(save_dir),
+                                     rosbag_rate, visualize, imu_topic, timeout, ground_truth)
+
+    def _run(self, algorithm, bag_path, topic, save_dir, rosbag_rate, visualize, imu_topic, timeout, ground_truth=None):
+        save_dir.mkdir(parents=True, exist_ok=True)
+        trajectory = save_dir / TRAJECTORY_FILE
+        trajectory.unlink(missing_ok=True)
+        log_path = save_dir / "slam.log"
+
+        with self._ports_lock:
+            port = self._ports.pop()
         try:
-            # check=Trueでエラー時に例外を投げる
-            subprocess.run(cmd, check=True)
-            print("--- SLAM正常終了 ---")
-        except subprocess.CalledProcessError as e:
-            print(f"SLAM実行中にエラーが発生しました (Exit code: {e.returncode})")
-        except Exception as e:
-            print(f"予期せぬエラー: {e}")
-
-    elif algorithm == 'fast_lio':
-
-        launch_file = "slam_test_flio.launch"
-
-        cmd = [
-            "roslaunch", 
-            "slamspoof", 
-            launch_file,
-            f"bagfile:={bag_path}",
-            f"topic:={topic}",
-            f"name_traj_dir:={save_dir}",
-            f"rosbag_rate:={rosbag_rate}",
-            f"visualize:={'true' if visualize else 'false'}"
-        ]
+            cmd = self.command_builder(algorithm, bag_path, topic, save_dir, rosbag_rate, visualize, imu_topic, port)
+            env = dict(os.environ, ROS_MASTER_URI=f"http://localhost:{port}", ROS_LOG_DIR=str(save_dir / "ros_log"))
+
+            monitor = None
+            if self.stall_timeout is not None or (ground_truth is not None and self.success_threshold is not None):
+                monitor = trajectory_monitor.TrajectoryMonitor(trajectory, ground_truth, self.success_threshold, self.stall_timeout)
 
+            start = time.time()
+            with open(log_path, 'w') as log:
+                log.write(f"{' '.join(map(str, cmd))}\n")
+                log.flush()
+                # プロセスグループごと止められるように新しいセッションで起動する
+                process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env, start_new_session=True)
+                returncode, timed_out, stopped = self._wait(process, timeout, monitor)
+                if stopped is not None:
+                    log.write(f"\nstopped by trajectory monitor: {stopped} (poses {len(monitor.rows)}, RPE {monitor.rpe}, APE {monitor.ape})\n")
+        finally:
+            with self._ports_lock:
+                self._ports.append(port)
+
+        result = SlamResult(algorithm, bag_path, trajectory, log_path, returncode, time.time() - start, timed_out, stopped)
+        instrument.emit('span', name='slam.run', duration=result.elapsed, algorithm=algorithm, bag=str(bag_path),
+                        returncode=returncode, timed_out=timed_out, stopped=stopped)
+        return result
+
+    def _wait(self, process, timeout, monitor):
+        # 終了/timeout/監視による停止まで待つ : (returncode, timed_out, stopped)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            interval = None if monitor is None else self.poll_interval
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0.0)
+                interval = remaining if interval is None else min(interval, remaining)
+            try:
+                return process.wait(timeout=interval), False, None
+            except subprocess.TimeoutExpired:
+                pass
+            if deadline is not None and time.monotonic() >= deadline:
+                return stop_process_group(process), True, None
+            if monitor is None:
+                continue
+            status = monitor.poll()
+            if status != trajectory_monitor.RUNNING:
+                return stop_process_group(process), False, status
+
+def stop_process_group(process, grace_period=10.0):
+    # roslaunchはSIGINTで子ノードを順に終了させる。応答が無ければSIGKILL
+    for sig in (signal.SIGINT, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            break
         try:
-            # check=Trueでエラー時に例外を投げる
-            subprocess.run(cmd, check=True)
-            print("--- SLAM正常終了 ---")
-        except subprocess.CalledProcessError as e:
-            print(f"SLAM実行中にエラーが発生しました (Exit code: {e.returncode})")
-        except Exception as e:
-            print(f"予期せぬエラー: {e}")
\ No newline at end of file
+            return process.wait(timeout=grace_period)
+        except subprocess.TimeoutExpired:
+            continue
+    return process.wait()
@@ -1,19 +1,150 @@
 import numpy as np
 
-import random
 import json
+from dataclasses import dataclass
 
-def decide_spoofer_placement(traj_x, traj_y, traj_z):
+SAMPLING_METHODS = ('random', 'stratified', 'lhs', 'adaptive')
+
+def decide_spoofer_placement(traj_x, traj_y, traj_z, rng=None):
 
     # load config
     with open('config_temp.json', 'r') as f:
         config = json.load(f)
 
     r = float(config['spoofer']['dist_from_traj'])
-    theta = random.uniform(-180, 180) # degree
+    # rng : seeding.placement_rng (Noneなら再現性なし)
+    if rng is None:
+        rng = np.random.default_rng()
+    theta = rng.uniform(-180, 180) # degree
 
     spoofer_x = traj_x + (r * np.cos(np.deg2rad(theta))) # spooferのx座標
     spoofer_y = traj_y + (r * np.sin(np.deg2rad(theta))) # spooferのy座標
     spoofer_z = traj_z # spooferのz座標
 
-    return spoofer_x, spoofer_y, spoofer_z
\ No newline at end of file
+    return spoofer_x, spoofer_y, spoofer_z
+
+@dataclass
+class Placements:
+    """
+    spoofer配置のbatch (各配列の長さ = 配置数)
+    unit : (n, 2) [0,1)の座標 (列0 = 軌跡上の位置, 列1 = spooferの向き)
+    weight : 一様サンプリング (decide_spoofer_placementと同じ分布) に対する重み。adaptive以外は1
+    """
+    unit: np.ndarray
+    index: np.ndarray   # 基準軌跡のindex
+    theta: np.ndarray   # degree
+    xyz: np.ndarray     # (n, 3)
+    frames: np.ndarray  # distance_threshold以内になるLiDARフレーム数
+    weight: np.ndarray
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def take(self, indices):
+        return Placements(*(getattr(self, name)[indices] for name in self.__dataclass_fields__))
+
+def unit_samples(n, rng, method='random'):
+    # (n, 2) の[0,1)サンプル。stratified/lhsは試行順に偏りが出ないよう並びをシャッフルする
+    if method == 'random':
+        return rng.random((n, 2))
+    if method == 'stratified':
+        # 軌跡をn区間に分けて各区間から1つ (向きは一様)
+        u = (np.arange(n) + rng.random(n)) / n
+        return np.column_stack((u, rng.random(n)))[rng.permutation(n)]
+    if method == 'lhs':
+        # Latin hypercube : 位置/向きの各軸をn等分し、各区間を1回ずつ使う
+        strata = np.column_stack((rng.permutation(n), rng.permutation(n)))
+        return (strata + rng.random((n, 2))) / n
+    raise ValueError(f"unknown sampling method: {method}")
+
+def resample_in_strata(unit, rng, method, n):
+    # unit (n個のうちの一部) を同じ層の中で引き直す
+    # stratified : 位置の区間は同じで向きは一様、lhs : 位置と向きの区間が同じ、random : 全体から
+    if method == 'random':
+        return rng.random(unit.shape)
+    low = np.floor(unit * n) / n
+    if method == 'stratified':
+        return np.column_stack((low[:, 0] + rng.random(unit.shape[0]) / n, rng.random(unit.shape[0])))
+    if method == 'lhs':
+        return low + rng.random(unit.shape) / n
+    raise ValueError(f"unknown sampling method: {method}")
+
+def frames_in_range(spoofer_xy, frame_xy, distance_threshold):
+    # 各spoofer候補からdistance_threshold以内 (check_spoofing_conditionと同じ<=) のLiDARフレーム数
+    # scipyは配置を決める時だけimportする (spawnのworkerは00_mainを読み直すので起動を遅くしない)
+    from scipy.spatial import cKDTree
+    return cKDTree(frame_xy).query_ball_point(spoofer_xy, distance_threshold, return_length=True)
+
+def place(unit, traj_x, traj_y, traj_z, r, frame_xy, distance_threshold, weight=None):
+    # unitサンプル -> 軌跡上のindexと向き -> spoofer位置 (decide_spoofer_placementと同じ式)
+    index = np.minimum((unit[:, 0] * traj_x.shape[0]).astype(np.int64), traj_x.shape[0] - 1)
+    theta = unit[:, 1] * 360.0 - 180.0
+    xyz = np.column_stack((traj_x[index] + r * np.cos(np.deg2rad(theta)),
+                           traj_y[index] + r * np.sin(np.deg2rad(theta)),
+                           traj_z[index]))
+    frames = frames_in_range(xyz[:, :2], frame_xy, distance_threshold)
+    if weight is None:
+        weight = np.ones(index.shape[0])
+    return Placements(unit, index, theta, xyz, frames, weight)
+
+def sample_placements(n, rng, traj_x, traj_y, traj_z, r, frame_xy, distance_threshold,
+                      method='random', min_frames=0, max_attempts=20):
+    """
+    n個のspoofer配置をまとめて作る (stratified/lhsは各層から1つずつ)
+    min_frames未満のフレームにしか届かない配置は同じ層の中で最大max_attempts回引き直す
+    (届かなければ引き直した中でフレーム数が最も多い配置を使う)
+    """
+    placements = place(unit_samples(n, rng, method), traj_x, traj_y, traj_z, r, frame_xy, distance_threshold)
+    for _ in range(max_attempts):
+        retry = np.flatnonzero(placements.frames < min_frames)
+        if retry.shape[0] == 0:
+            break
+        candidates = place(resample_in_strata(placements.unit[retry], rng, method, n),
+                           traj_x, traj_y, traj_z, r, frame_xy, distance_threshold)
+        better = candidates.frames > placements.frames[retry]
+        for name in placements.__dataclass_fields__:
+            getattr(placements, name)[retry[better]] = getattr(candidates, name)[better]
+    return placements
+
+def adaptive_unit_samples(n, rng, history_unit, history_rpe, success_threshold, rpe_scale=None,
+                          exploration=0.2, bandwidth=0.05):
+    """
+    過去の試行でRPEがsuccess_thresholdに近かった配置の周りを重点的にサンプリングする
+    提案分布 q = exploration * 一様 + (1 - exploration) * 過去の配置を中心とするGauss核の混合
+    戻り値 : (unit (n, 2), weight (n,) = 1 / q)  weightで成功率を重み付けすれば一様サンプリングの推定になる
+    """
+    history_unit = np.asarray(history_unit, dtype=np.float64).reshape(-1, 2)
+    history_rpe = np.asarray(history_rpe, dtype=np.float64)
+    valid = np.isfinite(history_rpe)
+    history_unit, history_rpe = history_unit[valid], history_rpe[valid]
+    if history_unit.shape[0] == 0:
+        return rng.random((n, 2)), np.ones(n)
+
+    if rpe_scale is None:
+        rpe_scale = 0.5 * success_threshold
+    score = np.exp(-0.5 * ((history_rpe - success_threshold) / rpe_scale) ** 2)
+    if score.sum() <= 0:
+        score = np.ones_like(score)
+    p = score / score.sum()
+
+    unit = rng.random((n, 2))
+    local = rng.random(n) >= exploration
+    parent = rng.choice(history_unit.shape[0], size=n, p=p)
+    offset = rng.normal(0.0, bandwidth, (n, 2))
+    u = np.abs(history_unit[parent, 0] + offset[:, 0]) # 軌跡の両端では折り返す
+    u = np.minimum(1.0 - np.abs(1.0 - u), np.nextafter(1.0, 0.0))
+    v = np.mod(history_unit[parent, 1] + offset[:, 1], 1.0) # 向きは周期的
+    unit[local] = np.column_stack((u, v))[local]
+
+    # 提案分布の密度 (位置は折り返し像を含める、向きはwrap)
+    du = unit[:, 0, None, None] - np.stack((history_unit[:, 0], -history_unit[:, 0], 2.0 - history_unit[:, 0]), axis=1)[None]
+    dv = np.mod(unit[:, 1, None] - history_unit[None, :, 1] + 0.5, 1.0) - 0.5
+    kernel = np.exp(-0.5 * (du / bandwidth) ** 2).sum(axis=2) * np.exp(-0.5 * (dv / bandwidth) ** 2) / (2 * np.pi * bandwidth ** 2)
+    density = exploration + (1.0 - exploration) * kernel @ p
+    return unit, 1.0 / density
+
+def weighted_success_rate(success, weight):
+    # adaptiveサンプリングの重みで補正した成功率 (重みが全て1なら単純な割合)
+    success = np.asarray(success, dtype=np.float64)
+    weight = np.asarray(weight, dtype=np.float64)
+    return float(np.sum(weight * success) / np.sum(weight))
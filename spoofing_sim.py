@@ -1,8 +1,59 @@
 #!/usr/bin/env python3
 
 import numpy as np
-import rospy
 import json
+from dataclasses import dataclass
+
+@dataclass(frozen=True)
+class SimulationParams:
+    """
+    spoofing_simulationの設定値 (1回の実行中は不変)
+    """
+    spoofing_range: float       # degree
+    static_wall_dist: float     # m
+    injection_mode: str         # 'wall' or 'corner'
+    corner_rotation: float      # degree
+    minimum_distance: float     # m (dynamic_injection)
+    maximum_distance: float     # m (dynamic_injection)
+    time_cycle: float           # sec (dynamic_injection)
+    horizontal_resolution: float
+    vertical_lines: int
+    spoofing_rate: float
+
+    def __post_init__(self):
+        if not 0.0 < self.spoofing_range <= 360.0:
+            raise ValueError(f"spoofing_range must be in (0, 360]: {self.spoofing_range}")
+        if self.injection_mode not in ('wall', 'corner'):
+            raise ValueError(f"unknown injection_mode: {self.injection_mode}")
+        if self.minimum_distance > self.maximum_distance:
+            raise ValueError("minimum_distance must not exceed maximum_distance")
+        if self.time_cycle <= 0 or self.horizontal_resolution <= 0 or self.vertical_lines <= 0:
+            raise ValueError("time_cycle, horizontal_resolution and vertical_lines must be positive")
+        if self.spoofing_rate < 0:
+            raise ValueError(f"spoofing_rate must be non-negative: {self.spoofing_rate}")
+
+def load_params(config, simulator_config_path='config.json'):
+    # configはconfig_temp.jsonの内容
+    # simulatorセクションが無ければ旧来のconfig.jsonから読む
+    sim = config['spoofing_simulation']
+    if 'simulator' in config:
+        simulator = config['simulator']
+    else:
+        with open(simulator_config_path, 'r') as f:
+            simulator = json.load(f)['simulator']
+
+    return SimulationParams(
+        spoofing_range=float(sim['spoofing_range']),
+        static_wall_dist=float(sim['static_wall_dist']),
+        injection_mode=str(sim['injection_mode']),
+        corner_rotation=float(sim['corner_rotation']),
+        minimum_distance=float(sim['minimum_distance']),
+        maximum_distance=float(sim['maximum_distance']),
+        time_cycle=float(sim['time_cycle']),
+        horizontal_resolution=float(simulator['horizontal_resolution']),
+        vertical_lines=int(simulator['vertical_lines']),
+        spoofing_rate=float(simulator['spoofing_rate']),
+    )
 
 def cartesian2polar(x, y):
     r = (x ** 2 + y ** 2) ** 0.5
@@ -18,197 +69,203 @@ def removal_simulation(raw_points, mask_index):
     removed_points = np.delete(raw_points, list(mask_index[0]))
     return removed_points
 
-def set_distance(timestamp):
-
-    with open('config_temp.json', 'r') as f:
-        config = json.load(f)
-
-    minimum_distance = config['spoofing_simulation']['minimum_distance']
-    maximum_distance = config['spoofing_simulation']['maximum_distance']
-    time_cycle = config['spoofing_simulation']['time_cycle']
+def set_distance(timestamp, params):
+    minimum_distance = params.minimum_distance
+    maximum_distance = params.maximum_distance
+    time_cycle = params.time_cycle
 
     f_t = (((maximum_distance - minimum_distance) / time_cycle) * (timestamp % time_cycle)) + minimum_distance
     return f_t
 
-def noise_simulation(raw_points, largest_score_angle, spoofing_range):
-    rng = np.random.default_rng() 
-    with open('config.json', 'r') as f:
-        config = json.load(f)
-
-    horizontal_resolution = config['simulator']['horizontal_resolution']
-    vertical_lines = config['simulator']['vertical_lines']
-    spoofing_rate = config['simulator']['spoofing_rate']
+def sector_mask(raw_points, largest_score_angle, spoofing_range):
+    # 方位角が largest_score_angle ± spoofing_range/2 (degree) に入る点
+    # arctan2を使わず中心方向との内積で判定するので±180をまたぐ範囲もそのまま扱える
+    # x = y = 0 の点 (無効点/真上真下) は方位角が無いので含めない
+    x, y = raw_points[:, 0], raw_points[:, 1]
+    half_range = np.radians(spoofing_range / 2)
+    r2 = x * x + y * y
+    if half_range >= np.pi:
+        return r2 > 0
+
+    center = np.radians(largest_score_angle)
+    dot = x * np.float32(np.cos(center)) + y * np.float32(np.sin(center))
+    cos_half = np.float32(np.cos(half_range))
+    limit = r2 * (cos_half * cos_half)
+
+    # cos(angle) >= cos_half を二乗で比較する
+    if cos_half >= 0:
+        return (dot >= 0) & (dot * dot >= limit) & (r2 > 0)
+    return ((dot >= 0) | (dot * dot <= limit)) & (r2 > 0)
+
+def uniform_float32(rng, low, high, size):
+    return rng.random(size, dtype=np.float32) * np.float32(high - low) + np.float32(low)
+
+def polar_points(r, theta, z):
+    # r, theta (degree), z -> (N, 3) float32
+    theta_rad = np.radians(theta, dtype=np.float32)
+    points = np.empty((r.shape[0], 3), dtype=np.float32)
+    np.multiply(r, np.cos(theta_rad), out=points[:, 0])
+    np.multiply(r, np.sin(theta_rad), out=points[:, 1])
+    points[:, 2] = z
+    return points
+
+def noise_simulation(raw_points, largest_score_angle, params, rng=None):
+    if rng is None:
+        rng = np.random.default_rng() 
+
+    spoofing_range = params.spoofing_range
+    horizontal_resolution = params.horizontal_resolution
+    vertical_lines = params.vertical_lines
+    spoofing_rate = params.spoofing_rate
 
     temp_min = largest_score_angle - (spoofing_range / 2) 
     temp_max = largest_score_angle + (spoofing_range / 2) 
 
-    min, max = temp_min, temp_max
-
-    r, theta = cartesian2polar(raw_points[:, 0], raw_points[:, 1]) 
-
-    # theta : -180 ~ 180 (deg)
-    z = raw_points[:, 2]
-
-    mask = ((min <= theta) & (theta <= max)) 
-
-    r_deleted = r[~mask]
-    theta_deleted = theta[~mask]
-    z_deleted = z[~mask]
+    mask = sector_mask(raw_points, largest_score_angle, spoofing_range)
 
     num_spoofed_points = int((spoofing_range / horizontal_resolution) * vertical_lines * spoofing_rate)
 
-    r_noise = rng.uniform(0.0, 200.0, num_spoofed_points)
-    theta_noise = rng.uniform(temp_min, temp_max, num_spoofed_points)
-    z_noise = r_noise * np.sin(np.degrees(rng.uniform(-15.0, 15.0, num_spoofed_points)))
-
-    # raw points
-    x_remaining, y_remaining = polar2cartesian(r_deleted, theta_deleted)
-    points_remaining = np.vstack((x_remaining, y_remaining, z_deleted)).T
+    r_noise = uniform_float32(rng, 0.0, 200.0, num_spoofed_points)
+    theta_noise = uniform_float32(rng, temp_min, temp_max, num_spoofed_points)
+    z_noise = r_noise * np.sin(np.degrees(uniform_float32(rng, -15.0, 15.0, num_spoofed_points)))
 
     # spoofed points
-    x_spoofed, y_spoofed = polar2cartesian(r_noise, theta_noise)
-    points_spoofed = np.vstack((x_spoofed, y_spoofed, z_noise)).T
+    points_spoofed = polar_points(r_noise, theta_noise, z_noise)
    
-    return points_remaining, points_spoofed
+    return ~mask, points_spoofed
 
 def defenced(raw_points, largest_score_angle, spoofing_range):
+    mask = sector_mask(raw_points, largest_score_angle, spoofing_range)
+    remaining = raw_points[~mask]
+    return remaining[:, 0], remaining[:, 1], remaining[:, 2]
 
-    temp_min = largest_score_angle - (spoofing_range / 2) 
-    temp_max = largest_score_angle + (spoofing_range / 2) 
-
-    min, max = temp_min, temp_max
-
-    r, theta = cartesian2polar(raw_points[:, 0], raw_points[:, 1]) 
-
-    # theta : -180 ~ 180 (deg)
-    z = raw_points[:, 2]
-
-    mask = ((min <= theta) & (theta <= max)) 
-
-    r_deleted = r[~mask]
-    theta_deleted = theta[~mask]
-    z_deleted = z[~mask]
-
-    x_deleted, y_deleted = polar2cartesian(r_deleted, theta_deleted)
-
-    return x_deleted, y_deleted, z_deleted
-
-def injection_simulation(raw_points, largest_score_angle, spoofing_range, injection_dist):
-    rng = np.random.default_rng()
-
-    with open('config_temp.json', 'r') as f:
-        config = json.load(f)
+def injection_simulation(raw_points, largest_score_angle, injection_dist, params, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    spoofing_range = params.spoofing_range
 
     temp_min = largest_score_angle - (spoofing_range / 2) 
     temp_max = largest_score_angle + (spoofing_range / 2) 
 
-    if temp_min < 0: 
-        min = 360 - temp_min
-        max = temp_max
-
-    elif temp_max > 360: 
-        min = temp_min
-        max = temp_max - 360
-
-    else: 
-        min = temp_min
-        max = temp_max
-
-    r, theta = cartesian2polar(raw_points[:, 0], raw_points[:, 1])
-    z = raw_points[:, 2]
-    mask = ((min <= theta) & (theta <= max)) 
-
-    r_deleted = r[~mask]
-    theta_deleted = theta[~mask]
-    z_deleted = z[~mask]
+    mask = sector_mask(raw_points, largest_score_angle, spoofing_range)
 
     horizontal_resolution = 0.2
     vertical_lines = 32
     n_injection = int((spoofing_range / horizontal_resolution) * vertical_lines)  
     #vertical_angle_canditate = [-15, -13, -11, -9, -7, -5, -3, -1, 1, 3, 5, 7, 9, 11, 13, 15] 
-    vertical_angle_canditate = [-1.333, -1.0, -0.667, -0.333, 0, 0.333, 0.667, 1.0, 1.333]
+    vertical_angle_canditate = np.array([-1.333, -1.0, -0.667, -0.333, 0, 0.333, 0.667, 1.0, 1.333], dtype=np.float32)
 
-    if config['spoofing_simulation']['injection_mode'] == 'wall':
-        r_wall = np.full(n_injection, injection_dist)
-        theta_wall = rng.uniform(temp_min, temp_max, n_injection) # Unit : degree
+    r_wall = np.full(n_injection, injection_dist, dtype=np.float32)
+    theta_wall = uniform_float32(rng, temp_min, temp_max, n_injection) # Unit : degree
 
-    elif config['spoofing_simulation']['injection_mode'] == 'corner':
-        r_wall = np.full(n_injection, injection_dist)
-        theta_wall = rng.uniform(temp_min, temp_max, n_injection) # Unit : degree
-        rotation = float(config['spoofing_simulation']['corner_rotation'])
+    if params.injection_mode == 'corner':
+        rotation = params.corner_rotation
 
         theta_wall_rad = np.radians(theta_wall)
-        center_angle = (np.min(theta_wall_rad) + np.max(theta_wall_rad)) / 2 + np.radians(rotation)
+        center_angle = (np.min(theta_wall_rad) + np.max(theta_wall_rad)) / 2 + np.float32(np.radians(rotation))
 
-        theta_wall_rad = np.radians(theta_wall)
         r_wall = r_wall/(np.abs(np.cos(theta_wall_rad - center_angle)) + np.abs(np.sin(theta_wall_rad - center_angle)))
 
-    else:
-        r_wall = np.full(n_injection, injection_dist)
-        theta_wall = rng.uniform(temp_min, temp_max, n_injection) # Unit : degree
-
     #theta_wall_rad = np.radians(theta_wall)
 
     #r_wall = r_wall * (1+0.2*np.sin(8*theta_wall_rad))
 
-    vertical_angle_wall = np.random.choice(vertical_angle_canditate, size=n_injection, replace=True)
+    vertical_angle_wall = rng.choice(vertical_angle_canditate, size=n_injection, replace=True)
     z_wall = r_wall * np.sin(np.degrees(vertical_angle_wall))
     
-    # raw points
-    x_remaining, y_remaining = polar2cartesian(r_deleted, theta_deleted)
-    points_remaining = np.vstack((x_remaining, y_remaining, z_deleted)).T
-
     # spoofed points
-    x_spoofed, y_spoofed = polar2cartesian(r_wall, theta_wall)
-    points_spoofed = np.vstack((x_spoofed, y_spoofed, z_wall)).T
+    points_spoofed = polar_points(r_wall, theta_wall, z_wall)
    
-    return points_remaining, points_spoofed
+    return ~mask, points_spoofed
 
 def decide_mask(horizontal_angle, largest_score_angle, spoofing_range):
-    temp_min = largest_score_angle - (spoofing_range / 2) 
-    temp_max = largest_score_angle + (spoofing_range / 2) 
-    if temp_min < 0: 
-        min = 360 - temp_min
-        spoofing_condition = ((min <= horizontal_angle) | (horizontal_angle <= temp_max))
+    # horizontal_angle (degree) が largest_score_angle ± spoofing_range/2 に入るか (360度で折り返す)
+    offset = np.mod(horizontal_angle - (largest_score_angle - spoofing_range / 2), 360)
+    return offset <= spoofing_range
+
+class ScanGeometry:
+    """
+    organizedな点群 (rings x columns) の列毎の方位角と ring毎の仰角
+    列の方位角はセンサ座標系で固定なので、bagの最初のフレームから1回だけ求める
+    """
+    def __init__(self, column_azimuth, ring_elevation):
+        self.column_azimuth = column_azimuth    # (W,) degree
+        self.ring_elevation = ring_elevation    # (H,) rad
+
+    @classmethod
+    def from_points(cls, xyz):
+        # xyz : (H, W, 3)、無効点 (0, 0, 0) は除く
+        x, y, z = (xyz[..., i].astype(np.float64) for i in range(3))
+        horizontal = np.hypot(x, y)
+        valid = horizontal > 0
+
+        column_azimuth = np.degrees(np.arctan2(np.where(valid, y / np.where(valid, horizontal, 1), 0).sum(axis=0),
+                                               np.where(valid, x / np.where(valid, horizontal, 1), 0).sum(axis=0)))
+
+        elevation = np.where(valid, np.arctan2(z, horizontal), np.nan)
+        ring_elevation = np.full(xyz.shape[0], np.nan)
+        has_return = valid.any(axis=1)
+        ring_elevation[has_return] = np.nanmedian(elevation[has_return], axis=1)
+        # 反射の無かったringは前後のringから補間する
+        rings = np.arange(xyz.shape[0])
+        if has_return.any():
+            ring_elevation = np.interp(rings, rings[has_return], ring_elevation[has_return])
+        else:
+            ring_elevation = np.zeros(xyz.shape[0])
+        return cls(column_azimuth, ring_elevation)
+
+    def sector_columns(self, largest_score_angle, spoofing_range):
+        # spoofing範囲に入る列のindex
+        return np.flatnonzero(decide_mask(self.column_azimuth, largest_score_angle, spoofing_range))
+
+def organized_spoof(spoofing_mode, geometry, largest_score_angle, timestamp, params, rng=None):
+    """
+    organized点群用のspoofing : 範囲内の列だけを扱う
+    戻り値 : (columns, cells) cellsは(H, len(columns), 3) float32 で、その列の点を置き換える (0は無効点)
+    注入点は実際のビームの仰角 (ring_elevation) 上に置く
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    columns = geometry.sector_columns(largest_score_angle, params.spoofing_range)
+    shape = (geometry.ring_elevation.shape[0], columns.shape[0])
+    azimuth = np.radians(geometry.column_azimuth[columns]).astype(np.float32)[None, :]
+    tan_elevation = np.tan(geometry.ring_elevation).astype(np.float32)[:, None]
+
+    if spoofing_mode == "removal":
+        # 各セルをspoofing_rateの確率で0~200mのノイズに置き換え、残りは消す
+        r = uniform_float32(rng, 0.0, 200.0, shape)
+        r[rng.random(shape, dtype=np.float32) >= params.spoofing_rate] = 0.0
 
-    elif temp_max > 360: 
-        max = temp_max - 360
-        spoofing_condition = ((temp_min <= horizontal_angle) | (horizontal_angle <= max))
-
-    else: 
-        spoofing_condition = ((temp_min <= horizontal_angle) & (horizontal_angle <= temp_max))
-    
-    return spoofing_condition
-
-def spoof_main(pointcloud, largest_score_angle, spoofing_range): 
-    angle = np.degrees(np.arctan2(pointcloud[:, 1], pointcloud[:, 0])) + 180
-    mask_condition = decide_mask(angle, largest_score_angle, spoofing_range)
-    mask_index = np.where(mask_condition)
-
-    x_spoofed , y_spoofed, z_spoofed = pointcloud[:, 0], pointcloud[:, 1], pointcloud[:, 2]
-
-    points_remaining, points_spoofed = noise_simulation(pointcloud, largest_score_angle, spoofing_range)
-   
-    x_remaining, y_remaining, z_remaining = points_remaining[:, 0], points_remaining[:, 1], points_remaining[:, 2]
-    x_spoofed, y_spoofed, z_spoofed = points_spoofed[:, 0], points_spoofed[:, 1], points_spoofed[:, 2]
-
-    return x_remaining, y_remaining, z_remaining, x_spoofed, y_spoofed, z_spoofed
+    else:
+        if spoofing_mode == "dynamic_injection":
+            injection_dist = set_distance(timestamp, params)
+        else:
+            injection_dist = params.static_wall_dist
+        r = np.full(shape, injection_dist, dtype=np.float32)
+
+        if params.injection_mode == 'corner':
+            center_angle = np.float32(np.radians(largest_score_angle + params.corner_rotation))
+            r = r / (np.abs(np.cos(azimuth - center_angle)) + np.abs(np.sin(azimuth - center_angle)))
+
+    # r : 水平距離
+    cells = np.empty(shape + (3,), dtype=np.float32)
+    np.multiply(r, np.cos(azimuth), out=cells[..., 0])
+    np.multiply(r, np.sin(azimuth), out=cells[..., 1])
+    np.multiply(r, tan_elevation, out=cells[..., 2])
+    return columns, cells
+
+def spoof_main(pointcloud, largest_score_angle, params, rng=None): 
+    # keep_mask : 元の点群のうち残す点 (True)
+    keep_mask, points_spoofed = noise_simulation(pointcloud, largest_score_angle, params, rng)
+    return keep_mask, points_spoofed
     
-def injection_main(pointcloud, largest_score_angle, spoofing_range, wall_dist):
-    points_remaining, points_spoofed = injection_simulation(pointcloud, largest_score_angle, spoofing_range, wall_dist)
-
-    x_remaining, y_remaining, z_remaining = points_remaining[:, 0], points_remaining[:, 1], points_remaining[:, 2]
-    x_spoofed, y_spoofed, z_spoofed = points_spoofed[:, 0], points_spoofed[:, 1], points_spoofed[:, 2]
-
-    return x_remaining, y_remaining, z_remaining, x_spoofed, y_spoofed, z_spoofed
+def injection_main(pointcloud, largest_score_angle, params, rng=None):
+    keep_mask, points_spoofed = injection_simulation(pointcloud, largest_score_angle, params.static_wall_dist, params, rng)
+    return keep_mask, points_spoofed
 
-def dynamic_injection_main(pointcloud, timestamp, largest_score_angle, spoofing_range):
-    wall_dist = set_distance(timestamp)
-
-    points_remaining, points_spoofed = injection_simulation(pointcloud, largest_score_angle, spoofing_range, wall_dist)
-    
-    x_remaining, y_remaining, z_remaining = points_remaining[:, 0], points_remaining[:, 1], points_remaining[:, 2]
-    x_spoofed, y_spoofed, z_spoofed = points_spoofed[:, 0], points_spoofed[:, 1], points_spoofed[:, 2]
+def dynamic_injection_main(pointcloud, timestamp, largest_score_angle, params, rng=None):
+    wall_dist = set_distance(timestamp, params)
 
-    return x_remaining, y_remaining, z_remaining, x_spoofed, y_spoofed, z_spoofed
-    #return x_spoofed, y_spoofed, z_spoofed
\ No newline at end of file
+    keep_mask, points_spoofed = injection_simulation(pointcloud, largest_score_angle, wall_dist, params, rng)
+    return keep_mask, points_spoofed
@@ -0,0 +1,350 @@
+"""
+spoofingパラメータのparameter sweep
+
+  python sweep.py
+
+config_temp.jsonのsweep.gridに {"セクション.キー": [値, ...]} を書くと、全ての組み合わせ (セル) について
+sweep.n_positions個のspoofer配置を評価する (試行iのseedは全セルで共通、配置はセルのdistance_threshold等で決まる)
+
+生成したbag / SLAMの推定軌跡はパラメータ・spoofer位置・seedから作ったkeyでsweep.cache_dirに置き、同じkeyの仕事は再実行しない
+  results (ResultsStore、campaign_id = セルのkey) に記録済み -> 何もしない
+  軌跡がcacheにある -> 評価だけ
+  bagがcacheにある -> SLAMだけ
+  それ以外 -> 生成から
+bagはsweep.bag_cache_max_bytesを超えたらSLAMで使っていないものから最後に使ったのが古い順に消す (keep_bags: falseならSLAM後すぐ消す)
+gridに値を追加した場合は新しいセルだけ、n_positionsを増やした場合は新しい試行だけを実行する
+benign軌跡は00_mainと同じBenignCacheを使い、sweep全体で1回だけ求める
+"""
+import numpy as np
+import pandas as pd
+
+# default modules
+import copy
+import dataclasses
+import functools
+import hashlib
+import itertools
+import json
+import time
+from concurrent.futures import wait, FIRST_COMPLETED, ALL_COMPLETED
+from pathlib import Path
+
+# load external files
+import benign_cache
+import error_estimate
+import file_io
+import generate_rosbag
+import results_store
+import scheduler
+import seeding
+import slam
+import spoofer
+import spoofing_sim
+
+# bagの生成方法を変えたら上げる (古いcacheを使わない)
+GENERATION_VERSION = 1
+
+def content_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+def expand_grid(config, grid):
+    # [(overrides {"セクション.キー": 値}, セルのconfig), ...]
+    names = sorted(grid)
+    cells = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        overrides = dict(zip(names, values))
+        cell = copy.deepcopy(config)
+        for name, value in overrides.items():
+            section, key = name.split('.', 1)
+            if key not in cell.get(section, {}):
+                raise ValueError(f"unknown sweep parameter: {name}")
+            cell[section][key] = value
+        cells.append((overrides, cell))
+    return cells
+
+def generation_inputs(cell, bag_fingerprint, reference_stamp):
+    # bagの中身を決めるもの (spoofer位置とseed以外)
+    inputs = {
+        'version': GENERATION_VERSION,
+        'bag': bag_fingerprint,
+        'reference': reference_stamp,
+        'params': dataclasses.asdict(spoofing_sim.load_params(cell)),
+        'rosbag': {key: cell['rosbag'].get(key) for key in seeding.GENERATION_KEYS},
+    }
+    # defenseを有効にした場合だけ含める (無効なら今までのキャッシュをそのまま使う)
+    if cell.get('defense', {}).get('enabled', False):
+        inputs['defense'] = cell['defense']
+    return inputs
+
+def generation_key(inputs, position, seed):
+    return content_key(inputs, [float(position[0]), float(position[1])], str(seed))
+
+@functools.lru_cache(maxsize=None)
+def launch_fingerprint(algorithm, launch_file):
+    # launchファイルと参照するパラメータファイルの中身 (sweepの間は変わらないものとして1回だけ読む)
+    return [[path.name, benign_cache.content_hash(path)] for path in slam.launch_dependencies(algorithm, {algorithm: launch_file})]
+
+def trajectory_key(bag_key, algorithm, rosbag_rate, launch_file):
+    return content_key(bag_key, algorithm, launch_file, float(rosbag_rate), launch_fingerprint(algorithm, launch_file))
+
+class ArtifactCache:
+    """
+    content-addressedなファイル置き場 : cache_dir/kind/key + suffix
+    kind毎にbenign_cache.BenignCacheと同じmanifestを持ち、max_bytes[kind]を超えたら最後に使ったのが古い順に消す
+    putは一時ファイルからのos.replaceなので、途中で落ちても壊れたファイルは残らない
+    """
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = Path(cache_dir)
+        self.tmp_dir = self.cache_dir / "tmp"
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes or {}
+        self.stores = {}
+
+    def store(self, kind):
+        if kind not in self.stores:
+            self.stores[kind] = benign_cache.BenignCache(self.cache_dir / kind, max_bytes=self.max_bytes.get(kind))
+        return self.stores[kind]
+
+    def get(self, kind, key, suffix):
+        return self.store(kind).get(key)
+
+    def put(self, kind, key, suffix, source, move=False, keep=()):
+        # keep : 使用中 (SLAMの実行待ち/実行中) で消してはいけないkey
+        return self.store(kind).put(key, source, suffix=suffix, move=move, keep=keep)
+
+    def discard(self, kind, key):
+        path = self.store(kind).get(key)
+        if path is not None:
+            path.unlink(missing_ok=True)
+
+def benign_trajectories(config, algorithms, runner, cache, rosbag_rate=1.0):
+    # 00_mainと同じkeyのbenign軌跡 (キャッシュが無ければSLAMを実行する)
+    launch_files = slam.launch_files(config)
+    benign_save_dir = Path(config['slam']['benign_save_dir'])
+    paths = {}
+    runs = {}
+    for algorithm in algorithms:
+        paths[algorithm] = benign_save_dir / f"{algorithm}_benign.txt"
+        cache_key = cache.key(config['rosbag']['input_bag'], algorithm, launch_files[algorithm], rosbag_rate,
+                              slam.launch_dependencies(algorithm, launch_files))
+        if cache.fetch(cache_key, paths[algorithm]):
+            continue
+        future = runner.submit(algorithm, config['rosbag']['input_bag'], config['rosbag']['lidar_topic'], benign_save_dir / algorithm,
+                               rosbag_rate=rosbag_rate, imu_topic=config['rosbag']['imu_topic'])
+        runs[algorithm] = (future, cache_key)
+
+    for algorithm, (future, cache_key) in runs.items():
+        result = future.result()
+        if not result.ok:
+            raise RuntimeError(f"benign SLAM ({algorithm}) failed: exit code {result.returncode}, log {result.log_path}")
+        result.trajectory.rename(paths[algorithm])
+        cache.put(cache_key, paths[algorithm], algorithm=algorithm, bag=str(config['rosbag']['input_bag']),
+                  launch_file=launch_files[algorithm], rosbag_rate=rosbag_rate)
+    return paths
+
+def main():
+    with open('config_temp.json', 'r') as f:
+        config = json.load(f)
+    sweep_config = config['sweep']
+    grid = sweep_config['grid']
+    n_positions = int(sweep_config['n_positions'])
+    algorithms = slam.configured_algorithms(config, sweep_config.get('algorithms'))
+    keep_bags = bool(sweep_config.get('keep_bags', True))
+    # 残すbag (入力bagと同じ大きさ) の合計の上限 [byte]。超えたら使っていないbagを古い順に消す (nullなら上限なし)
+    bag_cache_max_bytes = sweep_config.get('bag_cache_max_bytes')
+    rosbag_rate = sweep_config.get('rosbag_rate', '2.0')
+    success_threshold = float(config['evaluation']['success_threshold'])
+    backend = config['evaluation'].get('backend', 'evo')
+
+    store = results_store.ResultsStore(sweep_config.get('results_db', 'sweep.sqlite'))
+    artifacts = ArtifactCache(sweep_config['cache_dir'],
+                              max_bytes={'bags': None if bag_cache_max_bytes is None else int(bag_cache_max_bytes)})
+    cache = benign_cache.BenignCache(config['slam'].get('benign_cache_dir', Path(config['slam']['benign_save_dir']) / "cache"),
+                                     max_bytes=config['slam'].get('benign_cache_max_bytes'),
+                                     verify_content=bool(config['slam'].get('benign_cache_verify_content', False)))
+
+    # sweep.seedがnullなら、結果に影響する設定 (grid/n_positions/worker数などを除く) が同じ前回のsweepのseedを使う
+    # (gridを広げても試行のseedは同じ)
+    settings = dict(seeding.campaign_settings(config, spoofing_sim.load_params(config), algorithms), rosbag_rate=float(rosbag_rate))
+    sweep_seed = sweep_config.get('seed')
+    if sweep_seed is None:
+        # 前のversionはgridとn_positionsだけを除いたconfig全体で探していた
+        base = copy.deepcopy(config)
+        base['sweep'] = {key: value for key, value in sweep_config.items() if key not in ('grid', 'n_positions')}
+        sweep_seed = store.find_campaign(settings, fallback=base)
+    sweep_seed = seeding.campaign_seed(None if sweep_seed is None else int(sweep_seed))
+    store.register_campaign(sweep_seed, settings)
+    print(f"sweep seed: {sweep_seed}")
+    seeds = [seeding.trial_seed(sweep_seed, trial) for trial in range(n_positions)]
+
+    lidar_topic = config['rosbag']['lidar_topic']
+    imu_topic = config['rosbag']['imu_topic']
+    input_bag = config['rosbag']['input_bag']
+    ref_x, ref_y, ref_z = file_io.load_reference(config['main']['reference_file'])
+    reference_index = file_io.load_reference_index(config['main']['reference_file'])
+    frame_xy = generate_rosbag.lidar_frame_xy(input_bag, lidar_topic, reference_index)
+    if frame_xy is None:
+        frame_xy = np.column_stack((ref_x, ref_y))
+    bag_fingerprint = cache.bag_fingerprint(input_bag)
+    reference_stamp = benign_cache.file_stamp(config['main']['reference_file'])
+
+    max_parallel_slam = int(config['slam'].get('max_parallel', 1))
+    early_stop = bool(config['slam'].get('early_stop', False))
+    launch_files = slam.launch_files(config)
+    runner = slam.SlamRunner(max_parallel=max_parallel_slam, timeout=config['slam'].get('timeout'),
+                             success_threshold=success_threshold if early_stop else None,
+                             stall_timeout=config['slam'].get('stall_timeout'),
+                             poll_interval=float(config['slam'].get('monitor_interval', 1.0)),
+                             launch_files=launch_files)
+
+    cells = expand_grid(config, grid)
+    frames = []
+    with runner:
+        benign = benign_trajectories(config, algorithms, runner, cache)
+
+        for cell_index, (overrides, cell) in enumerate(cells):
+            inputs = generation_inputs(cell, bag_fingerprint, reference_stamp)
+            placement = {'dist_from_traj': cell['spoofer']['dist_from_traj'],
+                         'min_frames_in_range': cell['spoofer'].get('min_frames_in_range', 0)}
+            cell_id = content_key(sweep_seed, inputs, placement)
+            store.register_campaign(cell_id, {'sweep_seed': str(sweep_seed), 'overrides': overrides})
+            completed = store.completed(cell_id)
+            params = spoofing_sim.load_params(cell)
+            distance_threshold = float(cell['rosbag']['distance_threshold'])
+
+            placements = {}
+            bag_keys = {}
+            stats = {'recorded': 0, 'evaluated': 0, 'slam': 0, 'generated': 0}
+
+            def record(trial, algorithm, trajectory, slam_time, stopped=None):
+                evaluation_start = time.perf_counter()
+                evaluation = error_estimate.evaluate(benign[algorithm], trajectory, backend=backend)
+                spoofer_x, spoofer_y, spoofer_z = placements[trial].xyz[0]
+                store.record(cell_id, seeds[trial], algorithm,
+                             trial=trial,
+                             spoofer_x=float(spoofer_x),
+                             spoofer_y=float(spoofer_y),
+                             spoofer_z=float(spoofer_z),
+                             frames_in_range=int(placements[trial].frames[0]),
+                             weight=float(placements[trial].weight[0]),
+                             predicted_failure=False,
+                             # 途中で止めた軌跡のAPEは別の列 (最後まで実行したAPEと比べられない)
+                             APE=evaluation.ape_rmse if stopped is None else None,
+                             ape_partial=None if stopped is None else evaluation.ape_rmse,
+                             RPE=evaluation.rpe_max,
+                             slam_time=slam_time,
+                             stopped=stopped,
+                             timings={'slam': slam_time, 'evaluation': time.perf_counter() - evaluation_start})
+
+            # 試行毎に足りない仕事を決める
+            cached_bags = [] # (trial, bag_path, [algorithm, ...])
+            to_generate = {} # trial -> [algorithm, ...]
+            for trial in range(n_positions):
+                pending = [algorithm for algorithm in algorithms if (trial, algorithm) not in completed]
+                stats['recorded'] += len(algorithms) - len(pending)
+                if not pending:
+                    continue
+                placements[trial] = spoofer.sample_placements(1, seeding.placement_rng(seeds[trial]), ref_x, ref_y, ref_z,
+                                                              float(cell['spoofer']['dist_from_traj']), frame_xy, distance_threshold,
+                                                              min_frames=int(placement['min_frames_in_range']))
+                bag_keys[trial] = generation_key(inputs, placements[trial].xyz[0, :2], seeds[trial])
+
+                need_slam = []
+                for algorithm in pending:
+                    trajectory = artifacts.get('trajectories',
+                                               trajectory_key(bag_keys[trial], algorithm, rosbag_rate, launch_files[algorithm]), '.txt')
+                    if trajectory is None:
+                        need_slam.append(algorithm)
+                        continue
+                    record(trial, algorithm, trajectory, None)
+                    stats['evaluated'] += 1
+                if not need_slam:
+                    continue
+                bag_path = artifacts.get('bags', bag_keys[trial], '.bag')
+                if bag_path is None:
+                    to_generate[trial] = need_slam
+                else:
+                    cached_bags.append((trial, bag_path, need_slam))
+
+            running = {} # future -> (trial, bag_path)
+            bag_users = {} # bag_path -> 残りのSLAM数
+
+            def collect(return_when):
+                done, _ = wait(running, return_when=return_when)
+                for future in done:
+                    trial, bag_path = running.pop(future)
+                    result = future.result()
+                    if result.ok and result.stopped is None:
+                        trajectory = artifacts.put('trajectories',
+                                                   trajectory_key(bag_keys[trial], result.algorithm, rosbag_rate, launch_files[result.algorithm]),
+                                                   '.txt', result.trajectory)
+                        record(trial, result.algorithm, trajectory, result.elapsed)
+                    elif result.ok:
+                        # 早期終了した軌跡は途中までなのでcacheしない (同じkeyで最後まで実行した軌跡と区別できない)
+                        record(trial, result.algorithm, result.trajectory, result.elapsed, result.stopped)
+                    else:
+                        print(f"Error SLAM ({result.algorithm}, cell {cell_index}, trial {trial}) failed: exit code {result.returncode}, "
+                              f"timed out {result.timed_out}, stopped {result.stopped}, log {result.log_path}")
+                    bag_users[bag_path] -= 1
+                    if bag_users[bag_path] == 0:
+                        del bag_users[bag_path]
+                        if not keep_bags:
+                            artifacts.discard('bags', bag_keys[trial])
+
+            def run_slam(trial, bag_path, need_slam):
+                bag_users[bag_path] = bag_users.get(bag_path, 0) + len(need_slam)
+                for algorithm in need_slam:
+                    run_key = trajectory_key(bag_keys[trial], algorithm, rosbag_rate, launch_files[algorithm])
+                    run_dir = Path(config['slam']['save_dir']) / f"sweep_{run_key[:16]}"
+                    ground_truth = benign[algorithm] if early_stop else None
+                    future = runner.submit(algorithm, bag_path, lidar_topic, run_dir, rosbag_rate=rosbag_rate, imu_topic=imu_topic,
+                                           ground_truth=ground_truth)
+                    running[future] = (trial, bag_path)
+                    stats['slam'] += 1
+                while len(running) >= max_parallel_slam:
+                    collect(FIRST_COMPLETED)
+
+            for trial, bag_path, need_slam in cached_bags:
+                run_slam(trial, bag_path, need_slam)
+
+            if to_generate:
+                trials = [(trial, placements[trial].xyz[0, 0], placements[trial].xyz[0, 1], seeds[trial]) for trial in to_generate]
+                ready_bags = scheduler.generate_trials(trials, reference_index, params, input_bag,
+                                                       artifacts.tmp_dir / f"{cell_id[:16]}.bag",
+                                                       max_workers=config['main'].get('n_workers'),
+                                                       batch_size=int(config['main'].get('trials_per_read', 1)),
+                                                       keep_bags=True, config=cell, held_bags=max_parallel_slam)
+                for trial, bag_path, _ in ready_bags:
+                    # SLAMが使う予定/使用中のbagは消さない (bagのファイル名 = key)
+                    bag_path = artifacts.put('bags', bag_keys[trial], '.bag', bag_path, move=True,
+                                             keep=[path.stem for path in bag_users])
+                    stats['generated'] += 1
+                    run_slam(trial, bag_path, to_generate[trial])
+
+            while running:
+                collect(ALL_COMPLETED)
+
+            print(f"cell {cell_index + 1}/{len(cells)} {overrides}: recorded {stats['recorded']}, "
+                  f"evaluated from cache {stats['evaluated']}, SLAM {stats['slam']}, generated {stats['generated']}")
+
+            df = store.rows(cell_id)
+            for name, value in overrides.items():
+                df[name] = value
+            frames.append(df)
+
+    results = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    output_csv = sweep_config.get('output_csv', 'sweep_results.csv')
+    results.to_csv(output_csv, index=False)
+    print(f"Saved: {output_csv}")
+
+    # セル毎の成功率
+    if len(results):
+        results['success'] = (~results['predicted_failure']) & (results['RPE'] >= success_threshold)
+        summary = results.groupby(sorted(grid) + ['algorithm'])['success'].agg(['sum', 'count'])
+        summary['rate'] = summary['sum'] / summary['count']
+        print(summary.to_string())
+
+if __name__ == "__main__":
+    start = time.time()
+    main()
+    print(f"processing time:{time.time() - start}sec")
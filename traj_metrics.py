@@ -0,0 +1,163 @@
+"""
+evoのPoseTrajectory3D/metricsを使わないAPE/RPEの計算 (大量の軌跡を評価する用)
+軌跡は (N, 8) のTUM配列 [timestamp, x, y, z, qx, qy, qz, qw]
+error_estimate.evaluate(..., backend='numpy') から使う
+"""
+import numpy as np
+
+STATISTICS = {
+    'rmse': lambda e: float(np.sqrt(np.mean(e ** 2))),
+    'mean': lambda e: float(np.mean(e)),
+    'median': lambda e: float(np.median(e)),
+    'std': lambda e: float(np.std(e)),
+    'min': lambda e: float(np.min(e)),
+    'max': lambda e: float(np.max(e)),
+    'sse': lambda e: float(np.sum(e ** 2)),
+}
+
+def load_tum(path):
+    return np.atleast_2d(np.loadtxt(path, comments='#', dtype=np.float64))
+
+def quaternion_to_rotation(q):
+    # q : (N, 4) [qx, qy, qz, qw] -> (N, 3, 3)
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+    x, y, z, w = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    return np.stack((
+        np.stack((1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)), axis=1),
+        np.stack((2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)), axis=1),
+        np.stack((2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)), axis=1),
+    ), axis=1)
+
+def matching_time_indices(stamps_1, stamps_2, max_diff=0.01):
+    # evo.core.sync.matching_time_indices と同じ対応付け (stamps_2はソート済み)
+    index_2 = np.minimum(np.searchsorted(stamps_2, stamps_1, side='right'), len(stamps_2) - 1)
+    diff_ub = stamps_2[index_2] - stamps_1
+    diff_lb = np.where(index_2 > 0, stamps_1 - stamps_2[np.maximum(index_2 - 1, 0)], np.inf)
+
+    use_ub = (diff_ub <= max_diff) & (diff_ub < diff_lb)
+    use_lb = ~use_ub & (diff_lb <= max_diff) & (diff_lb <= diff_ub)
+    in_range = (stamps_1 >= stamps_2[0] - max_diff) & (stamps_1 <= stamps_2[-1] + max_diff)
+    matched = in_range & (use_ub | use_lb)
+
+    indices_1 = np.flatnonzero(matched)
+    indices_2 = np.where(use_ub, index_2, index_2 - 1)[matched]
+    return indices_1, indices_2
+
+def associate(traj_1, traj_2, max_diff=0.01):
+    # evo.core.sync.associate_trajectories と同じく短い方を基準にする
+    second_longer = traj_2.shape[0] > traj_1.shape[0]
+    short, long = (traj_1, traj_2) if second_longer else (traj_2, traj_1)
+    indices_short, indices_long = matching_time_indices(short[:, 0], long[:, 0], max_diff)
+    if indices_short.shape[0] == 0:
+        raise ValueError(f"found no matching timestamps with max. time diff {max_diff} (s)")
+
+    short, long = short[indices_short], long[indices_long]
+    return (short, long) if second_longer else (long, short)
+
+def umeyama_alignment(x, y):
+    # x, y : (N, 3)  y ≒ R x + t となる R, t (スケールなし)
+    mean_x, mean_y = x.mean(axis=0), y.mean(axis=0)
+    cov_xy = (y - mean_y).T @ (x - mean_x) / x.shape[0]
+    return umeyama_from_moments(mean_x, mean_y, cov_xy)
+
+def umeyama_from_moments(mean_x, mean_y, cov_xy):
+    # 平均と共分散から R, t (姿勢を追加しながら位置合わせし直す場合は和から求めた値を渡す)
+    u, d, v = np.linalg.svd(cov_xy)
+    if np.count_nonzero(d > np.finfo(d.dtype).eps) < 2:
+        raise ValueError("Degenerate covariance rank, Umeyama alignment is not possible")
+
+    s = np.eye(3)
+    if np.linalg.det(u) * np.linalg.det(v) < 0.0:
+        s[2, 2] = -1
+    r = u @ s @ v
+    t = mean_y - r @ mean_x
+    return r, t
+
+def align(traj, r, t):
+    # 位置と姿勢の両方に R, t を適用する
+    aligned = traj.copy()
+    aligned[:, 1:4] = traj[:, 1:4] @ r.T + t
+    rotation = r @ quaternion_to_rotation(traj[:, 4:8])
+    aligned[:, 4:8] = rotation_to_quaternion(rotation)
+    return aligned
+
+def rotation_to_quaternion(rotation):
+    # (N, 3, 3) -> (N, 4) [qx, qy, qz, qw]
+    m = rotation
+    trace = m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2]
+    q = np.empty((m.shape[0], 4))
+    candidates = np.stack((trace, m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]), axis=1)
+    case = np.argmax(candidates, axis=1)
+
+    c = case == 0
+    s = np.sqrt(1.0 + trace[c]) * 2
+    q[c] = np.stack(((m[c, 2, 1] - m[c, 1, 2]) / s, (m[c, 0, 2] - m[c, 2, 0]) / s, (m[c, 1, 0] - m[c, 0, 1]) / s, 0.25 * s), axis=1)
+    for axis in range(3):
+        c = case == axis + 1
+        i, j, k = axis, (axis + 1) % 3, (axis + 2) % 3
+        s = np.sqrt(1.0 + m[c, i, i] - m[c, j, j] - m[c, k, k]) * 2
+        q[c, i] = 0.25 * s
+        q[c, j] = (m[c, j, i] + m[c, i, j]) / s
+        q[c, k] = (m[c, k, i] + m[c, i, k]) / s
+        q[c, 3] = (m[c, k, j] - m[c, j, k]) / s
+    return q
+
+def ape_translation(traj_a, traj_b):
+    # 各時刻の位置誤差 ||p_a - p_b||
+    return np.linalg.norm(traj_a[:, 1:4] - traj_b[:, 1:4], axis=1)
+
+def path_pairs(positions, delta):
+    # evo.core.filters.filter_pairs_by_path (all_pairs=False) と同じindexの組
+    # 各点からdelta進んだ先のindexを一括で求めてから連鎖をたどる
+    steps = np.linalg.norm(np.diff(positions, axis=0), axis=1)
+    distances = np.concatenate(([0.0], np.cumsum(steps)))
+    next_index = np.searchsorted(distances, distances + delta, side='left')
+
+    ids = [0]
+    while True:
+        j = next_index[ids[-1]]
+        if j >= positions.shape[0]:
+            break
+        ids.append(int(j))
+    ids = np.array(ids)
+    return ids[:-1], ids[1:]
+
+def rpe_translation(traj_q, traj_p, delta):
+    # evo.core.metrics.RPE (translation_part, delta[m]) と同じ : data = (traj_q, traj_p), pairはtraj_pの経路長から
+    i, j = path_pairs(traj_p[:, 1:4], delta)
+    if i.shape[0] == 0:
+        raise ValueError(f"delta = {delta} (m) produced an empty index list")
+    return pair_translation_error(traj_q, traj_p, i, j)
+
+def pair_translation_error(traj_q, traj_p, i, j):
+    # 姿勢の組 (i, j) 毎の相対移動の差 (RPE translation)
+    rotation_q = quaternion_to_rotation(traj_q[i, 4:8])
+    rotation_p = quaternion_to_rotation(traj_p[i, 4:8])
+    q_rel = np.einsum('nji,nj->ni', rotation_q, traj_q[j, 1:4] - traj_q[i, 1:4])
+    p_rel = np.einsum('nji,nj->ni', rotation_p, traj_p[j, 1:4] - traj_p[i, 1:4])
+    return np.linalg.norm(p_rel - q_rel, axis=1)
+
+def evaluate_arrays(traj_est, traj_ref, ape=('rmse',), rpe=('max',), rpe_delta=5.0, max_diff=0.01):
+    """
+    error_estimate.evaluate と同じ手順 : 対応付け -> traj_estをtraj_refに位置合わせ -> APE/RPE
+    戻り値 : ({'ape': {統計量: 値}, 'rpe': {...}}, 対応付けできた姿勢数)
+    """
+    traj_ref, traj_est = associate(traj_ref, traj_est, max_diff)
+    r, t = umeyama_alignment(traj_est[:, 1:4], traj_ref[:, 1:4])
+    traj_est = align(traj_est, r, t)
+
+    stats = {'ape': {}, 'rpe': {}}
+    if ape:
+        ape_error = ape_translation(traj_est, traj_ref)
+        stats['ape'] = {name: STATISTICS[name](ape_error) for name in ape}
+    if rpe:
+        rpe_error = rpe_translation(traj_est, traj_ref, rpe_delta)
+        stats['rpe'] = {name: STATISTICS[name](rpe_error) for name in rpe}
+    return stats, traj_est.shape[0]
+
+def nearest_distances(query, points):
+    # query各点からpoints内の最近傍点までの距離
+    # scipyはここでだけ使うので呼ばれた時にimportする (in-process SLAMのworkerは軌跡の変換にしか使わない)
+    from scipy.spatial import cKDTree
+    distance, _ = cKDTree(points).query(query)
+    return distance
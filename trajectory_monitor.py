@@ -0,0 +1,158 @@
+"""
+実行中のSLAMが書いている推定軌跡 (TUM, temp.txt) を読み進め、benign軌跡と比べる
+SlamRunnerが一定間隔でpoll()を呼び、結果が決まった (RPEがsuccess_thresholdを超えた) か止まった時点でroslaunchを止める
+
+RPE (translation, pairは経路長delta毎) は位置合わせに依らず、軌跡の先頭部分のRPEの最大値は全体のRPEの最大値以下
+-> 途中でsuccess_thresholdを超えれば最後まで実行しても成功
+RPE/APEは新しく読んだ姿勢の分だけ更新する (pollの度に全姿勢から計算し直さない)
+推定軌跡の各姿勢をbenign軌跡に対応付ける (evoは短い方を基準にするので、推定がbenignより長くなった後は少し違う)
+"""
+import numpy as np
+
+# default modules
+import time
+from pathlib import Path
+
+# load external files
+import traj_metrics
+
+RUNNING = 'running'
+SUCCESS = 'success'
+STALLED = 'stalled'
+
+# error_estimate.RPE_DELTAと同じ (error_estimate/evoをSLAMの実行側でimportしない)
+RPE_DELTA = 5.0
+
+class TrajectoryMonitor:
+    """
+    path : SLAMの出力 (まだ無くても良い)
+    ground_truth : benign軌跡 (TUMファイルのパスか (N, 8) の配列)、Noneなら停止の判定だけ行う
+    stall_timeout : 最初の姿勢の後、新しい姿勢がこの秒数書かれなければSTALLED、Noneなら判定しない
+                    (起動/地図の読み込みに掛かる時間は数えない。最初の姿勢が書かれない場合はSlamRunnerのtimeoutで止める)
+    """
+    def __init__(self, path, ground_truth=None, success_threshold=None, stall_timeout=None, rpe_delta=RPE_DELTA, max_diff=0.01):
+        self.path = Path(path)
+        if ground_truth is not None and not isinstance(ground_truth, np.ndarray):
+            ground_truth = traj_metrics.load_tum(ground_truth)
+        self.ground_truth = ground_truth
+        self.success_threshold = success_threshold
+        self.stall_timeout = stall_timeout
+        self.rpe_delta = rpe_delta
+        self.max_diff = max_diff
+
+        self.rows = []
+        self.ape = None
+        self.rpe = None
+        self._offset = 0
+        self._partial = b''
+        self._last_update = None # 最初の姿勢を読むまでNone
+
+        # RPE : 最後のpairの終点 (推定, benign) と経路長
+        self._chain = None
+        self._chain_distance = 0.0
+        self._distance = 0.0
+        self._last_position = None
+        # APE : 位置合わせ用の和 (x = benign, y = 推定、桁落ちしないよう最初のbenign位置を原点にする)
+        self._origin = None
+        self._n = 0
+        self._sum_x = np.zeros(3)
+        self._sum_y = np.zeros(3)
+        self._sum_yx = np.zeros((3, 3))
+        self._sum_xx = 0.0
+        self._sum_yy = 0.0
+
+    def read_new_poses(self):
+        # 前回の続きから読む。改行で終わっていない最後の行は次回に回す
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        self._offset += len(data)
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+
+        n_new = 0
+        for line in lines:
+            values = line.split()
+            if len(values) != 8 or line.lstrip().startswith(b'#'):
+                continue
+            self.rows.append([float(value) for value in values])
+            n_new += 1
+        if n_new:
+            self._last_update = time.monotonic()
+        return n_new
+
+    def update_errors(self, n_new):
+        # 新しいn_new個の姿勢でRPE (max) / APE (rmse) を更新する
+        # 00_mainと同じくerror_estimate.evaluate(benign, 推定) の順 (benignを推定に位置合わせする)
+        new_rows = np.asarray(self.rows[-n_new:])
+        index_estimate, index_ground_truth = traj_metrics.matching_time_indices(new_rows[:, 0], self.ground_truth[:, 0], self.max_diff)
+        if index_estimate.shape[0] == 0:
+            return
+        estimate, ground_truth = new_rows[index_estimate], self.ground_truth[index_ground_truth]
+        self._update_rpe(estimate, ground_truth)
+        self._update_ape(estimate, ground_truth)
+
+    def _update_rpe(self, estimate, ground_truth):
+        # traj_metrics.path_pairsと同じpair : 前のpairの終点から推定軌跡の経路長がdelta以上になった最初の姿勢
+        positions = estimate[:, 1:4]
+        previous = positions[:1] if self._last_position is None else self._last_position[None]
+        distances = self._distance + np.cumsum(np.linalg.norm(np.diff(np.vstack((previous, positions)), axis=0), axis=1))
+        self._distance, self._last_position = float(distances[-1]), positions[-1]
+        if self._chain is None:
+            self._chain = (estimate[0], ground_truth[0])
+            self._chain_distance = float(distances[0])
+
+        starts, ends = [], []
+        while True:
+            k = np.searchsorted(distances, self._chain_distance + self.rpe_delta, side='left')
+            if k >= distances.shape[0]:
+                break
+            starts.append(self._chain)
+            self._chain = (estimate[k], ground_truth[k])
+            self._chain_distance = float(distances[k])
+            ends.append(self._chain)
+        if not starts:
+            return
+
+        n = len(starts)
+        estimate_pairs = np.array([pose[0] for pose in starts + ends])
+        ground_truth_pairs = np.array([pose[1] for pose in starts + ends])
+        errors = traj_metrics.pair_translation_error(ground_truth_pairs, estimate_pairs, np.arange(n), np.arange(n) + n)
+        self.rpe = max(float(np.max(errors)), -np.inf if self.rpe is None else self.rpe)
+
+    def _update_ape(self, estimate, ground_truth):
+        # 和を足してからUmeyamaで位置合わせし直し、RMSEは和から求める : Σ|R x + t - y|^2
+        if self._origin is None:
+            self._origin = ground_truth[0, 1:4].copy()
+        x = ground_truth[:, 1:4] - self._origin
+        y = estimate[:, 1:4] - self._origin
+        self._n += x.shape[0]
+        self._sum_x += x.sum(axis=0)
+        self._sum_y += y.sum(axis=0)
+        self._sum_yx += y.T @ x
+        self._sum_xx += float(np.sum(x * x))
+        self._sum_yy += float(np.sum(y * y))
+
+        mean_x, mean_y = self._sum_x / self._n, self._sum_y / self._n
+        try:
+            r, t = traj_metrics.umeyama_from_moments(mean_x, mean_y, self._sum_yx / self._n - np.outer(mean_y, mean_x))
+        except ValueError:
+            # 姿勢が少なく位置合わせできない (RPEは位置合わせに依らない)
+            return
+        sse = (self._sum_xx + self._sum_yy + self._n * (t @ t) - 2.0 * np.sum(r * self._sum_yx)
+               + 2.0 * t @ (r @ self._sum_x) - 2.0 * t @ self._sum_y)
+        self.ape = float(np.sqrt(max(sse, 0.0) / self._n))
+
+    def poll(self):
+        n_new = self.read_new_poses()
+        if n_new and self.ground_truth is not None:
+            self.update_errors(n_new)
+            if self.success_threshold is not None and self.rpe is not None and self.rpe >= self.success_threshold:
+                return SUCCESS
+        if (self.stall_timeout is not None and self._last_update is not None
+                and time.monotonic() - self._last_update > self.stall_timeout):
+            return STALLED
+        return RUNNING